@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Breadth Benchmark
+@author: Parker Lamb
+@description: Benchmark of the batched breadth engine in characterization.py against the original
+per-coordinate loop. Both are run on the same coordinates and Canny edge map, and their bp+bn
+values are compared (except for rays reaching the image border, which the original loop wrapped
+around the image). The directional BreadthIndex lookup is timed and compared as well.
+@usage: "python breadth.py <coordinate-file> <width-map .fits or .sav file>"
+"""
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from collections import OrderedDict
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "characterization"))
+from characterization import calculate_breadth, edge_map, load_coordinates
+from breadth_index import BreadthIndex, DEFAULT_MAX_RADIUS, agreement
+from sav_arrays import read_sav
+
+def load_width_map(path):
+    """
+    Load the Halpha width map from a .sav or .fits file.
+    """
+    if ".sav" in path:
+        # Reads the converted .arrays if there is one (see sav_arrays.py)
+        return read_sav(path, ["halpha_width"])['halpha_width']
+    from astropy.io import fits
+    with fits.open(path, ignore_missing_end=True) as f:
+        return np.array(f[0].data, dtype=np.float32)
+
+def legacy_breadth(coords, edges):
+    """
+    The original per-coordinate breadth loop from characterization.py, kept as a reference.
+    """
+    breadth = []
+    for key in coords.keys():
+        coordinfo = list(coords[key])
+        for coord in coordinfo:
+            nextcoord = next((i for i, val in enumerate(coordinfo) if np.all(val == coord)), -1)+1
+            prevcoord = next((i for i, val in enumerate(coordinfo) if np.all(val == coord)), -1)-1
+            if nextcoord > len(coordinfo)-1:
+                nextcoord = len(coordinfo)-1
+            if prevcoord < 0:
+                prevcoord = 0
+            nextcoord = coordinfo[nextcoord]
+            prevcoord = coordinfo[prevcoord]
+            dx = nextcoord[1]-prevcoord[1]
+            dy = nextcoord[0]-prevcoord[0]
+            v = np.array([dx,dy])
+            dp = np.empty_like(v)
+            dp[0] = -v[1]
+            dp[1] = v[0]
+            mag = np.sqrt(dp[0]**2+dp[1]**2)
+            dp[0] = dp[0]/mag
+            dp[1] = dp[1]/mag
+            dp[0] = round(dp[0])
+            dp[1] = round(dp[1])
+            bp= 0
+            coord_offset = np.array([round(coord[1]),round(coord[0])])
+            while edges[coord_offset[0],coord_offset[1]] == 0:
+                bp+=1
+                coord_offset[0] = coord_offset[0]+dp[0]
+                coord_offset[1] = coord_offset[1]+dp[1]
+            bn = 0
+            coord_offset = np.array([round(coord[1]),round(coord[0])])
+            while edges[coord_offset[0],coord_offset[1]] == 0:
+                bn+=1
+                coord_offset[0] = coord_offset[0]-dp[0]
+                coord_offset[1] = coord_offset[1]-dp[1]
+            breadth.append(bp+bn)
+    return np.array(breadth)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the batched breadth engine against the original loop.")
+    parser.add_argument('coordinate_file', help='OCCULT-2 coordinates file')
+    parser.add_argument('width_file', help='.sav or .fits file containing the Halpha width map')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of the batched engine')
+    parser.add_argument('--max-radius', type=int, default=DEFAULT_MAX_RADIUS, help='maximum radius of the breadth index')
+    args = parser.parse_args()
+
+    width_map = load_width_map(args.width_file)
+    fibrils = load_coordinates(args.coordinate_file)
+    edges = edge_map(width_map)
+
+    # The original loop works on {fibril_id: np.array([[x,y], ...])}
+    coords = OrderedDict(zip(fibrils.ids, fibrils))
+    keys = list(coords)
+    lengths = fibrils.lengths
+    allcoords = np.column_stack((fibrils.x, fibrils.y))
+
+    t0 = time.perf_counter()
+    legacy = legacy_breadth(coords, edges)
+    t_legacy = time.perf_counter() - t0
+
+    t_batched = []
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        bp, bn, dp = calculate_breadth(allcoords[:,0], allcoords[:,1], lengths, edges)
+        t_batched.append(time.perf_counter() - t0)
+    batched = bp+bn
+
+    t0 = time.perf_counter()
+    index = BreadthIndex(edges, args.max_radius)
+    t_build = time.perf_counter() - t0
+    t_lookup = []
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        index_bp, index_bn, _ = calculate_breadth(allcoords[:,0], allcoords[:,1], lengths, edges, index=index)
+        t_lookup.append(time.perf_counter() - t0)
+    # The index caps each side at max_radius, and is otherwise exact
+    index_mismatches = np.count_nonzero((index_bp != np.minimum(bp, args.max_radius)) | (index_bn != np.minimum(bn, args.max_radius)))
+    check = agreement(batched, index_bp+index_bn)
+
+    # The original loop wrapped around to the far side of the image when it stepped past
+    # the low border, while the batched engine stops at the border. Only compare the rest.
+    start = np.stack((np.rint(allcoords[:,1]), np.rint(allcoords[:,0])), axis=1).astype(np.int64)
+    ends = np.concatenate((start + dp*bp[:,None], start - dp*bn[:,None]))
+    outside = np.any((ends < 0) | (ends >= edges.shape), axis=1)
+    border = outside[:len(start)] | outside[len(start):]
+    mismatches = np.count_nonzero((legacy != batched) & ~border)
+    print(
+        "Fibrils: {}, coordinates: {}\n".format(len(keys), len(allcoords)),
+        "Original loop: {:.3f} s\n".format(t_legacy),
+        "Batched engine: {:.3f} s (best of {})\n".format(min(t_batched), args.repeat),
+        "Speedup: {:.1f}x\n".format(t_legacy/min(t_batched)),
+        "Rays reaching the image border: {}\n".format(np.count_nonzero(border)),
+        "Mismatched breadths: {}\n".format(mismatches),
+        "Breadth index: {:.3f} s to build ({:.1f} MB), {:.3f} s per lookup (best of {})\n".format(t_build, index.nbytes/2**20, min(t_lookup), args.repeat),
+        "Index breadths equal to the batched engine: {:.2%} (within 1 px: {:.2%}, max difference {:.0f} px)\n".format(check["equal"], check["within_1"], check["max_abs"]),
+        "Mismatched index counts (after the {} px cap): {}".format(args.max_radius, index_mismatches)
+    )
+    if mismatches or index_mismatches:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Import Time Benchmark
+@author: Parker Lamb
+@description: Regression check of headless startup time. Each module used by the batch jobs is
+imported in a fresh interpreter, as a short-lived job would, and the import is timed. The check
+fails if any import takes longer than the budget, or pulls in one of the heavy dependencies
+(PySide6, matplotlib, cv2, sunkit_image, astropy) that should only load on the code paths that
+need them.
+@usage: "python import_time.py [--budget 0.5] [--repeat 5] [--modules tracing characterization]"
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+PATHS = [os.path.join(BENCHMARKS, os.pardir, directory) for directory in ("curve-tracing", "characterization")]
+
+# Modules imported by headless jobs
+HEADLESS_MODULES = ("coordinates", "fibril_store", "fits_images", "sampling", "geometry", "session", "tracing", "batch",
+                    "sav_arrays", "characterization", "breadth_index", "service", "stats", "timeseries")
+
+# Dependencies taking a noticeable time to import, which no headless module should import
+HEAVY_MODULES = ("PySide6", "matplotlib", "cv2", "sunkit_image", "astropy")
+
+# Seconds each headless import may take, including NumPy (about 0.1 s)
+DEFAULT_BUDGET = 0.5
+
+# Run in the fresh interpreter: time the import and list the heavy modules it loaded
+PROBE = """
+import json, sys, time
+sys.path[:0] = {paths!r}
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = sorted(name for name in {heavy!r} if name in sys.modules)
+print(json.dumps({{"seconds": elapsed, "heavy": heavy}}))
+"""
+
+def time_import(module, repeat=5):
+    """
+    Import a module in repeat fresh interpreters.
+
+    Returns
+    -------
+    dict
+        Best and all import times, in seconds, and the heavy modules loaded by the import
+    """
+    times = []
+    heavy = []
+    for _ in range(repeat):
+        code = PROBE.format(paths=PATHS, module=module, heavy=HEAVY_MODULES)
+        output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        times.append(result["seconds"])
+        heavy = result["heavy"]
+    return {"module": module, "best": min(times), "times": times, "heavy": heavy}
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that headless modules import within a time budget.")
+    parser.add_argument('--modules', nargs='+', default=list(HEADLESS_MODULES), help='modules to import (default: all headless modules)')
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET, help='seconds each import may take (default: {})'.format(DEFAULT_BUDGET))
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per module, of which the best time is used (default: 5)')
+    args = parser.parse_args()
+
+    failures = 0
+    for module in args.modules:
+        result = time_import(module, args.repeat)
+        problems = []
+        if result["best"] > args.budget:
+            problems.append("over the {:.2f} s budget".format(args.budget))
+        if result["heavy"]:
+            problems.append("imports {}".format(", ".join(result["heavy"])))
+        failures += bool(problems)
+        print("{:<18} {:.3f} s  {}".format(module, result["best"], "; ".join(problems) or "ok"))
+    if failures:
+        sys.exit("{} of {} modules failed the import check".format(failures, len(args.modules)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Optimizer Benchmark
+@author: Parker Lamb
+@description: Wall-clock benchmark of the OCCULT-2 parameter optimizer in optimization/optimize.py.
+The full 150 parameter set grid of optimize_occult_2_parameters.pro is run serially (one worker, as
+the IDL sweep does) and in parallel, and compared to the coarse-to-fine search.
+@usage: "python optimizer.py <image.fits> [--workers n] [--roi y0 y1 x0 x1]"
+"""
+
+import argparse
+import os
+import sys
+import time
+
+OPTIMIZATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "optimization")
+sys.path.append(OPTIMIZATION)
+from optimize import MANUAL_RESULTS, Optimizer, load_manual_fibrils
+
+def run(image, manual, search, workers, roi):
+    """
+    Run one search, returning (wall-clock seconds, number of parameter sets, best set, its result).
+    """
+    start = time.perf_counter()
+    with Optimizer(image, manual, workers=workers, roi=roi) as optimizer:
+        if search == "grid":
+            optimizer.grid_search()
+        else:
+            optimizer.coarse_to_fine()
+        best = optimizer.best()
+        return time.perf_counter() - start, len(optimizer.results), optimizer.params(best), optimizer.results[best]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the OCCULT-2 parameter optimizer.")
+    parser.add_argument('image', help='FITS image to run OCCULT-2 on')
+    parser.add_argument('--workers', type=int, default=None, help='number of workers for the parallel runs (default: one per core)')
+    parser.add_argument('--roi', type=int, nargs=4, metavar=('Y0', 'Y1', 'X0', 'X1'), help='only trace this region of the image')
+    parser.add_argument('--skip-serial', action='store_true', help='skip the serial grid run')
+    args = parser.parse_args()
+
+    manual = load_manual_fibrils([(os.path.join(OPTIMIZATION, path), offset) for path, offset in MANUAL_RESULTS])
+
+    runs = [("grid", args.workers, "parallel grid"), ("coarse", args.workers, "coarse-to-fine")]
+    if not args.skip_serial:
+        runs.insert(0, ("grid", 1, "serial grid"))
+    timings = {}
+    for search, workers, label in runs:
+        seconds, count, best, result = run(args.image, manual, search, workers, args.roi)
+        timings[label] = seconds
+        print("{}: {} parameter sets in {:.1f} s, best {} (occult {:.4f}, manual {:.4f})".format(
+            label, count, seconds, best, *result))
+    if "serial grid" in timings:
+        for label in ("parallel grid", "coarse-to-fine"):
+            print("{} speedup over serial grid: {:.1f}x".format(label, timings["serial grid"]/timings[label]))
+
+if __name__ == "__main__":
+    main()
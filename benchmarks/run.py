@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Benchmark Suite
+@author: Parker Lamb
+@description: Times the main stages of the pipeline (OCCULT-2 tracing, coordinate and characteristics
+loading, edge detection, map sampling, breadth, fibril geometry and proximity matching) on the
+bundled m300 frame and on synthetic frames of any size and fibril count (see synthetic.py). Each
+timing is appended to a JSON lines file, one record per dataset and stage, tagged with the git
+version, so runs of different versions and sizes can be compared (--summarize).
+@usage: "python run.py [--synthetic 500:1024 4000:4096] [--cases sample breadth] [--output results.jsonl]"
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+import numpy as np
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCHMARKS, os.pardir, "curve-tracing"))
+sys.path.append(os.path.join(BENCHMARKS, os.pardir, "characterization"))
+sys.path.append(os.path.join(BENCHMARKS, os.pardir, "optimization"))
+from coordinates import FibrilCoordinates, read_coordinates
+from fits_images import FitsMaps
+import synthetic
+
+# The bundled frame, relative to the repository
+M300 = {
+    "maps": "data/images/fits",
+    "suffix": "mfbd_m300",
+    "coordinates": "data/occult_results/occult_output.dat",
+    "characteristics": "data/characteristics/characteristics.csv",
+}
+
+# Stages run once however many repeats are asked for, as a single run takes minutes
+SLOW_CASES = ("trace",)
+
+class Dataset:
+    def __init__(self, name, maps, coordinates, reference, image_file, coordinate_file, characteristics_file):
+        """
+        Everything the benchmark cases run on.
+
+        Parameters
+        ----------
+        name : str
+            Name of the dataset in the results, i.e. m300 or synthetic-500x1024
+        maps : dict
+            Intensity, velocity and width maps (as returned by load_maps)
+        coordinates : FibrilCoordinates
+            Fibrils to characterize
+        reference : FibrilCoordinates
+            Fibrils to match the coordinates against (manual traces, or the synthetic ground truth)
+        image_file : str
+            FITS image traced by OCCULT-2
+        coordinate_file : str
+            File the coordinates were read from
+        characteristics_file : str
+            Characteristics .csv of the fibrils
+        """
+        self.name = name
+        self.maps = maps
+        self.coordinates = coordinates
+        self.reference = reference
+        self.image_file = image_file
+        self.coordinate_file = coordinate_file
+        self.characteristics_file = characteristics_file
+
+    @property
+    def shape(self):
+        return self.maps["width"].shape
+
+def m300_dataset(root=os.path.join(BENCHMARKS, os.pardir)):
+    """
+    The bundled m300 frame, its OCCULT-2 fibrils and characteristics, and the manual traces.
+    """
+    from optimize import MANUAL_RESULTS, load_manual_fibrils
+
+    path = lambda name: os.path.join(root, M300[name])
+    with FitsMaps.from_directory(path("maps"), M300["suffix"], names=list(synthetic.MAP_NAMES.values())) as maps:
+        planes = maps.read()
+    maps = {name: planes[fits_name] for name, fits_name in synthetic.MAP_NAMES.items()}
+    manual = load_manual_fibrils([(os.path.join(root, file), offset) for file, offset in MANUAL_RESULTS])
+    image_file = os.path.join(path("maps"), "halpha_width_{}.fits".format(M300["suffix"]))
+    return Dataset("m300", maps, read_coordinates(path("coordinates")), manual, image_file,
+                   path("coordinates"), path("characteristics"))
+
+def synthetic_dataset(nfibrils, size, directory, seed=0):
+    """
+    A synthetic frame of size x size pixels with nfibrils fibrils, written to directory. The
+    fibrils characterized are the ground truth, which is also matched against a copy moved
+    by up to a pixel.
+    """
+    from characterization import characterize, edge_map, write_characteristics
+
+    shape = (size, size)
+    truth = synthetic.synthetic_fibrils(nfibrils, shape, seed=seed)
+    maps = synthetic.synthetic_maps(truth, shape, seed=seed)
+    paths = synthetic.write_maps(directory, maps)
+    coordinate_file = os.path.join(directory, "coordinates_{}.csv".format(synthetic.SUFFIX))
+    synthetic.write_coordinates(coordinate_file, truth)
+    characteristics_file = os.path.join(directory, "characteristics_{}.csv".format(synthetic.SUFFIX))
+    write_characteristics(characteristics_file, characterize(truth, maps, edge_map(maps["width"])))
+
+    rng = np.random.default_rng(seed + 2)
+    moved = FibrilCoordinates(truth.ids, truth.offsets, truth.lengths,
+                              truth.x + rng.uniform(-1, 1, truth.npoints), truth.y + rng.uniform(-1, 1, truth.npoints))
+    return Dataset("synthetic-{}x{}".format(nfibrils, size), maps, truth, moved, paths["width"],
+                   coordinate_file, characteristics_file)
+
+# Each case takes a dataset and returns (function to time, number of points it handles)
+
+def trace_case(data):
+    from tracing import AutoTracing
+    tracer = AutoTracing(data.image_file)
+    return tracer.run, tracer.img_data.size
+
+def load_coordinates_case(data):
+    return lambda: read_coordinates(data.coordinate_file), data.coordinates.npoints
+
+def load_characteristics_case(data):
+    from stats import read_chunks
+    return lambda: sum(len(chunk) for chunk in read_chunks(data.characteristics_file)), data.coordinates.npoints
+
+def edges_case(data):
+    from characterization import edge_map
+    return lambda: edge_map(data.maps["width"]), data.maps["width"].size
+
+def sample_case(data):
+    from sampling import sample_maps
+    coords = data.coordinates
+    return lambda: sample_maps(data.maps, coords.x, coords.y, "bilinear"), coords.npoints
+
+def breadth_case(data):
+    from characterization import calculate_breadth, edge_map
+    coords = data.coordinates
+    edges = edge_map(data.maps["width"])
+    return lambda: calculate_breadth(coords.x, coords.y, coords.lengths, edges), coords.npoints
+
+def breadth_index_case(data):
+    from characterization import calculate_breadth, edge_map
+    from breadth_index import BreadthIndex
+    coords = data.coordinates
+    edges = edge_map(data.maps["width"])
+    # Building the index is part of the cost, as it's done once per frame
+    return lambda: calculate_breadth(coords.x, coords.y, coords.lengths, edges, index=BreadthIndex(edges)), coords.npoints
+
+def geometry_case(data):
+    from geometry import FibrilGeometry
+    coords = data.coordinates
+    return lambda: FibrilGeometry(coords), coords.npoints
+
+def proximity_case(data):
+    from optimize import match_percentages
+    return lambda: match_percentages(data.coordinates, data.reference), data.coordinates.npoints + data.reference.npoints
+
+CASES = OrderedDict([
+    ("trace", trace_case),
+    ("load_coordinates", load_coordinates_case),
+    ("load_characteristics", load_characteristics_case),
+    ("edges", edges_case),
+    ("sample", sample_case),
+    ("breadth", breadth_case),
+    ("breadth_index", breadth_index_case),
+    ("geometry", geometry_case),
+    ("proximity", proximity_case),
+])
+
+def version():
+    """The git version of the repository, i.e. 661412e or 661412e-dirty."""
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=BENCHMARKS, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def environment():
+    """Where and when the benchmarks ran, added to every record."""
+    return {
+        "version": version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": platform.node(),
+        "cpus": len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+    }
+
+def run_case(name, data, repeat):
+    """
+    Time one case on one dataset, repeat times (once for SLOW_CASES).
+
+    Returns
+    -------
+    dict
+        The record of the case: dataset size, every timing, and the best and median timings
+    """
+    function, count = CASES[name](data)
+    seconds = []
+    for _ in range(1 if name in SLOW_CASES else repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    best = min(seconds)
+    return {
+        "dataset": data.name,
+        "case": name,
+        "rows": data.shape[0],
+        "columns": data.shape[1],
+        "fibrils": len(data.coordinates),
+        "points": data.coordinates.npoints,
+        "seconds": seconds,
+        "best": best,
+        "median": float(np.median(seconds)),
+        "items_per_second": count/best if best > 0 else None,
+    }
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def summarize(records):
+    """
+    Table of the best time of each case on each dataset, with a column per version.
+    """
+    versions = list(OrderedDict.fromkeys(record["version"] for record in records))
+    best = OrderedDict()
+    for record in records:
+        key = (record["case"], record["dataset"])
+        times = best.setdefault(key, {})
+        times[record["version"]] = min(times.get(record["version"], np.inf), record["best"])
+    lines = ["{:<22}{:<26}".format("case", "dataset") + "".join("{:>16}".format(v[:15]) for v in versions)]
+    for (case, dataset), times in sorted(best.items()):
+        cells = ["{:>16.4f}".format(times[v]) if v in times else "{:>16}".format("-") for v in versions]
+        lines.append("{:<22}{:<26}".format(case, dataset) + "".join(cells))
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the tracing and characterization stages.")
+    parser.add_argument('--synthetic', nargs='+', default=[], metavar='FIBRILS:SIZE', help='synthetic datasets, i.e. 500:1024 4000:4096')
+    parser.add_argument('--no-m300', action='store_true', help='skip the bundled m300 frame')
+    parser.add_argument('--cases', nargs='+', default=list(CASES), choices=list(CASES), help='cases to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of each case, of which the best is reported (default: 3)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic datasets (default: 0)')
+    parser.add_argument('--output', default=os.path.join(BENCHMARKS, "results.jsonl"), help='JSON lines file to append the results to')
+    parser.add_argument('--summarize', action='store_true', help='print a table of the results in --output and exit')
+    args = parser.parse_args()
+
+    if args.summarize:
+        print(summarize(read_records(args.output)))
+        return
+
+    env = environment()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Datasets are made one at a time, as the 4k ones take up some memory
+        loaders = [] if args.no_m300 else [m300_dataset]
+        for spec in args.synthetic:
+            nfibrils, size = (int(value) for value in spec.split(":"))
+            loaders.append(lambda n=nfibrils, s=size: synthetic_dataset(n, s, os.path.join(tmp, "{}x{}".format(n, s)), args.seed))
+        for load in loaders:
+            data = load()
+            for name in args.cases:
+                record = dict(env, **run_case(name, data, args.repeat))
+                with open(args.output, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+                print("{} {}: {:.4f} s ({} fibrils, {} points)".format(
+                    data.name, name, record["best"], record["fibrils"], record["points"]), file=sys.stderr)
+            del data
+
+if __name__ == "__main__":
+    main()
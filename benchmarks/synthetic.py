@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Synthetic Fibrils
+@author: Parker Lamb
+@description: Synthetic fibril images for benchmarking, with a configurable number of fibrils and
+image size (up to 4096x4096 and beyond). Fibrils are circular arcs, with radii of curvature above
+the OCCULT-2 rmin, sampled at one pixel spacing. They are drawn as bright Gaussian ridges on a
+smooth, noisy background, and the coordinates drawn are kept as the ground truth. Intensity,
+velocity and width maps are made from the same fibrils, so the whole pipeline can be run.
+@usage: "python synthetic.py <output-directory> [--fibrils 500] [--size 1024] [--seed 0]"
+"""
+
+import argparse
+import os
+import sys
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "curve-tracing"))
+from coordinates import FibrilCoordinates
+
+# Names of the FITS maps written by write_maps, as read by FitsMaps.from_directory
+SUFFIX = "synthetic"
+MAP_NAMES = {
+    "intensity": "coreint",
+    "velocity": "vel",
+    "width": "width",
+}
+
+def synthetic_fibrils(nfibrils, shape, lengths=(40, 120), radii=(60, 400), seed=0):
+    """
+    Random circular arcs lying entirely within the image.
+
+    Parameters
+    ----------
+    nfibrils : int
+        Number of fibrils
+    shape : tuple
+        (rows, columns) of the image
+    lengths : tuple
+        Range of the fibril lengths, in pixels
+    radii : tuple
+        Range of the radii of curvature, in pixels
+    seed : int
+        Random seed, so the same arguments always give the same fibrils
+
+    Returns
+    -------
+    FibrilCoordinates
+        Fibrils with IDs from 2 (as in AutoTracing.save), at one pixel spacing
+    """
+    rng = np.random.default_rng(seed)
+    rows, cols = shape
+    length = rng.integers(lengths[0], lengths[1], nfibrils, endpoint=True)
+    radius = rng.uniform(radii[0], radii[1], nfibrils)
+    bend = rng.choice([-1.0, 1.0], nfibrils)
+    heading = rng.uniform(0, 2*np.pi, nfibrils)
+
+    # Arcs around the origin, then moved so each lies within the image
+    owner = np.repeat(np.arange(nfibrils), length)
+    s = np.arange(owner.size) - np.repeat(np.cumsum(length) - length, length)
+    angle = heading[owner] + bend[owner]*s/radius[owner]
+    x = radius[owner]*(np.sin(angle) - np.sin(heading[owner]))*bend[owner]
+    y = -radius[owner]*(np.cos(angle) - np.cos(heading[owner]))*bend[owner]
+
+    margin = 5
+    low_x = np.minimum.reduceat(x, np.cumsum(length) - length)
+    high_x = np.maximum.reduceat(x, np.cumsum(length) - length)
+    low_y = np.minimum.reduceat(y, np.cumsum(length) - length)
+    high_y = np.maximum.reduceat(y, np.cumsum(length) - length)
+    x0 = rng.uniform(margin - low_x, np.maximum(cols - 1 - margin - high_x, margin - low_x))
+    y0 = rng.uniform(margin - low_y, np.maximum(rows - 1 - margin - high_y, margin - low_y))
+    x += x0[owner]
+    y += y0[owner]
+    return FibrilCoordinates.from_arrays(owner + 2, x, y)
+
+def synthetic_image(fibrils, shape, sigma=1.5, contrast=1.0, noise=0.02, seed=0):
+    """
+    Draw fibrils as Gaussian ridges on a smooth background with noise.
+
+    Parameters
+    ----------
+    fibrils : FibrilCoordinates
+        Fibrils to draw, i.e. from synthetic_fibrils
+    shape : tuple
+        (rows, columns) of the image
+    sigma : float
+        Gaussian width of the fibrils, in pixels
+    contrast : float
+        Peak brightness of an isolated fibril above the background
+    noise : float
+        Standard deviation of the Gaussian noise
+    seed : int
+        Random seed of the background and noise
+
+    Returns
+    -------
+    numpy.ndarray
+        float32 image, roughly between 0 and 1 + contrast
+    """
+    rng = np.random.default_rng(seed)
+    image = np.zeros(shape, dtype=np.float32)
+    rows = np.clip(np.rint(fibrils.y).astype(np.int64), 0, shape[0] - 1)
+    cols = np.clip(np.rint(fibrils.x).astype(np.int64), 0, shape[1] - 1)
+    np.add.at(image, (rows, cols), 1.0)
+    # A line of unit impulses blurred by sigma peaks at about 1/(sqrt(2 pi) sigma)
+    image = gaussian_filter(image, sigma)*(contrast*np.sqrt(2*np.pi)*sigma)
+
+    # Large-scale background variation, from blurred coarse noise
+    coarse = rng.standard_normal((max(shape[0]//64, 2), max(shape[1]//64, 2))).astype(np.float32)
+    background = np.kron(coarse, np.ones((64, 64), dtype=np.float32))[:shape[0],:shape[1]]
+    background = np.pad(background, ((0, shape[0] - background.shape[0]), (0, shape[1] - background.shape[1])), mode='edge')
+    image += 0.5 + 0.1*gaussian_filter(background, 32)
+    image += rng.normal(0, noise, shape).astype(np.float32)
+    return image
+
+def synthetic_maps(fibrils, shape, seed=0):
+    """
+    Intensity, velocity and width maps of the same fibrils, in the value ranges of the m300
+    maps, as returned by load_maps.
+    """
+    image = synthetic_image(fibrils, shape, seed=seed)
+    rng = np.random.default_rng(seed + 1)
+    velocity = gaussian_filter(rng.standard_normal(shape).astype(np.float32), 8)*2.0 - 0.04
+    return {
+        "intensity": (0.1 + 0.05*image).astype(np.float32),
+        "velocity": velocity,
+        "width": (0.9 + 0.45*image/max(float(image.max()), 1e-6)).astype(np.float32),
+    }
+
+def write_fits(path, image):
+    """Write an image as a single-HDU FITS file."""
+    from astropy.io import fits
+    fits.PrimaryHDU(np.asarray(image, dtype=np.float32)).writeto(path, overwrite=True)
+
+def write_maps(directory, maps, suffix=SUFFIX):
+    """
+    Write maps as halpha_<name>_<suffix>.fits, readable by FitsMaps.from_directory.
+
+    Returns
+    -------
+    dict
+        {map name: path}
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for name, fits_name in MAP_NAMES.items():
+        paths[name] = os.path.join(directory, "halpha_{}_{}.fits".format(fits_name, suffix))
+        write_fits(paths[name], maps[name])
+    return paths
+
+def write_coordinates(path, fibrils):
+    """Write fibrils as a fibril ID, x, y .csv (as AutoTracing.save)."""
+    np.savetxt(path, np.column_stack((fibrils.point_ids, fibrils.x, fibrils.y)), delimiter=",", fmt=["%d", "%.4f", "%.4f"])
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic fibril maps and their coordinates.")
+    parser.add_argument('output_dir', help='directory to write the FITS maps and coordinates to')
+    parser.add_argument('--fibrils', type=int, default=500, help='number of fibrils (default: 500)')
+    parser.add_argument('--size', type=int, default=1024, help='image width and height, in pixels (default: 1024)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    args = parser.parse_args()
+
+    shape = (args.size, args.size)
+    fibrils = synthetic_fibrils(args.fibrils, shape, seed=args.seed)
+    paths = write_maps(args.output_dir, synthetic_maps(fibrils, shape, seed=args.seed))
+    coordinates = os.path.join(args.output_dir, "coordinates_{}.csv".format(SUFFIX))
+    write_coordinates(coordinates, fibrils)
+    print("{} fibrils ({} coordinates) on {}x{} maps:\n {}\n {}".format(
+        len(fibrils), fibrils.npoints, args.size, args.size, "\n ".join(paths.values()), coordinates))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Breadth Index
+@author: Parker Lamb
+@description: Breadth of fibril coordinates by lookup in precomputed distance-to-edge maps. The
+rounded perpendicular steps used by calculate_breadth() only point in 8 directions, so for each of
+them the number of non-edge pixels passed before hitting a Canny edge is computed once per frame,
+for every pixel, capped at a maximum radius. The breadth of any number of coordinates is then two
+array lookups, equal to the bp+bn of calculate_breadth() with max_steps set to the same radius.
+A Euclidean (direction-free) distance transform is also available, as a faster rough estimate.
+@usage: bp, bn, steps = calculate_breadth(x, y, lengths, edges, index=BreadthIndex(edges))
+"""
+
+import numpy as np
+
+# Default cap on the pixels counted on each side of a coordinate
+DEFAULT_MAX_RADIUS = 64
+
+# Ways of finding the breadth: stepping out over the edge map (calculate_breadth's default), or
+# looking up a BreadthIndex with per-direction maps or one Euclidean map
+BREADTH_METHODS = ("march", "directional", "euclidean")
+
+# The [row, column] steps a rounded unit perpendicular can take
+DIRECTIONS = tuple((dr, dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1) if dr or dc)
+
+def directional_distance(edges, step, max_radius=DEFAULT_MAX_RADIUS):
+    """
+    Number of non-edge pixels passed stepping from every pixel along step until an edge (or the
+    image border) is hit, as march_to_edges() counts them.
+
+    Parameters
+    ----------
+    edges : numpy.ndarray
+        Edge map, where non-zero pixels are edges (i.e. the output of cv2.Canny)
+    step : tuple
+        [row, column] step, each component in {-1, 0, 1}
+    max_radius : int
+        Counts are capped at this value
+
+    Returns
+    -------
+    numpy.ndarray
+        Count for every pixel, uint8 if max_radius fits, otherwise uint16
+    """
+    dtype = np.uint8 if max_radius <= np.iinfo(np.uint8).max else np.uint16
+    dr, dc = step
+    if dr == 0:
+        # Work along columns as rows of the transpose, so the recurrence below only needs row steps
+        return directional_distance(np.asarray(edges).T, (dc, dr), max_radius).T
+    open_ = (np.asarray(edges) == 0).astype(dtype)
+    distance = np.zeros(open_.shape, dtype=dtype)
+    nrows, ncols = open_.shape
+    # Columns of the previous row each column steps to, and that row's counts in them (0 past
+    # the left and right border)
+    if dc > 0:
+        source, target = slice(1, None), slice(None, -1)
+    elif dc < 0:
+        source, target = slice(None, -1), slice(1, None)
+    else:
+        source, target = slice(None), slice(None)
+    following = np.zeros(ncols, dtype=dtype)
+    # distance[r, c] = 0 on edges, otherwise 1 + distance[r + dr, c + dc], starting from the
+    # row past the border (all 0)
+    for row in (range(nrows - 1, -1, -1) if dr > 0 else range(nrows)):
+        if row != (nrows - 1 if dr > 0 else 0):
+            following[target] = distance[row + dr][source]
+        current = distance[row]
+        np.minimum(following, max_radius - 1, out=current)
+        current += 1
+        current *= open_[row]
+    return distance
+
+class BreadthIndex:
+    def __init__(self, edges, max_radius=DEFAULT_MAX_RADIUS, directional=True):
+        """
+        Distance-to-edge maps of one frame, for looking up the breadth of fibril coordinates.
+
+        Parameters
+        ----------
+        edges : numpy.ndarray
+            Canny edge map, indexed [y,x] (see edge_map)
+        max_radius : int
+            Maximum pixels counted on each side of a coordinate, so no lookup searches further
+        directional : bool
+            Precompute a map per perpendicular direction (8 maps, exact). Otherwise a single
+            Euclidean distance transform is used, and each side gets the distance to the
+            nearest edge in any direction.
+        """
+        self.shape = edges.shape
+        self.max_radius = int(max_radius)
+        self.directional = directional
+        if directional:
+            self.distances = {step: directional_distance(edges, step, self.max_radius) for step in DIRECTIONS}
+        else:
+            import cv2
+
+            # Edges are the zeros of the transform's input. Distances are to the nearest edge
+            # pixel centre, so a pixel next to an edge is 1, as when marching.
+            distance = cv2.distanceTransform((edges == 0).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+            self.distances = {None: np.minimum(np.floor(distance), self.max_radius).astype(np.uint16)}
+
+    @property
+    def nbytes(self):
+        return sum(distance.nbytes for distance in self.distances.values())
+
+    def lookup(self, start, steps):
+        """
+        Count for each start pixel along its step. With a directional index, this is what
+        march_to_edges(start, steps, edges, max_radius) gives.
+
+        Parameters
+        ----------
+        start : numpy.ndarray
+            (n, 2) integer array of [row, column] starting pixels
+        steps : numpy.ndarray
+            (n, 2) integer array of [row, column] steps, each component in {-1, 0, 1}
+
+        Returns
+        -------
+        numpy.ndarray
+            Number of non-edge pixels passed. Starts outside the image and zero steps give 0.
+        """
+        start = np.asarray(start, dtype=np.int64).reshape(-1, 2)
+        steps = np.asarray(steps, dtype=np.int64).reshape(-1, 2)
+        counts = np.zeros(len(start), dtype=np.int64)
+        rows, cols = start[:,0], start[:,1]
+        valid = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1]) & np.any(steps != 0, axis=1)
+        if not self.directional:
+            counts[valid] = self.distances[None][rows[valid], cols[valid]]
+            return counts
+        # Codes 0-8 of the [row, column] steps, (dr + 1)*3 + (dc + 1)
+        code = (steps[:,0] + 1)*3 + (steps[:,1] + 1)
+        for step, distance in self.distances.items():
+            select = valid & (code == (step[0] + 1)*3 + (step[1] + 1))
+            counts[select] = distance[rows[select], cols[select]]
+        return counts
+
+def agreement(reference, estimate):
+    """
+    Compare breadths of the same coordinates, i.e. the bp+bn of calculate_breadth() with those of
+    a BreadthIndex (see calculate_breadth).
+
+    Parameters
+    ----------
+    reference : numpy.ndarray
+        Breadth of each coordinate from calculate_breadth()
+    estimate : numpy.ndarray
+        Breadth of each coordinate using a BreadthIndex
+
+    Returns
+    -------
+    dict
+        Number of points, fraction with equal breadth and within 1 pixel, mean and maximum
+        absolute difference, and the mean difference (estimate - reference)
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    difference = np.asarray(estimate, dtype=np.float64) - reference
+    if reference.size == 0:
+        return {"points": 0, "equal": np.nan, "within_1": np.nan, "mean_abs": np.nan, "max_abs": np.nan, "bias": np.nan}
+    return {
+        "points": int(reference.size),
+        "equal": float(np.mean(difference == 0)),
+        "within_1": float(np.mean(np.abs(difference) <= 1)),
+        "mean_abs": float(np.mean(np.abs(difference))),
+        "max_abs": float(np.max(np.abs(difference))),
+        "bias": float(np.mean(difference)),
+    }
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Map Cache
+@author: Parker Lamb
+@description: On-disk cache for maps derived from an input map, such as the sharpened width map
+and Canny edge map of characterization.py. Entries are named by a hash of the input map and the
+parameters used, so a changed map or parameter is a miss rather than a stale hit. The least
+recently used entries are removed once the cache grows past its size limit.
+@usage: cache = MapCache("~/.cache/fibrils"); edges = edge_map(width_map, cache=cache)
+"""
+
+import hashlib
+import json
+import os
+import numpy as np
+
+# Default size limit of a cache directory, in bytes
+DEFAULT_MAX_BYTES = 512*1024*1024
+
+class MapCache:
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Cache of arrays stored as .npy files in a directory. Safe to share between processes:
+        entries are written under a temporary name and moved into place.
+
+        Parameters
+        ----------
+        directory : str
+            Directory holding the cache, created if needed
+        max_bytes : int
+            Total size of the entries to keep
+        """
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def digest(image):
+        """
+        Hash of an array's shape, type and contents.
+        """
+        image = np.ascontiguousarray(image)
+        h = hashlib.blake2b(digest_size=16)
+        h.update("{}{}".format(image.shape, image.dtype.str).encode())
+        h.update(image.view(np.uint8).reshape(-1) if image.size else b"")
+        return h.hexdigest()
+
+    def key(self, kind, digest, params):
+        """
+        Name of the entry for one kind of derived map, of the input map with the given digest,
+        made with the given (JSON serializable) parameters.
+        """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(json.dumps([kind, digest, params], sort_keys=True).encode())
+        return "{}-{}".format(kind, h.hexdigest())
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, key):
+        """
+        Load an entry, marking it as recently used. Returns None if it isn't cached.
+        """
+        path = self.path(key)
+        try:
+            result = np.load(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            # Missing, or removed or replaced by another process while we read it
+            return None
+        return result
+
+    def put(self, key, array):
+        """
+        Store an entry, then evict old entries if the cache is over its size limit.
+        """
+        path = self.path(key)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def cached(self, kind, digest, params, compute):
+        """
+        Get an entry, computing and storing it with compute() if it isn't cached.
+        """
+        key = self.key(kind, digest, params)
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
+
+    def entries(self):
+        """
+        (modification time, size, path) of every entry, least recently used first.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npy"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def size(self):
+        """Total size of the entries, in bytes."""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove every entry."""
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -5,36 +5,507 @@ Created on Fri 12.31.21
 @title: Characterization
 @author: Parker Lamb
 @description: Script used to characterize OCCULT-2 identified fibrils, including core intensity,
-breadth and velocity values for each coordinate point on each fibril. 
-@usage: "python characterization.py <occult-coordinates-file> <Ha.sav file>"
+breadth and velocity values for each coordinate point on each fibril. The individual stages 
+(loading, sampling, edge detection, breadth and writing) can also be imported and used headless, 
+i.e. characterize(load_coordinates(path), load_maps(sav_path)).
+@usage: "python characterization.py <occult-coordinates-file> <Ha.sav file> <output-file>"
 """
 
 import argparse
-from audioop import avg
-from contextlib import suppress
+import os
 import sys
 import numpy as np
 import csv
-import cv2
-from scipy.__config__ import show
-from scipy.io import readsav
-from matplotlib import pyplot as plt
-from collections import OrderedDict
 from os.path import exists
+# cv2, scipy.io (via sav_arrays) and matplotlib are imported where they're used, so short-lived processes that
+# don't need them (i.e. batch jobs only reading coordinates) start quickly
+
+# Coordinate handling is shared with the tracing code
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "curve-tracing"))
+from coordinates import FibrilCoordinates, read_coordinates
+from fibril_store import is_store_path, open_store, write_store
+from sampling import INTERPOLATIONS, OUTSIDE, sample_maps
+from geometry import FibrilGeometry, tangents
+from sav_arrays import read_sav
+from breadth_index import BREADTH_METHODS, BreadthIndex, DEFAULT_MAX_RADIUS, agreement
+from cache import DEFAULT_MAX_BYTES, MapCache
+from stats import Statistics
+from profiling import PROFILER, stage
+
+# Structure of the characterization output, one row per coordinate
+CHARACTERISTICS_DTYPE = np.dtype([
+    ('fibril_id', np.int64),
+    ('x', np.float64),
+    ('y', np.float64),
+    ('intensity', np.float64),
+    ('velocity', np.float64),
+    ('width', np.float64),
+    ('breadth', np.float64),
+])
+
+# Edge detection parameters: the width map is scaled to 8 bits, sharpened with an unsharp mask
+# of this amount, blurred with a blur_size kernel, then passed to cv2.Canny
+EDGE_PARAMETERS = {
+    "scale": 325,
+    "amount": 10.0,
+    "blur_size": 5,
+    "blur_sigma": 8.0,
+    "threshold1": 260,
+    "threshold2": 280,
+    "aperture": 7,
+}
+
+# The parameters used before Canny, in sharpen()
+SHARPEN_PARAMETERS = ("scale", "amount", "blur_size", "blur_sigma")
+
+def load_maps(sav_file):
+    """
+    Read the Halpha maps out of an IDL .sav file.
+
+    Parameters
+    ----------
+    sav_file : str
+        Path to the .sav file containing halpha_coreint, halpha_vel and halpha_width
+
+    Returns
+    -------
+    dict
+        Maps keyed by the characteristic they provide: "intensity", "velocity" and "width". 
+        Numpy array indices are [y,x].
+    """
+    with stage("load_maps"):
+        # Memory-mapped from the file's conversion (see sav_arrays.py), if it has one
+        sav = read_sav(sav_file, ("halpha_coreint", "halpha_vel", "halpha_width"))
+        return {
+            "intensity": sav['halpha_coreint'],
+            "velocity": sav['halpha_vel'],
+            "width": sav['halpha_width'],
+        }
+
+def load_coordinates(coordinate_file):
+    """
+    Read an OCCULT-2 coordinates file (or any comma or whitespace separated file with fibril ID, 
+    x and y as the first three columns), or a fibril store.
+
+    Parameters
+    ----------
+    coordinate_file : str
+        Path to the coordinates file or fibril store
+
+    Returns
+    -------
+    FibrilCoordinates
+        Coordinates grouped by fibril, in order of first appearance
+    """
+    with stage("load_coordinates") as record:
+        if is_store_path(coordinate_file):
+            with open_store(coordinate_file) as store:
+                coords = store.coordinates()
+        else:
+            coords = read_coordinates(coordinate_file)
+        record.add(fibrils=len(coords), points=coords.npoints)
+    return coords
+
+def fibril_geometry(coords):
+    """Geometry of every fibril, computed in one pass (see geometry.py)."""
+    with stage("geometry", fibrils=len(coords), points=coords.npoints):
+        return FibrilGeometry(coords)
+
+def fibril_lengths(fibril_ids):
+    """
+    Get the number of coordinates in each run of equal fibril IDs.
+    """
+    fibril_ids = np.asarray(fibril_ids)
+    if fibril_ids.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    bounds = np.flatnonzero(np.diff(fibril_ids)) + 1
+    return np.diff(np.concatenate(([0], bounds, [fibril_ids.size])))
+
+def unsharp_mask(image, kernel_size=(5, 5), sigma=1.0, amount=1.0, threshold=0):
+    """Return a sharpened version of the image, using an unsharp mask."""
+    import cv2
+
+    # From https://codingdeekshi.com/python-3-opencv-script-to-smoothen-or-sharpen-input-image-using-numpy-library/
+    blurred = cv2.GaussianBlur(image, kernel_size, sigma)
+    sharpened = float(amount + 1) * image - float(amount) * blurred
+    sharpened = np.maximum(sharpened, np.zeros(sharpened.shape))
+    sharpened = np.minimum(sharpened, 255 * np.ones(sharpened.shape))
+    sharpened = sharpened.round().astype(np.uint8)
+    if threshold > 0:
+        low_contrast_mask = np.absolute(image - blurred) < threshold
+        np.copyto(sharpened, image, where=low_contrast_mask)
+    return sharpened
+
+def sharpen(width_map, params=None):
+    """
+    Sharpen the width map with an unsharp mask, then blur it slightly to get rid of noise.
+
+    Parameters
+    ----------
+    width_map : numpy.ndarray
+        Halpha width map
+    params : dict
+        Any of the "scale", "amount", "blur_size" and "blur_sigma" values of EDGE_PARAMETERS to
+        override
+
+    Returns
+    -------
+    numpy.ndarray
+        uint8 sharpened and blurred map
+    """
+    import cv2
+
+    params = dict(EDGE_PARAMETERS, **(params or {}))
+    width_map_cv2 = width_map*params["scale"]
+    width_map_cv2 = width_map_cv2.astype(np.uint8)
+
+    wm_sharp = unsharp_mask(width_map_cv2, amount=params["amount"])
+    return cv2.GaussianBlur(wm_sharp, (params["blur_size"],)*2, params["blur_sigma"])
+
+def edge_map(width_map, params=None, cache=None):
+    """
+    Identify fibril edges in the width map. 
+
+    This technique will sharpen the image, slightly smooth out noise, then run cv2.Canny
+    on the result to identify edges.
+
+    Parameters
+    ----------
+    width_map : numpy.ndarray
+        Halpha width map
+    params : dict
+        Values of EDGE_PARAMETERS to override
+    cache : MapCache
+        If given, the sharpened and edge maps are looked up in (or added to) this cache, keyed
+        by the contents of width_map and the parameters (see cache.py)
+
+    Returns
+    -------
+    numpy.ndarray
+        uint8 edge map, where edges are non-zero
+    """
+    import cv2
+
+    params = dict(EDGE_PARAMETERS, **(params or {}))
+    sharpen_params = {name: params[name] for name in SHARPEN_PARAMETERS}
+
+    with stage("edge_map", pixels=np.size(width_map)):
+        if cache is None:
+            wm_sharp_gauss = sharpen(width_map, sharpen_params)
+            return cv2.Canny(wm_sharp_gauss, params["threshold1"], params["threshold2"], apertureSize=params["aperture"])
+
+        digest = cache.digest(width_map)
+        def edges():
+            wm_sharp_gauss = cache.cached("sharpened", digest, sharpen_params, lambda: sharpen(width_map, sharpen_params))
+            return cv2.Canny(wm_sharp_gauss, params["threshold1"], params["threshold2"], apertureSize=params["aperture"])
+        return cache.cached("edges", digest, params, edges)
+
+def perpendicular_steps(x, y, lengths, normals=None):
+    """
+    Get the rounded unit step perpendicular to each fibril at every coordinate. 
+
+    The tangent at a coordinate is taken between its previous and next neighbours in the 
+    same fibril (clamped at the fibril ends), exactly as the original per-coordinate loop did.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Flat array of x coordinates for all fibrils, fibril after fibril
+    y : numpy.ndarray
+        Flat array of y coordinates, same layout as x
+    lengths : numpy.ndarray
+        Number of coordinates in each fibril, in the order they appear in x and y
+    normals : numpy.ndarray
+        (n, 2) unit [x, y] normals of the coordinates, i.e. FibrilGeometry.normal. Computed with
+        geometry.tangents if not supplied.
+
+    Returns
+    -------
+    numpy.ndarray
+        (n, 2) integer array of [row, column] steps, each component in {-1, 0, 1}. Coordinates
+        without a defined tangent (e.g. single-point fibrils) get a [0, 0] step.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    n = x.size
+    if n == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    if normals is None:
+        _, normals = tangents(x, y, lengths)
+
+    # The original loop looked up each coordinate by value, so repeated coordinates in a
+    # fibril all take the neighbours of their first occurrence.
+    fibril = np.repeat(np.arange(lengths.size), lengths)
+    index = np.arange(n)
+    order = np.lexsort((index, y, x, fibril))
+    new_group = np.ones(n, dtype=bool)
+    new_group[1:] = (np.diff(fibril[order]) != 0) | (np.diff(x[order]) != 0) | (np.diff(y[order]) != 0)
+    group_start = np.maximum.accumulate(np.where(new_group, np.arange(n), 0))
+    position = np.empty(n, dtype=np.int64)
+    position[order] = index[order][group_start]
+
+    # The [x, y] normal [ty, -tx], reversed, is the [row, column] step [-tx, ty]
+    return np.rint(normals[position,::-1]).astype(np.int64)
+
+def march_to_edges(start, steps, edges, max_steps=None):
+    """
+    Step every start pixel along its direction at once, until a non-zero pixel in edges is hit.
+
+    Parameters
+    ----------
+    start : numpy.ndarray
+        (n, 2) integer array of [row, column] starting pixels
+    steps : numpy.ndarray
+        (n, 2) integer array of [row, column] steps
+    edges : numpy.ndarray
+        Edge map, where non-zero pixels are edges (i.e. the output of cv2.Canny)
+    max_steps : int
+        Maximum number of steps to take per ray. Defaults to the largest image dimension.
+
+    Returns
+    -------
+    numpy.ndarray
+        Number of non-edge pixels passed before hitting an edge. Rays leaving the image stop
+        at the image border, and rays with a zero step stop immediately.
+    """
+    if max_steps is None:
+        max_steps = max(edges.shape)
+    pos = np.array(start, dtype=np.int64, copy=True).reshape(-1, 2)
+    steps = np.asarray(steps, dtype=np.int64).reshape(-1, 2)
+    counts = np.zeros(len(pos), dtype=np.int64)
+
+    # Indices of the rays that are still moving
+    active = np.flatnonzero(np.any(steps != 0, axis=1))
+    for _ in range(max_steps):
+        if active.size == 0:
+            break
+        rows = pos[active,0]
+        cols = pos[active,1]
+        inside = (rows >= 0) & (rows < edges.shape[0]) & (cols >= 0) & (cols < edges.shape[1])
+        active = active[inside]
+        active = active[edges[rows[inside],cols[inside]] == 0]
+        counts[active] += 1
+        pos[active] += steps[active]
+    return counts
+
+def calculate_breadth(x, y, lengths, edges, max_steps=None, index=None, normals=None):
+    """
+    Calculate the breadth of every fibril coordinate in one batch. 
+
+    For each coordinate, we step out along the rounded perpendicular in both directions until
+    we hit a Canny-identified edge, and count the pixels passed on either side. With an index,
+    the counts are looked up in its precomputed distance maps instead (see breadth_index.py).
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Flat array of x coordinates for all fibrils
+    y : numpy.ndarray
+        Flat array of y coordinates for all fibrils
+    lengths : numpy.ndarray
+        Number of coordinates in each fibril
+    edges : numpy.ndarray
+        Canny edge map, indexed [y,x]
+    max_steps : int
+        Maximum number of pixels to step on each side (see march_to_edges)
+    index : BreadthIndex
+        Distance maps of edges to look the counts up in. Its max_radius takes the place of
+        max_steps.
+    normals : numpy.ndarray
+        Precomputed normals of the coordinates (see perpendicular_steps)
+
+    Returns
+    -------
+    tuple
+        (bp, bn, steps), the pixel counts in the positive and negative perpendicular direction
+        and the [row, column] perpendicular steps. The breadth is bp+bn. 
+    """
+    steps = perpendicular_steps(x, y, lengths, normals)
+    start = np.stack((np.rint(y), np.rint(x)), axis=1).astype(np.int64)
+    if index is not None:
+        return index.lookup(start, steps), index.lookup(start, -steps), steps
+    bp = march_to_edges(start, steps, edges, max_steps)
+    bn = march_to_edges(start, -steps, edges, max_steps)
+    return bp, bn, steps
+
+def characterize(coords, maps, edges=None, interpolation="bilinear", outside="nan", breadth="march", max_radius=None,
+                 index=None, geometry=None):
+    """
+    Characterize every coordinate of every fibril. No files are read or written, and nothing
+    is displayed.
+
+    Parameters
+    ----------
+    coords : FibrilCoordinates
+        Fibril coordinates, as returned by load_coordinates. An (n, 3) array of [fibril_id, x, y]
+        is also accepted.
+    maps : dict
+        "intensity", "velocity" and "width" maps, as returned by load_maps
+    edges : numpy.ndarray
+        Precomputed edge map of maps["width"]. Computed with edge_map if not supplied. 
+    interpolation : str
+        How map values are read at the sub-pixel coordinates: "bilinear", "bicubic", "nearest",
+        or "truncate" to take the pixel a coordinate falls in (see sampling.py)
+    outside : str
+        Map values of coordinates outside the maps: "nan", "clip" to the edge, or "raise"
+    breadth : str
+        "march" to step out over the edge map from each coordinate, or "directional" or
+        "euclidean" to look the breadth up in a BreadthIndex of the edges (see breadth_index.py)
+    max_radius : int
+        Maximum pixels counted on each side of a coordinate. Unbounded by default when
+        marching, DEFAULT_MAX_RADIUS for a BreadthIndex.
+    index : BreadthIndex
+        Prebuilt index of edges to look the breadth up in, i.e. kept between calls on the same
+        frame. breadth and max_radius are then ignored.
+    geometry : FibrilGeometry
+        Geometry of coords, whose normals are reused for the breadth (see geometry.py)
+
+    Returns
+    -------
+    numpy.ndarray
+        Structured array of CHARACTERISTICS_DTYPE, one row per coordinate
+    """
+    if not isinstance(coords, FibrilCoordinates):
+        coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+        coords = FibrilCoordinates.from_arrays(coords[:,0], coords[:,1], coords[:,2])
+    if edges is None:
+        edges = edge_map(maps["width"])
+
+    table = np.empty(coords.npoints, dtype=CHARACTERISTICS_DTYPE)
+    table['fibril_id'] = coords.point_ids
+    table['x'] = coords.x
+    table['y'] = coords.y
+    with stage("sample_maps", points=coords.npoints):
+        for name, values in sample_maps(maps, coords.x, coords.y, interpolation, outside).items():
+            table[name] = values
+
+    # TODO compare with previous coordinate width. If significantly larger, (i.e. 4 -> 12), set to previous
+    # coordinate width, as it's implied there is a error width here. 
+    if index is None and breadth != "march":
+        with stage("breadth_index", pixels=np.size(edges)):
+            index = BreadthIndex(edges, max_radius or DEFAULT_MAX_RADIUS, directional=(breadth == "directional"))
+    with stage("breadth", fibrils=len(coords), points=coords.npoints):
+        bp, bn, _ = calculate_breadth(coords.x, coords.y, coords.lengths, edges, max_radius, index,
+                                      geometry.normal if geometry is not None else None)
+    table['breadth'] = bp+bn
+    return table
+
+def write_characteristics(output_file, table):
+    """
+    Write characterization results to a .csv file, or to a binary fibril store if output_file
+    ends in .fibrils or .npz (see fibril_store.py).
+
+    Parameters
+    ----------
+    output_file : str
+        Path of the .csv file or store to write
+    table : numpy.ndarray
+        Structured array returned by characterize()
+    """
+    with stage("write_characteristics", points=len(table)):
+        if is_store_path(output_file):
+            write_store(output_file, table)
+            return
+        with open(output_file, "w", newline='') as outfile:
+            writer = csv.writer(outfile)
+            # fibril_id, x, y, intensity, velocity, width (from width_map), calculated breadth
+            writer.writerows(table.tolist())
+
+def geometry_paths(output_file):
+    """
+    Files the geometry of characterized fibrils is written to, next to the output file:
+    <name>-geometry<ext> per coordinate (.csv or store, like the output) and
+    <name>-fibril-geometry.csv per fibril.
+    """
+    name, ext = os.path.splitext(str(output_file).rstrip("/"))
+    return name + "-geometry" + ext, name + "-fibril-geometry.csv"
+
+def write_geometry(output_file, geometry):
+    """
+    Write the geometry of characterized fibrils next to the output file (see geometry_paths).
+
+    Parameters
+    ----------
+    output_file : str
+        Path of the characteristics .csv file or store
+    geometry : FibrilGeometry
+        Geometry of the characterized coordinates
+    """
+    points_file, fibrils_file = geometry_paths(output_file)
+    with stage("write_geometry", fibrils=len(geometry), points=geometry.x.size):
+        points = geometry.points()
+        if is_store_path(points_file):
+            write_store(points_file, points)
+        else:
+            with open(points_file, "w", newline='') as outfile:
+                # fibril_id, x, y, arc length, tangent x/y, normal x/y, curvature
+                csv.writer(outfile).writerows(points.tolist())
+        fibrils = geometry.fibrils()
+        with open(fibrils_file, "w", newline='') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(fibrils.dtype.names)
+            writer.writerows(fibrils.tolist())
+
+def summarize(table):
+    """
+    Get the fibril count and average characteristics over all coordinates.
+
+    Parameters
+    ----------
+    table : numpy.ndarray
+        Structured array returned by characterize()
+
+    Returns
+    -------
+    dict
+        Fibril count and average intensity, velocity, width and breadth. Map values of
+        coordinates outside the maps (NaN) are left out of the averages. See stats.py for
+        percentiles, histograms and per-fibril statistics.
+    """
+    return Statistics().update(table).summary()
+
+def show_width_calculations(table, width_map, edges, breadth="march", max_radius=None):
+    """
+    Display the Canny edges, fibrils and every second width segment of each fibril, blocking
+    until the window is closed. breadth and max_radius are those given to characterize(). See
+    plotting.py to write the figure to a file instead.
+    """
+    from matplotlib import pyplot as plt
+    from plotting import width_figure
+
+    width_figure(table, width_map, edges, plt.figure(), breadth, max_radius)
+    plt.show()
 
 def manual_execution():
     # Modify numpy print options
     np.set_printoptions(suppress=True)
 
-    # Disable if you don't want to visualize width calculations
-    show_width_calculations = True
-
     # Parse command line arguments
     parser = argparse.ArgumentParser(description="Characterize fibrils on a coordinate-by-coordinate basis. ")
     parser.add_argument('coordinate_file', help='OCCULT-2 coordinates file')
     parser.add_argument('sav_file', help='ha sav file')
-    parser.add_argument('output_file', help='where to store characteristic info')
+    parser.add_argument('output_file', help='where to store characteristic info (.csv, or .fibrils/.npz for a binary store)')
+    parser.add_argument('--interpolation', default="bilinear", choices=INTERPOLATIONS, help='how maps are sampled at sub-pixel coordinates (default: bilinear)')
+    parser.add_argument('--outside', default="nan", choices=OUTSIDE, help='map values for coordinates outside the maps (default: nan)')
+    parser.add_argument('--breadth', default="march", choices=BREADTH_METHODS, help='how breadth is found: march out from each coordinate (default), or look it up in precomputed directional or euclidean distance-to-edge maps')
+    parser.add_argument('--max-radius', type=int, default=None, help='maximum pixels counted on each side of a coordinate (default: unbounded when marching, {} otherwise)'.format(DEFAULT_MAX_RADIUS))
+    parser.add_argument('--check-breadth', action='store_true', help='compare the breadth with unbounded marching and print the agreement')
+    parser.add_argument('--geometry', action='store_true', help='also write the length, curvature, orientation and bounding box of each fibril, and the arc length, tangent, normal and curvature of each coordinate, next to the output')
+    parser.add_argument('--plot', nargs='+', default=[], metavar='FILE', help='write the width calculations figure to these .png/.svg files, in the background')
+    parser.add_argument('--show', action='store_true', help='display the width calculations figure when done')
+    parser.add_argument('--cache-dir', default=None, help='directory to cache edge maps in, reused between runs on the same frame (not with --service, which uses its own)')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_BYTES//2**20, help='size limit of the cache directory, in MB')
+    parser.add_argument('--profile', default=None, metavar='FILE', help='time each stage and write a JSON report to FILE')
+    parser.add_argument('--service', nargs='?', default=None, const="http://127.0.0.1:8765", metavar='URL',
+                        help='characterize with a running service.py, which keeps the frame in memory (default URL: http://127.0.0.1:8765)')
     args = parser.parse_args()
+    if args.service and (args.plot or args.show or args.check_breadth):
+        parser.error("--plot, --show and --check-breadth need the maps, and can't be used with --service")
+    if args.service and args.cache_dir:
+        parser.error("--cache-dir can't be used with --service, which uses the cache given to service.py")
+    if args.profile:
+        PROFILER.enable()
 
     # Test validity of command line arguments
     if not exists(args.coordinate_file):
@@ -42,195 +513,58 @@ def manual_execution():
     if not exists(args.sav_file):
         sys.exit("Save file not found")
 
-    # Read in the sav file
-    sav = readsav(args.sav_file)
-    core_map = sav['halpha_coreint']
-    width_map = sav['halpha_width']
-    vel_map = sav['halpha_vel']
-
-    # Numpy array indices are [y,x]. No further transformations necessary.
-
-    # Convert OCCULT-2 coordinates file to an OrderedDict
-    coords = OrderedDict()
-    with open(args.coordinate_file, newline='') as csvfile:
-        for line in csvfile.readlines():
-            line = ' '.join(line.split())
-            line = line.split(" ")
-            num = int(float(line[0]))
-            x = float(line[1])
-            y = float(line[2])
+    if args.service:
+        # The service reads the maps (once) and makes the edge map (using its own cache)
+        from service import characterize_remote
+
+        coords = load_coordinates(args.coordinate_file)
+        geometry = fibril_geometry(coords) if args.geometry else None
+        with stage("service", fibrils=len(coords), points=coords.npoints):
             try:
-                coords[num]
-            except KeyError:
-                coords[num] = np.array([])
-            if np.size(coords[num]) == 0:
-                coords[num] = np.array([[x,y]])
-            else:
-                coords[num] = np.append(coords[num], [np.array([x,y])], axis=0)
-            # Structure of coords is: {fibril_id: np.array([x,y],[x,y], ...)}
-
-    # Get intensity and velocity on a per-coordinate basis
-    for key in coords.keys():
-        coord_info = []
-        for coordpair in coords[key]:
-            x = int(coordpair[0])
-            y = int(coordpair[1])
-            intensity = core_map[y,x]
-            velocity = vel_map[y,x]
-            width = width_map[y,x]
-            coord_info.append([coordpair[0],coordpair[1],intensity,velocity,width])
-        coords[key] = np.array(coord_info)
-
-    # Getting the breadth of each fibril. 
-    ## This technique will sharpen the image, slightly smooth out noise, then run cv2.Canny
-    ## on the result to identify edges.
-
-    def unsharp_mask(image, kernel_size=(5, 5), sigma=1.0, amount=1.0, threshold=0):
-        """Return a sharpened version of the image, using an unsharp mask."""
-        # From https://codingdeekshi.com/python-3-opencv-script-to-smoothen-or-sharpen-input-image-using-numpy-library/
-        blurred = cv2.GaussianBlur(image, kernel_size, sigma)
-        sharpened = float(amount + 1) * image - float(amount) * blurred
-        sharpened = np.maximum(sharpened, np.zeros(sharpened.shape))
-        sharpened = np.minimum(sharpened, 255 * np.ones(sharpened.shape))
-        sharpened = sharpened.round().astype(np.uint8)
-        if threshold > 0:
-            low_contrast_mask = np.absolute(image - blurred) < threshold
-            np.copyto(sharpened, image, where=low_contrast_mask)
-        return sharpened
-
-    width_map_cv2 = width_map*325
-    width_map_cv2 = width_map_cv2.astype(np.uint8)
+                table = characterize_remote(coords, args.sav_file, args.service, args.interpolation, args.outside,
+                                            args.breadth, args.max_radius)
+            except (OSError, RuntimeError) as e:
+                sys.exit("Characterization service at {} failed: {}".format(args.service, e))
+    else:
+        maps = load_maps(args.sav_file)
+        coords = load_coordinates(args.coordinate_file)
+        geometry = fibril_geometry(coords) if args.geometry else None
+        cache = MapCache(args.cache_dir, args.cache_size*2**20) if args.cache_dir else None
+        edges = edge_map(maps["width"], cache=cache)
+        table = characterize(coords, maps, edges, args.interpolation, args.outside, args.breadth, args.max_radius,
+                             geometry=geometry)
+    if args.check_breadth:
+        bp, bn, _ = calculate_breadth(coords.x, coords.y, coords.lengths, edges)
+        check = agreement(bp+bn, table['breadth'])
+        print("Breadth agreement with marching: {:.2%} equal, {:.2%} within 1 px, mean difference {:.3f} px (max {:.0f} px)".format(
+            check["equal"], check["within_1"], check["mean_abs"], check["max_abs"]))
 
-    # Create a sharpened image, then blur it a bit to get rid of noise
-    wm_sharp = unsharp_mask(width_map_cv2, amount=10.0)
-    wm_sharp_gauss = cv2.GaussianBlur(wm_sharp, (5,5), 8.0)
-
-    edges = cv2.Canny(wm_sharp_gauss, threshold1=260, threshold2=280, apertureSize=7)
-
-    # Test if Canny boundaries match OCCULT-identified fibrils
-    # overlay = cv2.addWeighted(width_map_cv2, 0.7, edges, 0.4,0)
-    # fig, ax = plt.subplots()
-    # plt.imshow(overlay, origin='lower')
-    # for key in coords.keys():
-    #     x = coords[key][:,0]
-    #     y = coords[key][:,1]
-    #     plt.plot(x,y,markersize=1,linewidth=1, color='#ff0000')
-    # plt.show()
-
-    # REMOVE Set up test --
-    overlay = cv2.addWeighted(width_map_cv2, 0.7, edges, 0.4,0)
-    plt.imshow(overlay, origin='lower')
-    for key in coords.keys():
-        x = coords[key][:,0]
-        y = coords[key][:,1]
-        plt.plot(x,y,markersize=1,linewidth=1, color='#ff0000')
-    # --
-
-    # Calculate breadth of fibril
-    keys = list(coords)
-    for key in coords.keys():
-        # Get a list of all coordinates in the fibril
-        coordinfo = list(coords[key])
-        coordinfo_new = list()
-        # Counter to display every nth width segment
-        wctr = 0
-        for coord in coordinfo:
-            wctr +=1
-            # Get next and previous coordinates
-            nextcoord = next((i for i, val in enumerate(coordinfo) if np.all(val == coord)), -1)+1
-            prevcoord = next((i for i, val in enumerate(coordinfo) if np.all(val == coord)), -1)-1
-            if nextcoord > len(coordinfo)-1:
-                nextcoord = len(coordinfo)-1
-            if prevcoord < 0:
-                prevcoord = 0
-            nextcoord = coordinfo[nextcoord]
-            prevcoord = coordinfo[prevcoord]
-            # Calculate the slope at the coordinate
-            dx = nextcoord[1]-prevcoord[1]
-            dy = nextcoord[0]-prevcoord[0]
-            v = np.array([dx,dy])
-            # Get perpendicular vector
-            dp = np.empty_like(v)
-            dp[0] = -v[1]
-            dp[1] = v[0]
-            # Convert to unit vector
-            mag = np.sqrt(dp[0]**2+dp[1]**2)
-            dp[0] = dp[0]/mag
-            dp[1] = dp[1]/mag
-            # Array indices must be integers, rounding
-            dp[0] = round(dp[0])
-            dp[1] = round(dp[1])
-            # Variables to store x and y displacement vectors for width visualization
-            xs = []
-            ys = []
-            # Move in positive dp until we hit a Canny-identified edge
-            bp= 0
-            coord_offset = np.array([round(coord[1]),round(coord[0])])
-            while edges[coord_offset[0],coord_offset[1]] == 0:
-                bp+=1
-                xs.append(coord_offset[0])
-                ys.append(coord_offset[1])
-                coord_offset[0] = coord_offset[0]+dp[0]
-                coord_offset[1] = coord_offset[1]+dp[1]
-            # Move in negative dp until we hit a Canny-identified edge
-            bn = 0
-            coord_offset = np.array([round(coord[1]),round(coord[0])])
-            while edges[coord_offset[0],coord_offset[1]] == 0:
-                bn+=1
-                xs.append(coord_offset[0])
-                ys.append(coord_offset[1])
-                coord_offset[0] = coord_offset[0]-dp[0]
-                coord_offset[1] = coord_offset[1]-dp[1]
-            if (wctr % 2) == 0 and show_width_calculations:
-                plt.plot(ys,xs,markersize=1,linewidth=1, color='#a09516')
-            # Add width to coord characteristics
-            coord = np.append(coord,np.array([bp+bn]))
-            coordinfo_new.append([coord[0],coord[1],coord[2],coord[3],coord[4],coord[5]])
-            # TODO compare with previous coordinate width. If significantly larger, (i.e. 4 -> 12), set to previous
-            # coordinate width, as it's implied there is a error width here. 
-        coords[key] = np.array(coordinfo_new)
-    if show_width_calculations:
-        plt.title("Estimate of per-pixel width of chromospheric fibrils")
-        plt.xlabel("Pixel positon")
-        plt.ylabel("Pixel position")
-        plt.show()
-
-    # Write to CSV
-    with open(args.output_file, "w", newline='') as outfile:
-        writer = csv.writer(outfile)
-        for key in coords.keys():
-            for coord in coords[key]:
-                # fibril_id, x, y, intensity, velocity, width (from width_map), calculated breadth
-                writer.writerow([key,coord[0],coord[1],coord[2],coord[3],coord[4],coord[5]])
+    renderer = None
+    if args.plot:
+        from plotting import Renderer
+        renderer = Renderer()
+        renderer.submit(table, maps["width"], edges, args.plot, args.breadth, args.max_radius)
 
-    # Generate a summary
-    n = 0               # Number of coordinate entries (total)
-    num = 0             # Number of fibrils
-    avg_intensity = 0   # Average intensity over all fibrils
-    avg_velocity = 0    # Average velocity
-    avg_width = 0       # Average width
-    avg_breadth = 0     # Average breadth
-    for key in coords.keys():
-        num += 1    
-        for coord in coords[key]:
-            n+=1
-            avg_intensity += coord[2]
-            avg_velocity += coord[3]
-            avg_width += coord[4]
-            avg_breadth += coord[5]
-
-    avg_intensity = avg_intensity/n
-    avg_velocity = avg_velocity/n
-    avg_width = avg_width/n
-    avg_breadth = avg_breadth/n
+    write_characteristics(args.output_file, table)
+    if geometry is not None:
+        write_geometry(args.output_file, geometry)
 
+    # Generate a summary
+    summary = summarize(table)
     print(
-        "Fibril count: {}\n".format(num),
-        "Average intensity: {}\n".format(avg_intensity),
-        "Average velocity: {}\n".format(avg_velocity),
-        "Average width: {}\n".format(avg_width),
-        "Average breadth: {}".format(avg_breadth)
+        "Fibril count: {}\n".format(summary["count"]),
+        "Average intensity: {}\n".format(summary["intensity"]),
+        "Average velocity: {}\n".format(summary["velocity"]),
+        "Average width: {}\n".format(summary["width"]),
+        "Average breadth: {}".format(summary["breadth"])
     )
 
+    if renderer is not None:
+        renderer.close()
+    if args.profile:
+        PROFILER.write(args.profile)
+    if args.show:
+        show_width_calculations(table, maps["width"], edges, args.breadth, args.max_radius)
+
 if __name__ == "__main__":
-    manual_execution()
\ No newline at end of file
+    manual_execution()
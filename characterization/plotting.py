@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Width Plotting
+@author: Parker Lamb
+@description: Figures of the breadth calculation: the width map with its Canny edges, each fibril,
+and the breadth segment at every second coordinate. All fibrils and all segments are each drawn as
+a single LineCollection. Figures can be written to .png/.svg files in a background process, so
+plotting doesn't hold up the characterization itself.
+@usage: with Renderer() as renderer: renderer.submit(table, maps["width"], edges, ["widths.png"])
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+
+from characterization import calculate_breadth, fibril_lengths
+from breadth_index import BreadthIndex, DEFAULT_MAX_RADIUS
+
+def width_segments(table, edges, breadth="march", max_radius=None):
+    """
+    Breadth segments at every second coordinate of each fibril (where the positive side found
+    any non-edge pixels), from the end on the positive side, through the coordinate, to the end
+    on the negative side.
+
+    Parameters
+    ----------
+    table : numpy.ndarray
+        Structured array returned by characterize()
+    edges : numpy.ndarray
+        Edge map the breadth was found in
+    breadth, max_radius
+        As given to characterize(), so the segments are those of the breadths in table
+
+    Returns
+    -------
+    numpy.ndarray
+        (n, 3, 2) array of [x, y] points
+    """
+    lengths = fibril_lengths(table['fibril_id'])
+    x = table['x']
+    y = table['y']
+    index = None
+    if breadth != "march":
+        index = BreadthIndex(edges, max_radius or DEFAULT_MAX_RADIUS, directional=(breadth == "directional"))
+    bp, bn, dp = calculate_breadth(x, y, lengths, edges, max_radius, index)
+    starts = np.cumsum(lengths) - lengths
+    local = np.arange(len(x)) - np.repeat(starts, lengths)
+    i = np.flatnonzero((local % 2 == 1) & (bp > 0))
+
+    start = np.column_stack((np.round(x[i]), np.round(y[i])))
+    step = dp[i][:,::-1]    # [row, column] to [x, y]
+    return np.stack((start + step*(bp[i]-1)[:,None], start, start - step*(bn[i]-1)[:,None]), axis=1)
+
+def width_figure(table, width_map, edges, figure=None, breadth="march", max_radius=None):
+    """
+    Draw the Canny edges over the width map, with the fibrils and every second breadth segment.
+
+    Parameters
+    ----------
+    table : numpy.ndarray
+        Structured array returned by characterize()
+    width_map : numpy.ndarray
+        Halpha width map
+    edges : numpy.ndarray
+        Edge map of width_map
+    figure : matplotlib.figure.Figure
+        Figure to draw in. A new one (not attached to pyplot) is made if not given.
+    breadth, max_radius
+        How the breadth was found, as given to characterize() (see width_segments)
+
+    Returns
+    -------
+    matplotlib.figure.Figure
+        The figure
+    """
+    from matplotlib.collections import LineCollection
+    from matplotlib.figure import Figure
+
+    if figure is None:
+        figure = Figure(figsize=(10, 10))
+    ax = figure.add_subplot()
+
+    width_map_cv2 = (width_map*325).astype(np.uint8)
+    overlay = cv2.addWeighted(width_map_cv2, 0.7, edges, 0.4,0)
+    ax.imshow(overlay, origin='lower')
+
+    lengths = fibril_lengths(table['fibril_id'])
+    xy = np.column_stack((table['x'], table['y']))
+    ax.add_collection(LineCollection(np.split(xy, np.cumsum(lengths)[:-1]), linewidths=1, colors='#ff0000'))
+    ax.add_collection(LineCollection(width_segments(table, edges, breadth, max_radius), linewidths=1, colors='#a09516'))
+
+    ax.set_title("Estimate of per-pixel width of chromospheric fibrils")
+    ax.set_xlabel("Pixel positon")
+    ax.set_ylabel("Pixel position")
+    return figure
+
+def save_width_figure(table, width_map, edges, paths, dpi=200, breadth="march", max_radius=None):
+    """
+    Draw the width figure (see width_figure) and write it to each path. The format follows
+    the suffix of each path (i.e. .png or .svg).
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = width_figure(table, width_map, edges, breadth=breadth, max_radius=max_radius)
+    FigureCanvasAgg(figure)
+    for path in paths:
+        figure.savefig(path, dpi=dpi, bbox_inches='tight')
+    return paths
+
+class Renderer:
+    def __init__(self, max_pending=2):
+        """
+        Writes width figures in a separate process. Submitting returns straight away, unless
+        max_pending figures are still being drawn, in which case it waits for the oldest, so
+        figures can't pile up in memory.
+        """
+        self.max_pending = max_pending
+        self.pending = []
+        self.pool = ProcessPoolExecutor(max_workers=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, table, width_map, edges, paths, breadth="march", max_radius=None):
+        """
+        Draw and save a width figure in the background. See save_width_figure.
+        """
+        while len(self.pending) >= self.max_pending:
+            self.pending.pop(0).result()
+        self.pending.append(self.pool.submit(save_width_figure, table, width_map, edges, paths,
+                                             breadth=breadth, max_radius=max_radius))
+
+    def close(self):
+        """Wait for every figure to be written."""
+        try:
+            for future in self.pending:
+                future.result()
+        finally:
+            self.pending = []
+            self.pool.shutdown()
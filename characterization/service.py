@@ -0,0 +1,335 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Characterization Service
+@author: Parker Lamb
+@description: Long-running localhost HTTP service for characterizing many small coordinate sets (i.e.
+single fibrils or manual re-traces) against the same frames. Each frame's maps are read and its
+Canny edge map made once, then kept in a memory pool, least recently used frames first out once the
+pool is full, so requests are answered in milliseconds. characterize_remote() is the client, used by
+characterization.py --service.
+@usage: "python service.py [--port 8765] [--pool-size 2048] [--preload Halpha.sav ...]", then
+"python characterization.py <coordinates> <Ha.sav> <output> --service"
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+from characterization import characterize, edge_map, load_maps
+from breadth_index import DEFAULT_MAX_RADIUS, BreadthIndex
+from cache import DEFAULT_MAX_BYTES, MapCache
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "curve-tracing"))
+from coordinates import FibrilCoordinates
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_URL = "http://{}:{}".format(DEFAULT_HOST, DEFAULT_PORT)
+
+# Coordinates sent to the service, one row per coordinate
+COORDINATES_DTYPE = np.dtype([
+    ('fibril_id', np.int64),
+    ('x', np.float64),
+    ('y', np.float64),
+])
+
+# Memory for resident frames (maps, edge maps and breadth indexes), in bytes
+DEFAULT_POOL_BYTES = 2048*1024*1024
+
+class Frame:
+    def __init__(self, sav_file, cache=None):
+        """
+        The maps of one .sav file and their edge map, with breadth indexes built on first use.
+
+        Parameters
+        ----------
+        sav_file : str
+            IDL .sav file with halpha_coreint, halpha_vel and halpha_width
+        cache : MapCache
+            On-disk cache the edge map is looked up in (see cache.py)
+        """
+        self.sav_file = sav_file
+        self.maps = load_maps(sav_file)
+        self.edges = edge_map(self.maps["width"], cache=cache)
+        self.indexes = {}
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return sum(np.asarray(m).nbytes for m in self.maps.values()) + self.edges.nbytes + \
+            sum(index.nbytes for index in self.indexes.values())
+
+    def index(self, breadth, max_radius=None):
+        """BreadthIndex of the edges for a breadth method other than "march", made once."""
+        key = (breadth, max_radius or DEFAULT_MAX_RADIUS)
+        with self._lock:
+            if key not in self.indexes:
+                self.indexes[key] = BreadthIndex(self.edges, key[1], directional=(breadth == "directional"))
+            return self.indexes[key]
+
+class FramePool:
+    def __init__(self, max_bytes=DEFAULT_POOL_BYTES, cache=None):
+        """
+        Frames kept in memory by .sav file, up to max_bytes. A file changed on disk is read again.
+
+        Parameters
+        ----------
+        max_bytes : int
+            Total size of the frames to keep. The most recently used frame is always kept.
+        cache : MapCache
+            On-disk cache of edge maps, shared by all frames
+        """
+        self.max_bytes = max_bytes
+        self.cache = cache
+        self.frames = OrderedDict()
+        self._lock = threading.Lock()
+        # Event of each frame being loaded, set once it's in the pool (or failed to load)
+        self._loading = {}
+
+    @staticmethod
+    def key(sav_file):
+        path = os.path.abspath(sav_file)
+        stat = os.stat(path)
+        return (path, stat.st_mtime_ns, stat.st_size)
+
+    def get(self, sav_file):
+        """
+        Frame of a .sav file, loaded if it isn't in the pool. Frames are loaded outside the pool
+        lock, so requests for frames already in the pool aren't held up, and concurrent requests
+        for the same frame wait for a single load.
+
+        Returns
+        -------
+        tuple
+            (Frame, whether it was loaded by this call)
+        """
+        key = self.key(sav_file)
+        while True:
+            with self._lock:
+                if key in self.frames:
+                    self.frames.move_to_end(key)
+                    return self.frames[key], False
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    break
+            # Another request is loading it: use its frame, or load it again if that failed
+            loading.wait()
+
+        try:
+            frame = Frame(key[0], self.cache)
+            with self._lock:
+                # Older versions of the same file are stale
+                for stale in [k for k in self.frames if k[0] == key[0]]:
+                    del self.frames[stale]
+                self.frames[key] = frame
+                self._evict()
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+        return frame, True
+
+    def evict(self):
+        """Drop the least recently used frames until the pool fits in max_bytes."""
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        while len(self.frames) > 1 and self.nbytes > self.max_bytes:
+            self.frames.popitem(last=False)
+
+    @property
+    def nbytes(self):
+        return sum(frame.nbytes for frame in list(self.frames.values()))
+
+    def status(self):
+        with self._lock:
+            return {
+                "frames": [{"sav_file": frame.sav_file, "bytes": frame.nbytes, "shape": list(frame.edges.shape)}
+                           for frame in self.frames.values()],
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+            }
+
+def handle_characterize(pool, params, coordinates):
+    """
+    Characterize the coordinates of a request against its frame.
+
+    Parameters
+    ----------
+    pool : FramePool
+        Frames to use, or load into
+    params : dict
+        "sav_file", and optionally the "interpolation", "outside", "breadth" and "max_radius"
+        arguments of characterize()
+    coordinates : numpy.ndarray
+        Structured array of COORDINATES_DTYPE, one row per coordinate
+
+    Returns
+    -------
+    tuple
+        (structured array of CHARACTERISTICS_DTYPE, whether the frame was loaded for this request)
+    """
+    frame, loaded = pool.get(params["sav_file"])
+    coords = FibrilCoordinates.from_arrays(coordinates["fibril_id"], coordinates["x"], coordinates["y"])
+    breadth = params.get("breadth", "march")
+    max_radius = int(params["max_radius"]) if params.get("max_radius") else None
+    index = frame.index(breadth, max_radius) if breadth != "march" else None
+    table = characterize(coords, frame.maps, frame.edges, params.get("interpolation", "bilinear"),
+                         params.get("outside", "nan"), breadth, max_radius, index)
+    if index is not None:
+        # The index may have grown the frame
+        pool.evict()
+    return table, loaded
+
+def to_npy(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+def from_npy(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    POST /characterize?sav_file=...&breadth=... with the coordinates as a .npy array of
+    COORDINATES_DTYPE, answered with the characteristics as a .npy array of CHARACTERISTICS_DTYPE
+    (see handle_characterize). GET /status for the frames in the pool. Errors are answered with
+    JSON {"error": message}.
+    """
+
+    def send_body(self, status, data, content_type, headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, status, body):
+        self.send_body(status, json.dumps(body).encode(), "application/json")
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.send_json(200, self.server.pool.status())
+        else:
+            self.send_json(404, {"error": "Unknown path {}".format(self.path)})
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/characterize":
+            self.send_json(404, {"error": "Unknown path {}".format(url.path)})
+            return
+        try:
+            start = time.perf_counter()
+            params = dict(urllib.parse.parse_qsl(url.query))
+            coordinates = from_npy(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            table, loaded = handle_characterize(self.server.pool, params, coordinates)
+            self.send_body(200, to_npy(table), "application/octet-stream", [
+                ("X-Frame-Loaded", str(int(loaded))),
+                ("X-Seconds", "{:.6f}".format(time.perf_counter() - start)),
+            ])
+        except (OSError, KeyError, ValueError) as e:
+            self.send_json(400, {"error": "{}: {}".format(type(e).__name__, e)})
+        except Exception as e:
+            self.send_json(500, {"error": "{}: {}".format(type(e).__name__, e)})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+def serve(pool, host=DEFAULT_HOST, port=DEFAULT_PORT, verbose=False):
+    """
+    Make a threaded HTTP server answering requests from a FramePool. Call serve_forever() on it
+    to start serving.
+    """
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.daemon_threads = True
+    server.pool = pool
+    server.verbose = verbose
+    return server
+
+def characterize_remote(coords, sav_file, url=DEFAULT_URL, interpolation="bilinear", outside="nan",
+                        breadth="march", max_radius=None, timeout=None):
+    """
+    Characterize coordinates with a running service, as characterize() would.
+
+    Parameters
+    ----------
+    coords : FibrilCoordinates
+        Fibril coordinates, as returned by load_coordinates
+    sav_file : str
+        .sav file of the frame, readable by the service
+    url : str
+        Address of the service
+    interpolation, outside, breadth, max_radius
+        As for characterize()
+    timeout : float
+        Seconds to wait for an answer. A frame's first request includes reading it.
+
+    Returns
+    -------
+    numpy.ndarray
+        Structured array of CHARACTERISTICS_DTYPE, one row per coordinate
+    """
+    params = {
+        "sav_file": os.path.abspath(sav_file),
+        "interpolation": interpolation,
+        "outside": outside,
+        "breadth": breadth,
+    }
+    if max_radius is not None:
+        params["max_radius"] = max_radius
+    coordinates = np.empty(coords.npoints, dtype=COORDINATES_DTYPE)
+    coordinates["fibril_id"] = coords.point_ids
+    coordinates["x"] = coords.x
+    coordinates["y"] = coords.y
+    http_request = urllib.request.Request(url.rstrip("/") + "/characterize?" + urllib.parse.urlencode(params),
+                                          data=to_npy(coordinates), headers={"Content-Type": "application/octet-stream"})
+    try:
+        with urllib.request.urlopen(http_request, timeout=timeout) as response:
+            return from_npy(response.read())
+    except urllib.error.HTTPError as e:
+        raise RuntimeError("Characterization service error: {}".format(json.load(e).get("error", e.reason)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve characterization requests, keeping frames in memory.")
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on (default: {})'.format(DEFAULT_HOST))
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on (default: {})'.format(DEFAULT_PORT))
+    parser.add_argument('--pool-size', type=int, default=DEFAULT_POOL_BYTES//2**20, help='memory for resident frames, in MB')
+    parser.add_argument('--preload', nargs='+', default=[], metavar='SAV', help='.sav files to load before serving')
+    parser.add_argument('--cache-dir', default=None, help='directory to cache edge maps in, reused between runs on the same frame')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_BYTES//2**20, help='size limit of the cache directory, in MB')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    cache = MapCache(args.cache_dir, args.cache_size*2**20) if args.cache_dir else None
+    pool = FramePool(args.pool_size*2**20, cache)
+    for sav_file in args.preload:
+        pool.get(sav_file)
+        print("Loaded {}".format(sav_file), file=sys.stderr)
+    server = serve(pool, args.host, args.port, args.verbose)
+    print("Serving on http://{}:{}".format(*server.server_address[:2]), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Characteristic Statistics
+@author: Parker Lamb
+@description: Summary statistics and histograms of characterization output. Statistics are
+accumulated chunk by chunk, so files larger than memory can be summarized, and statistics of
+separate chunks or frames can be merged, so many frames can be summarized in parallel. Gives global
+and per-fibril means, percentiles, histograms and 2D histograms between characteristics (i.e.
+breadth against velocity).
+@usage: "python stats.py <characteristics .csv/.fibrils/.npz or .series directory...> [--output histograms.npz]"
+"""
+
+import argparse
+import itertools
+import os
+import sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "curve-tracing"))
+from fibril_store import is_store_path, open_store
+
+# Characteristics summarized, i.e. the value columns of characterize()
+VALUE_COLUMNS = ("intensity", "velocity", "width", "breadth")
+
+# Histogram bin edges of each characteristic. Values outside the edges are counted in an
+# underflow and an overflow bin.
+DEFAULT_BINS = {
+    "intensity": np.linspace(0, 0.5, 201),
+    "velocity": np.linspace(-0.5, 0.5, 201),
+    "width": np.linspace(0, 2.5, 251),
+    "breadth": np.arange(101) - 0.5,
+}
+
+# Pairs of characteristics with a 2D histogram
+DEFAULT_PAIRS = (
+    ("breadth", "velocity"),
+    ("breadth", "intensity"),
+    ("breadth", "width"),
+    ("intensity", "velocity"),
+)
+
+# Rows read at once from a file
+CHUNK_ROWS = 1_000_000
+
+def histogram_percentiles(counts, edges, low, high, q):
+    """
+    Percentiles of binned values, interpolating linearly within each bin.
+
+    Parameters
+    ----------
+    counts : numpy.ndarray
+        Counts of the underflow bin, each bin between edges, and the overflow bin
+    edges : numpy.ndarray
+        Bin edges
+    low, high : float
+        Smallest and largest value, which bound the underflow and overflow bins
+    q : array_like
+        Percentiles, between 0 and 100
+
+    Returns
+    -------
+    numpy.ndarray
+        Value at each percentile, NaN if there are no values
+    """
+    q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+    total = counts.sum()
+    if total == 0:
+        return np.full(q.shape, np.nan)
+    bounds = np.clip(np.concatenate(([low], edges, [high])), low, high)
+    cumulative = np.cumsum(counts)
+    target = q/100*total
+    b = np.minimum(np.searchsorted(cumulative, target, side='left'), counts.size-1)
+    before = cumulative[b] - counts[b]
+    fraction = np.divide(target - before, counts[b], out=np.zeros_like(target), where=counts[b] > 0)
+    return np.clip(bounds[b] + fraction*(bounds[b+1] - bounds[b]), low, high)
+
+class Statistics:
+    def __init__(self, columns=VALUE_COLUMNS, bins=None, pairs=DEFAULT_PAIRS):
+        """
+        Mergeable accumulator of statistics over characterization tables. NaN values (i.e. of
+        coordinates outside the maps) are left out.
+
+        Parameters
+        ----------
+        columns : tuple
+            Columns to summarize
+        bins : dict
+            Histogram bin edges per column, overriding DEFAULT_BINS
+        pairs : tuple
+            Pairs of columns to make 2D histograms of
+        """
+        self.columns = tuple(columns)
+        self.bins = {name: np.asarray(edges, dtype=np.float64) for name, edges in dict(DEFAULT_BINS, **(bins or {})).items()
+                     if name in self.columns}
+        self.pairs = tuple(tuple(pair) for pair in pairs if pair[0] in self.columns and pair[1] in self.columns)
+        self.rows = 0
+        # Per column count, mean, sum of squared differences from the mean, minimum and maximum
+        self.count = np.zeros(len(self.columns), dtype=np.int64)
+        self.mean = np.zeros(len(self.columns))
+        self.m2 = np.zeros(len(self.columns))
+        self.min = np.full(len(self.columns), np.inf)
+        self.max = np.full(len(self.columns), -np.inf)
+        self.histograms = {name: np.zeros(self.bins[name].size + 1, dtype=np.int64) for name in self.columns}
+        self.histograms2d = {pair: np.zeros((self.bins[pair[0]].size + 1, self.bins[pair[1]].size + 1), dtype=np.int64)
+                             for pair in self.pairs}
+        # Per fibril: (frame << 32 | fibril_id) key, number of rows, and per column count and sum
+        self.fibril_keys = np.zeros(0, dtype=np.int64)
+        self.fibril_rows = np.zeros(0, dtype=np.int64)
+        self.fibril_count = np.zeros((0, len(self.columns)), dtype=np.int64)
+        self.fibril_sum = np.zeros((0, len(self.columns)))
+
+    def _bin(self, name, values):
+        # 0 for the underflow bin, edges.size for the overflow bin
+        return np.searchsorted(self.bins[name], values, side='right')
+
+    def update(self, table, frame=0):
+        """
+        Add a chunk of a characterization table (i.e. the output of characterize()). Rows of one
+        fibril may be split over several chunks.
+        """
+        self.rows += len(table)
+        values = np.column_stack([np.asarray(table[name], dtype=np.float64) for name in self.columns]) \
+            if len(table) else np.zeros((0, len(self.columns)))
+        valid = ~np.isnan(values)
+
+        # Global moments, combined with Chan's parallel algorithm
+        count = valid.sum(axis=0)
+        sums = np.where(valid, values, 0).sum(axis=0)
+        mean = np.divide(sums, count, out=np.zeros(len(self.columns)), where=count > 0)
+        m2 = (np.where(valid, values - mean, 0)**2).sum(axis=0)
+        self._combine(count, mean, m2)
+        if len(table):
+            self.min = np.fmin(self.min, np.nanmin(np.where(valid, values, np.inf), axis=0))
+            self.max = np.fmax(self.max, np.nanmax(np.where(valid, values, -np.inf), axis=0))
+
+        bins = {}
+        for i, name in enumerate(self.columns):
+            bins[name] = self._bin(name, values[:,i])
+            self.histograms[name] += np.bincount(bins[name][valid[:,i]], minlength=self.histograms[name].size)
+        for a, b in self.pairs:
+            both = valid[:,self.columns.index(a)] & valid[:,self.columns.index(b)]
+            shape = self.histograms2d[(a, b)].shape
+            flat = np.ravel_multi_index((bins[a][both], bins[b][both]), shape)
+            self.histograms2d[(a, b)] += np.bincount(flat, minlength=shape[0]*shape[1]).reshape(shape)
+
+        keys, inverse = np.unique((np.int64(frame) << 32) | np.asarray(table['fibril_id'], dtype=np.int64), return_inverse=True)
+        inverse = inverse.reshape(-1)
+        rows = np.bincount(inverse, minlength=keys.size)
+        fibril_count = np.stack([np.bincount(inverse, weights=valid[:,i], minlength=keys.size)
+                                 for i in range(len(self.columns))], axis=1)
+        fibril_sum = np.stack([np.bincount(inverse, weights=np.where(valid[:,i], values[:,i], 0), minlength=keys.size)
+                               for i in range(len(self.columns))], axis=1)
+        self._combine_fibrils(keys, rows, fibril_count.astype(np.int64), fibril_sum)
+        return self
+
+    def _combine(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mean = np.where(total > 0, self.mean + delta*count/np.maximum(total, 1), 0)
+            self.m2 = self.m2 + m2 + delta**2*self.count*count/np.maximum(total, 1)
+        self.count = total
+
+    def _combine_fibrils(self, keys, rows, count, sums):
+        keys = np.concatenate((self.fibril_keys, keys))
+        self.fibril_keys, inverse = np.unique(keys, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        n = self.fibril_keys.size
+        self.fibril_rows = np.bincount(inverse, weights=np.concatenate((self.fibril_rows, rows)), minlength=n).astype(np.int64)
+        count = np.concatenate((self.fibril_count, count))
+        sums = np.concatenate((self.fibril_sum, sums))
+        self.fibril_count = np.zeros((n, len(self.columns)), dtype=np.int64)
+        self.fibril_sum = np.zeros((n, len(self.columns)))
+        np.add.at(self.fibril_count, inverse, count)
+        np.add.at(self.fibril_sum, inverse, sums)
+
+    def merge(self, other):
+        """
+        Add the statistics of another accumulator with the same columns and bins (i.e. of other
+        chunks or frames).
+        """
+        if other.columns != self.columns or other.pairs != self.pairs or \
+                any(not np.array_equal(self.bins[name], other.bins[name]) for name in self.columns):
+            raise ValueError("Can only merge statistics with the same columns and bins")
+        self.rows += other.rows
+        self._combine(other.count, other.mean, other.m2)
+        self.min = np.fmin(self.min, other.min)
+        self.max = np.fmax(self.max, other.max)
+        for name in self.columns:
+            self.histograms[name] += other.histograms[name]
+        for pair in self.pairs:
+            self.histograms2d[pair] += other.histograms2d[pair]
+        self._combine_fibrils(other.fibril_keys, other.fibril_rows, other.fibril_count, other.fibril_sum)
+        return self
+
+    def means(self):
+        """Mean of each column."""
+        return {name: self.mean[i] if self.count[i] else np.nan for i, name in enumerate(self.columns)}
+
+    def std(self):
+        """Standard deviation of each column."""
+        return {name: np.sqrt(self.m2[i]/self.count[i]) if self.count[i] else np.nan for i, name in enumerate(self.columns)}
+
+    def percentiles(self, q=(5, 25, 50, 75, 95)):
+        """
+        Percentiles of each column, estimated from the histograms (so only as fine as the bins).
+        """
+        return {name: histogram_percentiles(self.histograms[name], self.bins[name], self.min[i], self.max[i], q)
+                for i, name in enumerate(self.columns)}
+
+    def fibrils(self):
+        """
+        Per-fibril statistics.
+
+        Returns
+        -------
+        numpy.ndarray
+            Structured array with the frame, fibril_id, number of coordinates (npoints) and the
+            mean of each column, one row per fibril of each frame
+        """
+        dtype = [("frame", np.int64), ("fibril_id", np.int64), ("npoints", np.int64)] + \
+            [(name, np.float64) for name in self.columns]
+        result = np.empty(self.fibril_keys.size, dtype=dtype)
+        result["frame"] = self.fibril_keys >> 32
+        result["fibril_id"] = self.fibril_keys & 0xFFFFFFFF
+        result["npoints"] = self.fibril_rows
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for i, name in enumerate(self.columns):
+                result[name] = np.where(self.fibril_count[:,i] > 0, self.fibril_sum[:,i]/self.fibril_count[:,i], np.nan)
+        return result
+
+    def summary(self):
+        """
+        Fibril count and the mean of each column, as printed by characterization.py.
+        """
+        return dict(count=self.fibril_keys.size, **self.means())
+
+def read_chunks(path, chunk_rows=CHUNK_ROWS, columns=None):
+    """
+    Read a characteristics .csv or fibril store in chunks of up to chunk_rows rows.
+    """
+    from characterization import CHARACTERISTICS_DTYPE
+
+    if is_store_path(path):
+        with open_store(path) as store:
+            yield from store.chunks(chunk_rows, columns)
+        return
+    with open(path) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if not lines:
+                break
+            values = np.loadtxt(lines, delimiter=",", ndmin=2)
+            table = np.empty(len(values), dtype=CHARACTERISTICS_DTYPE)
+            for i, name in enumerate(CHARACTERISTICS_DTYPE.names):
+                table[name] = values[:,i]
+            yield table
+
+def file_statistics(path, frame=0, chunk_rows=CHUNK_ROWS, **kwargs):
+    """
+    Statistics of one characterization output, read in chunks. Keyword arguments are passed to
+    Statistics.
+    """
+    stats = Statistics(**kwargs)
+    for chunk in read_chunks(path, chunk_rows, ("fibril_id",) + stats.columns):
+        stats.update(chunk, frame)
+    return stats
+
+def find_frames(paths):
+    """
+    Expand .series directories (see timeseries.py) into their per-frame stores.
+    """
+    frames = []
+    for path in paths:
+        if os.path.isdir(path) and not is_store_path(path):
+            frames.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if is_store_path(name))
+        else:
+            frames.append(path)
+    return frames
+
+def frame_statistics(paths, workers=None, chunk_rows=CHUNK_ROWS, **kwargs):
+    """
+    Statistics over many frames, one file or store each, computed in parallel and merged. Frames
+    are numbered in the order of paths.
+    """
+    stats = Statistics(**kwargs)
+    if workers == 1 or len(paths) < 2:
+        for frame, path in enumerate(paths):
+            stats.merge(file_statistics(path, frame, chunk_rows, **kwargs))
+        return stats
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(file_statistics, path, frame, chunk_rows, **kwargs) for frame, path in enumerate(paths)]
+        for future in futures:
+            stats.merge(future.result())
+    return stats
+
+def write_histograms(path, stats):
+    """
+    Save the histograms, their bin edges and the per-fibril statistics to a .npz file.
+    """
+    arrays = {"fibrils": stats.fibrils()}
+    for name in stats.columns:
+        arrays["hist_" + name] = stats.histograms[name]
+        arrays["bins_" + name] = stats.bins[name]
+    for a, b in stats.pairs:
+        arrays["hist2d_{}_{}".format(a, b)] = stats.histograms2d[(a, b)]
+    np.savez_compressed(path, **arrays)
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize characterization output, over one or many frames.")
+    parser.add_argument('inputs', nargs='+', help='characteristics .csv files, fibril stores, or .series directories (one frame each)')
+    parser.add_argument('--output', default=None, help='.npz file to save the histograms and per-fibril statistics to')
+    parser.add_argument('--percentiles', type=float, nargs='+', default=[5, 25, 50, 75, 95], help='percentiles to print')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per core)')
+    args = parser.parse_args()
+
+    stats = frame_statistics(find_frames(args.inputs), args.workers)
+    means = stats.means()
+    std = stats.std()
+    percentiles = stats.percentiles(args.percentiles)
+    print("Fibrils: {}, coordinates: {}".format(stats.fibril_keys.size, stats.rows))
+    for name in stats.columns:
+        print("{}: mean {:.4g}, std {:.4g}, percentiles ({}) {}".format(
+            name, means[name], std[name], ", ".join("{:g}".format(q) for q in args.percentiles),
+            ", ".join("{:.4g}".format(v) for v in percentiles[name])))
+    if args.output:
+        write_histograms(args.output, stats)
+
+if __name__ == "__main__":
+    main()
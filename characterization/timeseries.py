@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Time Series Characterization
+@author: Parker Lamb
+@description: Characterize fibrils over a whole observing run, frame by frame. Frames are read
+lazily from a list of .sav files or from the planes of FITS cubes (halpha_*_mfbd_m300.fits), and
+the next frame is read in the background while the current one is characterized, so at most two
+frames are held in memory. Each frame's results are written to a frame-indexed series store as
+soon as they are done; an interrupted run picks up where it stopped.
+@usage: "python timeseries.py <coordinates file or directory> <.sav glob or FITS directory> <output.series>"
+"""
+
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from characterization import characterize, edge_map, load_coordinates, load_maps, summarize
+from cache import DEFAULT_MAX_BYTES, MapCache
+from fibril_store import STORE_SUFFIXES, open_store, write_store
+from fits_images import FitsMaps
+from sampling import INTERPOLATIONS, OUTSIDE
+from profiling import PROFILER
+
+# FITS maps read for each characteristic
+FITS_MAPS = {
+    "intensity": "coreint",
+    "velocity": "vel",
+    "width": "width",
+}
+
+class SeriesStore:
+    def __init__(self, path):
+        """
+        A directory of fibril stores, one per frame, named frame_<index>.fibrils.
+
+        Parameters
+        ----------
+        path : str
+            Directory of the series, created if needed (conventionally ending in .series)
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def frame_path(self, index):
+        return os.path.join(self.path, "frame_{:05d}.fibrils".format(index))
+
+    def __contains__(self, index):
+        return os.path.exists(self.frame_path(index))
+
+    def frames(self):
+        """Sorted indices of the frames in the series."""
+        names = [re.fullmatch(r"frame_(\d+)\.fibrils", name) for name in os.listdir(self.path)]
+        return sorted(int(match.group(1)) for match in names if match)
+
+    def __len__(self):
+        return len(self.frames())
+
+    def append(self, index, table):
+        """
+        Write the characteristics of one frame. The frame only appears in the series once it
+        has been completely written.
+        """
+        write_store(self.frame_path(index), table)
+
+    def open(self, index):
+        """The FibrilStore of one frame."""
+        return open_store(self.frame_path(index))
+
+    def tables(self, columns=None):
+        """
+        Iterate over (frame index, table) for every frame, reading one frame at a time.
+        """
+        for index in self.frames():
+            with self.open(index) as store:
+                yield index, store.table(columns)
+
+def sav_frames(paths):
+    """
+    One loader per .sav file, each returning the maps of that file (see load_maps).
+    """
+    return [(path, lambda path=path: load_maps(path)) for path in paths]
+
+def fits_frames(directory, suffix="mfbd_m300"):
+    """
+    One loader per plane of the FITS maps in a directory (i.e. halpha_coreint_mfbd_m300.fits),
+    each returning the intensity, velocity and width maps of that plane. Single images give
+    a single frame.
+    """
+    maps = FitsMaps.from_directory(directory, suffix, names=list(FITS_MAPS.values()))
+    with maps:
+        nplanes = maps["width"].nplanes
+
+    def load(plane):
+        with FitsMaps.from_directory(directory, suffix, names=list(FITS_MAPS.values())) as maps:
+            planes = maps.read(plane=plane if nplanes > 1 else None)
+        return {name: planes[fits_name] for name, fits_name in FITS_MAPS.items()}
+    return [("{}[{}]".format(directory, plane), lambda plane=plane: load(plane)) for plane in range(nplanes)]
+
+def find_frames(source, suffix="mfbd_m300"):
+    """
+    Frame loaders for a directory of FITS maps, a directory of .sav files, or a glob of .sav files.
+    """
+    if os.path.isdir(source):
+        sav_files = sorted(glob.glob(os.path.join(source, "*.sav")))
+        return sav_frames(sav_files) if sav_files else fits_frames(source, suffix)
+    return sav_frames(sorted(glob.glob(source)))
+
+def find_coordinates(source):
+    """
+    Coordinate files for each frame: a single file (the same fibrils in every frame), or the
+    sorted coordinate files and stores in a directory (one per frame, i.e. from batch.py).
+    """
+    if os.path.isdir(source) and not source.rstrip("/").endswith(STORE_SUFFIXES):
+        names = sorted(name for name in os.listdir(source)
+                       if name.endswith(STORE_SUFFIXES + (".dat", ".csv")) and not name.startswith("."))
+        return [os.path.join(source, name) for name in names]
+    return [source]
+
+def prefetched(loaders):
+    """
+    Call each loader in turn, reading the next one in a background thread while the current
+    result is in use.
+    """
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        future = reader.submit(loaders[0]) if loaders else None
+        for i in range(len(loaders)):
+            result = future.result()
+            future = reader.submit(loaders[i+1]) if i+1 < len(loaders) else None
+            yield result
+            result = None
+
+def characterize_series(frames, coordinates, output, interpolation="bilinear", outside="nan", cache=None,
+                        resume=True, progress=True, plot_dir=None):
+    """
+    Characterize every frame, writing each to the series store as soon as it's done.
+
+    Parameters
+    ----------
+    frames : list
+        (name, loader) for each frame, from sav_frames, fits_frames or find_frames
+    coordinates : list
+        Coordinate files or stores, either one per frame, or a single one used for every frame
+    output : str
+        Series store directory
+    interpolation : str
+        How maps are sampled (see characterize)
+    outside : str
+        Map values of coordinates outside the maps (see characterize)
+    cache : MapCache
+        Cache for the edge maps of each frame
+    resume : bool
+        Skip frames already in the series store
+    progress : bool
+        Print a line to stderr as each frame completes
+    plot_dir : str
+        If given, write the width calculations figure of each frame to <plot_dir>/frame_<index>.png,
+        in a background process (see plotting.py)
+
+    Returns
+    -------
+    SeriesStore
+        The series store
+    """
+    if len(coordinates) not in (1, len(frames)):
+        raise ValueError("Got {} coordinate files for {} frames".format(len(coordinates), len(frames)))
+    series = SeriesStore(output)
+    todo = [index for index in range(len(frames)) if not (resume and index in series)]
+    if progress and len(todo) < len(frames):
+        print("Skipping {} completed frames".format(len(frames) - len(todo)), file=sys.stderr)
+
+    # The same coordinates for every frame only need reading once
+    shared = load_coordinates(coordinates[0]) if len(coordinates) == 1 else None
+    def loader(index):
+        load = frames[index][1]
+        return lambda: (index, load(), shared if shared is not None else load_coordinates(coordinates[index]))
+
+    renderer = None
+    if plot_dir:
+        from plotting import Renderer
+        os.makedirs(plot_dir, exist_ok=True)
+        renderer = Renderer()
+
+    for index, maps, coords in prefetched([loader(index) for index in todo]):
+        start = time.perf_counter()
+        edges = edge_map(maps["width"], cache=cache)
+        table = characterize(coords, maps, edges, interpolation, outside)
+        series.append(index, table)
+        if renderer is not None:
+            renderer.submit(table, maps["width"], edges, [os.path.join(plot_dir, "frame_{:05d}.png".format(index))])
+        if progress:
+            summary = summarize(table)
+            print("[{}/{}] {}: {} fibrils, mean breadth {:.2f} ({:.1f} s)".format(
+                index + 1, len(frames), frames[index][0], summary["count"], summary["breadth"],
+                time.perf_counter() - start), file=sys.stderr)
+        # Let go of this frame before the one after next is read
+        del maps, edges, table
+    if renderer is not None:
+        renderer.close()
+    return series
+
+def main():
+    parser = argparse.ArgumentParser(description="Characterize fibrils over a sequence of frames.")
+    parser.add_argument('coordinates', help='coordinates file or store, or a directory with one per frame')
+    parser.add_argument('frames', help='directory of FITS maps (cubes) or .sav files, or a (quoted) .sav glob pattern')
+    parser.add_argument('output', help='series store directory to write (i.e. run.series)')
+    parser.add_argument('--suffix', default="mfbd_m300", help='suffix of the FITS map names (default: mfbd_m300)')
+    parser.add_argument('--interpolation', default="bilinear", choices=INTERPOLATIONS, help='how maps are sampled at sub-pixel coordinates (default: bilinear)')
+    parser.add_argument('--outside', default="nan", choices=OUTSIDE, help='map values for coordinates outside the maps (default: nan)')
+    parser.add_argument('--cache-dir', default=None, help='directory to cache edge maps in')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_BYTES//2**20, help='size limit of the cache directory, in MB')
+    parser.add_argument('--plot-dir', default=None, help='write a width calculations figure per frame to this directory (off by default)')
+    parser.add_argument('--no-resume', action='store_true', help='re-characterize frames already in the output')
+    parser.add_argument('--profile', default=None, metavar='FILE', help='time each stage and write a JSON report to FILE')
+    args = parser.parse_args()
+    if args.profile:
+        PROFILER.enable()
+
+    frames = find_frames(args.frames, args.suffix)
+    if not frames:
+        sys.exit("No frames found")
+    coordinates = find_coordinates(args.coordinates)
+    if not coordinates:
+        sys.exit("No coordinate files found")
+    cache = MapCache(args.cache_dir, args.cache_size*2**20) if args.cache_dir else None
+
+    start = time.perf_counter()
+    series = characterize_series(frames, coordinates, args.output, args.interpolation, args.outside, cache,
+                                 not args.no_resume, plot_dir=args.plot_dir)
+    print("{} frames in {} ({:.1f} s)".format(len(series), args.output, time.perf_counter() - start))
+    if args.profile:
+        PROFILER.write(args.profile)
+
+if __name__ == "__main__":
+    main()
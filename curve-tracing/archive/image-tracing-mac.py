@@ -15,12 +15,17 @@ import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 import csv
+import os
 import sys
-import scipy.io as sio
 from datetime import datetime
 from astropy.io import fits
 from collections import OrderedDict
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from sav_arrays import read_sav
+from coordinates import FibrilCoordinates, read_coordinates
+from geometry import path_lengths
+
 matplotlib.use("TkAgg")
 
 class Coordinates:
@@ -42,7 +47,8 @@ class Coordinates:
             f = np.flipud(f) # IDL arrays appear vertically "flipped" to Python. We reset it here. 
             self.ax.imshow(f[0].data, cmap="ocean", vmin="0", vmax="700", extent=ext)
         elif ".sav" in path:
-            f = sio.readsav(self.path)
+            # From the file's .npy conversion if it has one (see sav_arrays.py)
+            f = read_sav(self.path)
             if len(f) > 1:
                 n = 0
                 print("Multiple images available in save. Choose the number that corresponds with the image you want.")
@@ -123,15 +129,9 @@ class Coordinates:
             with open('data/'+self.characterfile, 'w', newline='') as charfile:
                 charwriter = csv.writer(charfile)
                 charwriter.writerow(["Loop Number", "Length (px)"])
-                for key in self.coords.keys():
-                    length = 0
-                    self.prevcoord=np.array([])
-                    for coord in self.coords[key]:
-                        if self.prevcoord.size == 0:
-                            self.prevcoord = coord
-                        else:
-                            length+=np.abs(np.linalg.norm(coord-self.prevcoord))
-                            self.prevcoord = coord
+                # Lengths of all curves at once
+                fibrils = FibrilCoordinates.from_features([np.reshape(c, (-1, 2)) for c in self.coords.values()])
+                for key, length in zip(self.coords.keys(), path_lengths(fibrils.x, fibrils.y, fibrils.lengths)):
                     print(key, length)
                     charwriter.writerow([key,length])
             print("Characteristics saved to data/"+self.characterfile)
@@ -141,26 +141,19 @@ class Coordinates:
     
     def plot_data(self):
         # If we already have data stored in a CSV, we can supply it as an optional argument to be plotted.
-        with open(self.datafile, newline='') as datafile:
-            datareader = csv.reader(datafile, delimiter=',')
-            for row in datareader:
-                try:
-                    self.coords[int(row[0])]
-                except KeyError:
-                    self.coords[int(row[0])] = np.array([])
-                if np.size(self.coords[int(row[0])]) == 0:
-                    self.coords[int(row[0])] = np.array([[float(row[1]),float(row[2])]])
-                else:
-                    self.coords[int(row[0])] = np.append(self.coords[int(row[0])], [np.array([float(row[1]),float(row[2])])], axis=0)
-                self.num = int(row[0])
-                x = self.coords[self.num][:,0]
-                y = self.coords[self.num][:,1]
-                self.ax.scatter(x,y)
-                self.ax.plot(x,y)
-            self.fig.canvas.draw()
-            print(self.num)
-            self.num+=1
-            self.coords[self.num] = np.array([])
+        fibrils = read_coordinates(self.datafile, delimiter=',')
+        for num, coords in zip(fibrils.ids.tolist(), fibrils):
+            # Curves already traced with the same number are continued
+            if np.size(self.coords.get(num, [])):
+                coords = np.append(self.coords[num], coords, axis=0)
+            self.coords[num] = coords
+            self.num = num
+            self.ax.scatter(coords[:,0],coords[:,1])
+            self.ax.plot(coords[:,0],coords[:,1])
+        self.fig.canvas.draw()
+        print(self.num)
+        self.num+=1
+        self.coords[self.num] = np.array([])
 
 
 if __name__ == "__main__":
@@ -8,18 +8,23 @@ Created on Wed 5.6.21
 containing coordinate information for individual points, and characteristics.csv, containing info
 (number and length) on each traced feature. 
 @usage: To trace a curve, hold shift and click to add points. Release and press shift again to trace
-another curve. Hit the enter key to save your data to the files indicated above. 
+another curve. Completed curves are appended to the files indicated above every few seconds, when
+the enter key is hit, and when the window is closed.
 """
 # Reference: https://learn.astropy.org/FITS-images.html
 import matplotlib.pyplot as plt
 import numpy as np
-import csv
+import os
 import sys
-import scipy.io as sio
 from datetime import datetime
 from astropy.io import fits
 from collections import OrderedDict
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from coordinates import read_coordinates
+from sav_arrays import read_sav
+from session import DEFAULT_AUTOSAVE, Session
+
 class Coordinates:
     ## Setup
     def __init__(self,path, x_off=0, y_off=0, datafile=None):
@@ -38,7 +43,8 @@ class Coordinates:
             ext = [x_off, f[0].data.shape[0]+x_off, y_off, f[0].data.shape[1]+y_off]
             self.ax.imshow(f[0].data, cmap="ocean", origin="lower", vmin="0", vmax="700", extent=ext)
         elif ".sav" in path:
-            f = sio.readsav(self.path)
+            # From the file's .npy conversion if it has one (see sav_arrays.py)
+            f = read_sav(self.path)
             if len(f) > 1:
                 n = 0
                 print("Multiple images available in save. Choose the number that corresponds with the image you want.")
@@ -57,14 +63,21 @@ class Coordinates:
         self.cidclick = self.fig.canvas.mpl_connect('button_press_event', self.onclick)
         self.cidpress = self.fig.canvas.mpl_connect('key_press_event', self.key_press)
         self.cidrelease = self.fig.canvas.mpl_connect('key_release_event', self.key_release)
-        if self.datafile:
-            self.plot_data()
-        else:
+        loaded = self.datafile is not None
+        if not loaded:
             self.datafile = "coordinates-{}.csv".format(datetime.now().strftime("%Y-%m-%d-%H:%m:%S"))
         # Our characterfile will just be dependent on the naming of our coordfile, so we don't have to repeat logic. 
         self.characterfile="characteristics-{}.csv".format(self.datafile[self.datafile.find('-')+1:self.datafile.find('.')])
         print(self.characterfile)
+        # Completed curves are appended to the files in the background
+        self.session = Session("data/"+self.datafile, "data/"+self.characterfile, autosave=DEFAULT_AUTOSAVE)
+        self.coords.pop(self.num)
+        self.num = self.session.next_id
+        self.coords[self.num] = np.array([])
+        if loaded:
+            self.plot_data()
         plt.show()
+        self.session.close()
 
     ## Operation: whenever shift is held (either), and a click is detected, a point
     ## will be plotted. After shift key is released, the curve trace is complete, and 
@@ -78,6 +91,8 @@ class Coordinates:
                 self.coords[self.num] = np.array([[self.ix,self.iy]])
             else:
                 self.coords[self.num] = np.append(self.coords[self.num], [np.array([self.ix,self.iy])], axis=0)
+            # Keeps the length of the curve as a running total
+            self.session.add_point(self.ix, self.iy)
             # We store coordinates in a numpy array. 
             x = self.coords[self.num][:,0]
             y = self.coords[self.num][:,1]
@@ -94,65 +109,37 @@ class Coordinates:
             self.save_to_files()
     def key_release(self,event):
         if event.key == "shift":
-            self.num+=1
             self.shift = False
+            # The session numbers curves as we do, but drops those of fewer than two points
+            if self.session.finish() is None:
+                self.coords.pop(self.num)
+            self.num = self.session.next_id
             self.coords[self.num] = np.array([])
 
     def save_to_files(self):
-        self.coords.pop(self.num) # Last number will always have 0 entries
-        # Save data to coordinates.csv and characteristics.csv in the local directory.
-        try: 
-            with open("data/"+self.datafile, 'w', newline='') as coordfile:
-                coordwriter = csv.writer(coordfile)
-                for key in self.coords.keys():
-                    for coord in self.coords[key]:
-                        coordwriter.writerow([key, coord[0], coord[1]])
-            print("Coordinates saved to {}".format("data/"+self.datafile))
-        except Exception as e:
-            print("Error writing to {}: {}".format("data/"+self.datafile, e))
-
+        # Append the curves completed since the last save to data/coordinates-*.csv and data/characteristics-*.csv
         try:
-            with open('data/'+self.characterfile, 'w', newline='') as charfile:
-                charwriter = csv.writer(charfile)
-                charwriter.writerow(["Loop Number", "Length (px)"])
-                for key in self.coords.keys():
-                    length = 0
-                    self.prevcoord=np.array([])
-                    for coord in self.coords[key]:
-                        if self.prevcoord.size == 0:
-                            self.prevcoord = coord
-                        else:
-                            length+=np.abs(np.linalg.norm(coord-self.prevcoord))
-                            self.prevcoord = coord
-                    print(key, length)
-                    charwriter.writerow([key,length])
-            print("Characteristics saved to data/"+self.characterfile)
+            saved = self.session.save()
+            print("{} curves saved to {} and {}".format(saved, "data/"+self.datafile, "data/"+self.characterfile))
         except Exception as e:
-            print("Error writing to {}: {}".format(self.characterfile, e))
-        self.coords[self.num] = np.array([])
+            print("Error writing to {}: {}".format("data/"+self.datafile, e))
     
     def plot_data(self):
         # If we already have data stored in a CSV, we can supply it as an optional argument to be plotted.
-        with open(self.datafile, newline='') as datafile:
-            datareader = csv.reader(datafile, delimiter=',')
-            for row in datareader:
-                try:
-                    self.coords[int(row[0])]
-                except KeyError:
-                    self.coords[int(row[0])] = np.array([])
-                if np.size(self.coords[int(row[0])]) == 0:
-                    self.coords[int(row[0])] = np.array([[float(row[1]),float(row[2])]])
-                else:
-                    self.coords[int(row[0])] = np.append(self.coords[int(row[0])], [np.array([float(row[1]),float(row[2])])], axis=0)
-                self.num = int(row[0])
-                x = self.coords[self.num][:,0]
-                y = self.coords[self.num][:,1]
-                self.ax.scatter(x,y)
-                self.ax.plot(x,y)
-            self.fig.canvas.draw()
-            print(self.num)
-            self.num+=1
-            self.coords[self.num] = np.array([])
+        fibrils = read_coordinates(self.datafile, delimiter=',')
+        self.coords.pop(self.num)
+        # Curves loaded from elsewhere are copied into the session files
+        copy = os.path.abspath(self.datafile) != os.path.abspath(self.session.coordinate_file)
+        for num, coords in zip(fibrils.ids, fibrils):
+            self.coords[int(num)] = coords
+            if copy:
+                self.session.add(coords, num)
+            self.ax.scatter(coords[:,0],coords[:,1])
+            self.ax.plot(coords[:,0],coords[:,1])
+        self.fig.canvas.draw()
+        self.num = self.session.next_id
+        print(self.num)
+        self.coords[self.num] = np.array([])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Batch Tracing
+@author: Parker Lamb
+@description: Run AutoTracing (OCCULT-2) over many FITS frames in parallel, one worker process per
+core. Each worker writes its own output file, so only a short summary is sent back per frame.
+Frames that already have an output are skipped, so an interrupted batch can simply be re-run.
+@usage: "python batch.py '<fits-glob or directory>' <output-directory> [--workers n] [--format .fibrils]"
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from fibril_store import is_store_path
+from profiling import PROFILER
+
+# OCCULT-2 parameters accepted by AutoTracing.run(), with their defaults
+OCCULT_PARAMETERS = {
+    "nsm1": 4,
+    "rmin": 45,
+    "lmin": 35,
+    "nstruc": 2000,
+    "ngap": 1,
+    "qthresh1": 0.0,
+    "qthresh2": 3.0,
+}
+
+def find_frames(pattern):
+    """
+    Get the sorted list of FITS frames in a directory, or matching a glob pattern.
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.fits")
+    return sorted(glob.glob(pattern))
+
+def frames_root(frames):
+    """
+    Deepest directory holding all of the frames.
+    """
+    return os.path.commonpath([os.path.dirname(os.path.abspath(frame)) for frame in frames])
+
+def output_path(frame, output_dir, fmt=".fibrils", root=None):
+    """
+    Path of the output for a frame, i.e. <output_dir>/<frame name><fmt>. With root (see
+    frames_root), the frame's directories below root are kept, i.e. <root>/a/frame.fits goes to
+    <output_dir>/a/frame<fmt>, so frames of the same name in different directories get different
+    outputs.
+    """
+    name = os.path.splitext(os.path.basename(frame))[0]
+    if root is not None:
+        name = os.path.join(os.path.relpath(os.path.dirname(os.path.abspath(frame)), root), name)
+    return os.path.normpath(os.path.join(output_dir, name + fmt))
+
+def trace_frame(frame, save_path, params, hdu=0, plane=None, profile=False):
+    """
+    Trace a single frame and save its features. Runs in a worker process.
+
+    The output is written under a temporary name and then moved into place, so save_path
+    only exists once the frame is complete.
+
+    Returns
+    -------
+    tuple
+        (number of features, number of coordinates, seconds taken), followed by the stage
+        records of the frame if profile is set (see profiling.py)
+    """
+    from tracing import AutoTracing
+
+    if profile:
+        # Worker processes are reused, so only keep the stages of this frame
+        PROFILER.reset()
+        PROFILER.enable()
+    start = time.perf_counter()
+    tracer = AutoTracing(frame, hdu=hdu, plane=plane)
+    features = tracer.run(**params)
+    if is_store_path(save_path):
+        # write_store already writes next to save_path and moves the store into place,
+        # replacing any existing one
+        tracer.save(features, save_path)
+    else:
+        # Keep the suffix, so the output format is unchanged
+        tmp_path = os.path.join(os.path.dirname(save_path), "." + os.path.basename(save_path))
+        try:
+            tracer.save(features, tmp_path)
+            os.replace(tmp_path, save_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    result = len(features), sum(len(feature) for feature in features), time.perf_counter() - start
+    if profile:
+        return result + (PROFILER.report()["stages"],)
+    return result
+
+def trace_frames(frames, output_dir, params=None, workers=None, fmt=".fibrils", resume=True, hdu=0, progress=True,
+                 profile=False):
+    """
+    Trace many frames in parallel.
+
+    Parameters
+    ----------
+    frames : list
+        Paths to the FITS frames
+    output_dir : str
+        Directory to write one output per frame to. Frames from several directories keep their
+        directories below the one holding them all (see output_path).
+    params : dict
+        OCCULT-2 parameters passed to AutoTracing.run()
+    workers : int
+        Number of worker processes. Defaults to the number of cores available to us.
+    fmt : str
+        Output suffix: ".csv", or ".fibrils"/".npz" for a fibril store
+    resume : bool
+        Skip frames which already have an output
+    hdu : int or str
+        HDU containing the image in each frame
+    progress : bool
+        Print a line to stderr as each frame completes
+    profile : bool
+        Profile each frame in its worker, adding the stage records to this process' PROFILER
+
+    Returns
+    -------
+    dict
+        {frame: (number of features, number of coordinates, seconds)} for each traced frame.
+        Frames that failed are reported on stderr and left out.
+    """
+    params = dict(OCCULT_PARAMETERS, **(params or {}))
+    os.makedirs(output_dir, exist_ok=True)
+
+    todo = []
+    root = frames_root(frames) if frames else None
+    for frame in frames:
+        save_path = output_path(frame, output_dir, fmt, root)
+        if resume and os.path.exists(save_path):
+            continue
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        todo.append((frame, save_path))
+    if progress and len(todo) < len(frames):
+        print("Skipping {} completed frames".format(len(frames) - len(todo)), file=sys.stderr)
+
+    if workers is None:
+        # Respect any CPU affinity set by the job scheduler
+        workers = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(trace_frame, frame, save_path, params, hdu, profile=profile): frame
+                   for frame, save_path in todo}
+        for n, future in enumerate(as_completed(futures), start=1):
+            frame = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print("[{}/{}] {}: failed ({})".format(n, len(todo), frame, e), file=sys.stderr)
+                continue
+            if profile:
+                PROFILER.merge(result[3])
+            results[frame] = result[:3]
+            if progress:
+                print("[{}/{}] {}: {} features, {} coordinates ({:.1f} s)".format(
+                    n, len(todo), frame, *results[frame]), file=sys.stderr)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Trace many FITS frames with OCCULT-2 in parallel.")
+    parser.add_argument('frames', help='directory of .fits frames, or a (quoted) glob pattern')
+    parser.add_argument('output_dir', help='directory to write one output per frame to')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per core)')
+    parser.add_argument('--format', default=".fibrils", choices=[".fibrils", ".npz", ".csv"], help='output format')
+    parser.add_argument('--hdu', type=int, default=0, help='HDU containing the image')
+    parser.add_argument('--no-resume', action='store_true', help='re-trace frames which already have an output')
+    parser.add_argument('--profile', default=None, metavar='FILE', help='time each stage and write a JSON report to FILE')
+    for name, default in OCCULT_PARAMETERS.items():
+        parser.add_argument('--'+name, type=type(default), default=default, help='OCCULT-2 {} (default: {})'.format(name, default))
+    args = parser.parse_args()
+
+    frames = find_frames(args.frames)
+    if not frames:
+        sys.exit("No frames found")
+
+    params = {name: getattr(args, name) for name in OCCULT_PARAMETERS}
+    if args.profile:
+        # Stages run in the workers; this only times the whole batch
+        PROFILER.enable(trace_memory=False)
+    start = time.perf_counter()
+    results = trace_frames(frames, args.output_dir, params, args.workers, args.format, not args.no_resume, args.hdu,
+                           profile=bool(args.profile))
+    print("Traced {} frames in {:.1f} s".format(len(results), time.perf_counter() - start))
+    if args.profile:
+        PROFILER.write(args.profile)
+
+if __name__ == "__main__":
+    main()
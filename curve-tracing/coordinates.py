@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Fibril Coordinates
+@author: Parker Lamb
+@description: Columnar storage and loading of fibril coordinates. Used by every stage that reads
+OCCULT-2 .dat files or the comma-separated manual/characteristics .csv files.
+@usage: fibrils = read_coordinates("data/occult_results/occult_output.dat")
+"""
+
+import numpy as np
+
+# Size of the blocks files are parsed in, in bytes
+CHUNK_SIZE = 16*1024*1024
+
+class FibrilCoordinates:
+    def __init__(self, ids, offsets, lengths, x, y, extra=None):
+        """
+        Coordinates of a set of fibrils, stored as flat x/y arrays. The coordinates of fibril i
+        are x[offsets[i]:offsets[i]+lengths[i]] (and likewise for y).
+
+        Parameters
+        ----------
+        ids : numpy.ndarray
+            Fibril ID of each fibril
+        offsets : numpy.ndarray
+            Index of the first coordinate of each fibril in x and y
+        lengths : numpy.ndarray
+            Number of coordinates in each fibril
+        x : numpy.ndarray
+            x coordinates of all fibrils
+        y : numpy.ndarray
+            y coordinates of all fibrils
+        extra : numpy.ndarray
+            (n, k) array of any further per-coordinate columns read from the file
+        """
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        if extra is None:
+            extra = np.empty((self.x.size, 0))
+        self.extra = np.asarray(extra, dtype=np.float64)
+        if self.extra.ndim == 1:
+            self.extra = self.extra[:,None]
+
+    @classmethod
+    def from_arrays(cls, point_ids, x, y, extra=None):
+        """
+        Build from per-coordinate fibril IDs. Coordinates with the same fibril ID are grouped
+        together, in order of first appearance, keeping their relative order.
+        """
+        point_ids = np.asarray(point_ids).astype(np.int64)
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if point_ids.size == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return cls(empty, empty, empty, x, y, extra)
+
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(point_ids)) + 1))
+        if np.unique(point_ids[starts]).size != starts.size:
+            # Some fibril is split over several runs. Sort by order of first appearance.
+            _, first, inverse = np.unique(point_ids, return_index=True, return_inverse=True)
+            rank = np.empty(first.size, dtype=np.int64)
+            rank[np.argsort(first)] = np.arange(first.size)
+            order = np.argsort(rank[inverse.reshape(-1)], kind='stable')
+            point_ids = point_ids[order]
+            x = x[order]
+            y = y[order]
+            if extra is not None:
+                extra = np.asarray(extra)[order]
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(point_ids)) + 1))
+        lengths = np.diff(np.append(starts, point_ids.size))
+        return cls(point_ids[starts], starts, lengths, x, y, extra)
+
+    @classmethod
+    def from_features(cls, features, first_id=0):
+        """
+        Build from a list of features (lists of (x, y) coordinates), as returned by
+        AutoTracing.run(). Features are numbered consecutively from first_id.
+        """
+        lengths = np.array([len(feature) for feature in features], dtype=np.int64)
+        xy = np.concatenate([np.asarray(f, dtype=np.float64).reshape(-1, 2) for f in features]) \
+            if len(features) else np.empty((0, 2))
+        ids = np.arange(lengths.size, dtype=np.int64) + first_id
+        return cls(ids, np.cumsum(lengths) - lengths, lengths, xy[:,0], xy[:,1])
+
+    @classmethod
+    def concatenate(cls, fibril_sets, id_offsets=None):
+        """
+        Join several sets of fibrils into one, optionally adding an offset to the fibril IDs
+        of each set (i.e. to keep IDs from different sets unique).
+        """
+        if id_offsets is None:
+            id_offsets = [0]*len(fibril_sets)
+        lengths = np.concatenate([f.lengths for f in fibril_sets])
+        ncols = max([f.extra.shape[1] for f in fibril_sets], default=0)
+        extra = np.concatenate([f.extra for f in fibril_sets]) if ncols and \
+            all(f.extra.shape[1] == ncols for f in fibril_sets) else None
+        return cls(
+            np.concatenate([f.ids + offset for f, offset in zip(fibril_sets, id_offsets)]),
+            np.cumsum(lengths) - lengths,
+            lengths,
+            np.concatenate([f.x for f in fibril_sets]),
+            np.concatenate([f.y for f in fibril_sets]),
+            extra,
+        )
+
+    def subset(self, index):
+        """
+        Get a new set with only some of the fibrils.
+
+        Parameters
+        ----------
+        index : numpy.ndarray
+            Boolean mask over the fibrils, or positions of the fibrils to keep
+        """
+        index = np.arange(len(self))[index]
+        lengths = self.lengths[index]
+        points = np.repeat(self.offsets[index] - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        return FibrilCoordinates(self.ids[index], np.cumsum(lengths) - lengths, lengths,
+                                 self.x[points], self.y[points], self.extra[points])
+
+    @property
+    def point_ids(self):
+        """Fibril ID of every coordinate."""
+        return np.repeat(self.ids, self.lengths)
+
+    @property
+    def npoints(self):
+        """Total number of coordinates."""
+        return self.x.size
+
+    def __len__(self):
+        return self.ids.size
+
+    def __getitem__(self, i):
+        """(n, 2) array of [x, y] for the ith fibril."""
+        part = slice(self.offsets[i], self.offsets[i] + self.lengths[i])
+        return np.column_stack((self.x[part], self.y[part]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_array(self):
+        """(n, 3 + k) array of [fibril_id, x, y, extra columns...] for every coordinate."""
+        return np.column_stack((self.point_ids, self.x, self.y, self.extra))
+
+def read_coordinates(path, delimiter=None, chunk_size=CHUNK_SIZE):
+    """
+    Read a fibril coordinates file in a single pass.
+
+    The file is parsed in blocks of chunk_size bytes, so apart from the returned arrays, memory
+    use is bounded by the block size. A non-numeric header line is skipped.
+
+    Parameters
+    ----------
+    path : str
+        File with fibril ID, x and y as the first three columns (i.e. an OCCULT-2 .dat file, or
+        a manual coordinates or characteristics .csv)
+    delimiter : str
+        Column delimiter. By default commas and whitespace are both accepted.
+    chunk_size : int
+        Number of bytes to parse at once
+
+    Returns
+    -------
+    FibrilCoordinates
+        Coordinates grouped by fibril. Any columns after x and y are kept in extra.
+    """
+    sep = b"," if delimiter is None else delimiter.encode()
+    blocks = []
+    with open(path, 'rb') as f:
+        # Use the first line to find the number of columns, skipping it if it's a header
+        first = f.readline()
+        while first and not first.strip():
+            first = f.readline()
+        try:
+            ncols = len([float(field) for field in first.replace(sep, b" ").split()])
+            remainder = first
+        except ValueError:
+            remainder = f.readline()
+            ncols = len(remainder.replace(sep, b" ").split())
+
+        while True:
+            data = f.read(chunk_size)
+            block = remainder + data
+            if data:
+                # Only parse complete lines, keep the rest for the next block
+                cut = block.rfind(b"\n") + 1
+                block, remainder = block[:cut], block[cut:]
+            if block.strip():
+                values = np.fromstring(block.replace(sep, b" "), sep=" ")
+                if values.size % ncols:
+                    raise ValueError("Inconsistent number of columns in {}".format(path))
+                blocks.append(values.reshape(-1, ncols))
+            if not data:
+                break
+
+    if not blocks or ncols < 3:
+        return FibrilCoordinates.from_arrays([], [], [])
+    values = np.concatenate(blocks) if len(blocks) > 1 else blocks[0]
+    del blocks
+    return FibrilCoordinates.from_arrays(values[:,0], values[:,1], values[:,2], values[:,3:])
@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Fibril Store
+@author: Parker Lamb
+@description: Binary, columnar storage of per-coordinate fibril data, as an alternative to the .csv
+outputs of tracing and characterization. A store is either a directory of .npy files (one per
+column, which can be memory-mapped) or a single, optionally compressed, .npz file.
+@usage: write_store("characteristics.fibrils", table); store = open_store("characteristics.fibrils")
+"""
+
+import os
+import shutil
+import numpy as np
+from coordinates import FibrilCoordinates
+
+# Suffixes recognized as stores by is_store_path. Anything else is treated as text.
+STORE_SUFFIXES = (".fibrils", ".npz")
+
+# Arrays stored alongside the columns: the per-fibril index and the column order
+INDEX_ARRAYS = ("ids", "offsets", "lengths", "columns")
+
+def is_store_path(path):
+    """
+    Whether a path names a fibril store (a .fibrils directory or .npz file) rather than a .csv.
+    """
+    return str(path).rstrip("/").endswith(STORE_SUFFIXES)
+
+def write_store(path, data, compress=True):
+    """
+    Write per-coordinate fibril data to a store.
+
+    The store is written next to its final location and then moved into place, so an existing
+    store at path is never left half-written.
+
+    Parameters
+    ----------
+    path : str
+        Path ending in .npz for a single file, or any other path (conventionally ending in .fibrils)
+        for a directory of memory-mappable .npy files
+    data : numpy.ndarray or FibrilCoordinates
+        Structured array with a fibril_id field (i.e. the output of characterize()), with the
+        coordinates of each fibril grouped together, or fibril coordinates. Any extra columns of
+        fibril coordinates are stored as extra_0, extra_1, ..., and come back in extra from
+        FibrilStore.coordinates().
+    compress : bool
+        Compress the columns. Only applies to .npz stores.
+    """
+    if isinstance(data, FibrilCoordinates):
+        columns = {"x": data.x, "y": data.y}
+        columns.update(("extra_{}".format(i), data.extra[:,i]) for i in range(data.extra.shape[1]))
+        fibrils = data
+    else:
+        columns = {name: data[name] for name in data.dtype.names if name != "fibril_id"}
+        fibrils = FibrilCoordinates.from_arrays(data["fibril_id"], data["x"], data["y"])
+        if fibrils.npoints and not np.array_equal(fibrils.point_ids, data["fibril_id"]):
+            raise ValueError("Coordinates of each fibril must be grouped together")
+    arrays = {"ids": fibrils.ids, "offsets": fibrils.offsets, "lengths": fibrils.lengths,
+              "columns": np.array(list(columns))}
+    arrays.update(columns)
+
+    path = str(path).rstrip("/")
+    tmp_path = path + ".tmp"
+    if path.endswith(".npz"):
+        with open(tmp_path, "wb") as f:
+            if compress:
+                np.savez_compressed(f, **arrays)
+            else:
+                np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    else:
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name, values in arrays.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), np.ascontiguousarray(values))
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+
+class FibrilStore:
+    def __init__(self, path):
+        """
+        Read access to a fibril store. Columns are only loaded when first accessed, and are
+        memory-mapped for directory stores.
+
+        Parameters
+        ----------
+        path : str
+            Path to a store written by write_store
+        """
+        self.path = str(path).rstrip("/")
+        self._columns = {}
+        self._npz = None if os.path.isdir(self.path) else np.load(self.path)
+        self.ids = self._load("ids")
+        self.offsets = self._load("offsets")
+        self.lengths = self._load("lengths")
+        self.columns = ["fibril_id"] + [str(name) for name in self._load("columns")]
+        # Position of each fibril ID, for per-fibril access
+        self._order = np.argsort(self.ids, kind='stable')
+
+    def _load(self, name):
+        if name not in self._columns:
+            if self._npz is None:
+                self._columns[name] = np.load(os.path.join(self.path, name + ".npy"), mmap_mode='r')
+            else:
+                self._columns[name] = self._npz[name]
+        return self._columns[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Release all loaded columns and any open file."""
+        self._columns = {}
+        if self._npz is not None:
+            self._npz.close()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, name):
+        """All values of a column, for every coordinate."""
+        if name == "fibril_id":
+            return np.repeat(self.ids, self.lengths)
+        if name not in self.columns:
+            raise KeyError(name)
+        return self._load(name)
+
+    def fibril(self, fibril_id, columns=None):
+        """
+        Get the data of a single fibril, reading only its rows.
+
+        Parameters
+        ----------
+        fibril_id : int
+            ID of the fibril
+        columns : list
+            Columns to include. Defaults to all columns.
+
+        Returns
+        -------
+        numpy.ndarray
+            Structured array with one row per coordinate of the fibril
+        """
+        pos = np.searchsorted(self.ids, fibril_id, sorter=self._order)
+        if pos == len(self.ids) or self.ids[self._order[pos]] != fibril_id:
+            raise KeyError(fibril_id)
+        i = self._order[pos]
+        part = slice(self.offsets[i], self.offsets[i] + self.lengths[i])
+        return self._table(columns, part, np.full(self.lengths[i], fibril_id))
+
+    def table(self, columns=None):
+        """
+        Get the whole store as a structured array (i.e. as returned by characterize()).
+        """
+        return self._table(columns, slice(None), np.repeat(self.ids, self.lengths))
+
+    def chunks(self, chunk_rows, columns=None):
+        """
+        Iterate over the store as structured arrays of up to chunk_rows consecutive rows, so
+        only one chunk of a memory-mapped store is read into memory at a time.
+        """
+        total = int(self.lengths.sum())
+        for start in range(0, total, chunk_rows):
+            part = slice(start, min(start + chunk_rows, total))
+            owner = np.searchsorted(self.offsets, np.arange(part.start, part.stop), side='right') - 1
+            yield self._table(columns, part, self.ids[owner])
+
+    def _table(self, columns, part, fibril_ids):
+        columns = self.columns if columns is None else columns
+        dtype = [(name, np.int64 if name == "fibril_id" else self._load(name).dtype) for name in columns]
+        table = np.empty(len(fibril_ids), dtype=dtype)
+        for name in columns:
+            table[name] = fibril_ids if name == "fibril_id" else self._load(name)[part]
+        return table
+
+    def coordinates(self):
+        """
+        Get the fibril coordinates, with any other columns in extra (in store column order).
+        """
+        others = [name for name in self.columns if name not in ("fibril_id", "x", "y")]
+        extra = np.column_stack([self._load(name) for name in others]) if others else None
+        return FibrilCoordinates(self.ids, self.offsets, self.lengths, self["x"], self["y"], extra)
+
+def open_store(path):
+    """
+    Open a fibril store for reading. See FibrilStore.
+    """
+    return FibrilStore(path)
@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: FITS Images
+@author: Parker Lamb
+@description: Memory-mapped, lazily sliced access to FITS images. Only the requested HDU, plane and
+region of interest are read into memory, and files are closed as soon as we're done with them.
+@usage: with FitsImage(path) as image: data = image.read(roi=(0, 512, 0, 512))
+"""
+
+import os
+import numpy as np
+
+# Co-aligned Halpha and white light maps, named as in data/images/fits/
+MAP_FILES = {
+    "coreint": "halpha_coreint_{}.fits",
+    "vel": "halpha_vel_{}.fits",
+    "width": "halpha_width_{}.fits",
+    "wingint": "halpha_wingint_{}.fits",
+    "wl": "wl_{}.fits",
+}
+
+def region(roi):
+    """
+    Convert a region of interest into a tuple of (row, column) slices.
+
+    Parameters
+    ----------
+    roi : tuple
+        (y0, y1, x0, x1) pixel bounds, a tuple of two slices, or None for the whole image
+    """
+    if roi is None:
+        return (slice(None), slice(None))
+    if len(roi) == 2:
+        return tuple(roi)
+    y0, y1, x0, x1 = roi
+    return (slice(y0, y1), slice(x0, x1))
+
+class FitsImage:
+    def __init__(self, path, hdu=0, memmap=True):
+        """
+        A single image in a FITS file. The file is opened on first access, and closed by close()
+        or when used as a context manager.
+
+        Parameters
+        ----------
+        path : str
+            Path to the .fits file
+        hdu : int or str
+            HDU containing the image
+        memmap : bool
+            Memory-map the data rather than reading the whole HDU
+        """
+        if ".fits" not in path:
+            raise Exception("Did not detect .fits extension in image path.")
+        self.path = path
+        self.hdu = hdu
+        self.memmap = memmap
+        self._hdul = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        """Open the file, if it isn't already open."""
+        if self._hdul is None:
+            # astropy takes a while to import, so it's only imported once a file is opened
+            from astropy.io import fits
+
+            self._hdul = fits.open(self.path, memmap=self.memmap, ignore_missing_end=True)
+        return self
+
+    def close(self):
+        """Close the file. Arrays returned by read() stay valid."""
+        if self._hdul is not None:
+            self._hdul.close()
+            self._hdul = None
+
+    @property
+    def header(self):
+        return self.open()._hdul[self.hdu].header
+
+    @property
+    def data(self):
+        """The (memory-mapped) data of the HDU. Only valid while the file is open."""
+        return self.open()._hdul[self.hdu].data
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def nplanes(self):
+        """Number of image planes, for data cubes. Single images have one plane."""
+        shape = self.shape
+        return int(np.prod(shape[:-2])) if len(shape) > 2 else 1
+
+    def read(self, roi=None, plane=None):
+        """
+        Read part of the image into memory.
+
+        Parameters
+        ----------
+        roi : tuple
+            (y0, y1, x0, x1) pixel bounds or a tuple of two slices. Defaults to the whole image.
+        plane : int
+            Plane of a data cube to read. Required if the HDU has more than two dimensions.
+
+        Returns
+        -------
+        numpy.ndarray
+            Copy of the selected data, in native byte order
+        """
+        data = self.data
+        if data.ndim > 2:
+            if plane is None:
+                raise ValueError("{} is a data cube, choose a plane to read".format(self.path))
+            data = data.reshape((-1,) + data.shape[-2:])[plane]
+        elif plane not in (None, 0):
+            raise IndexError("{} only has a single plane".format(self.path))
+        data = data[region(roi)]
+        return np.array(data, dtype=data.dtype.newbyteorder('='))
+
+class FitsMaps:
+    def __init__(self, paths, hdu=0, memmap=True):
+        """
+        A set of co-aligned maps (i.e. the *_mfbd_m300.fits files), kept open together so a
+        region or plane can be read from all of them at once.
+
+        Parameters
+        ----------
+        paths : dict
+            Paths to the .fits file of each map, keyed by map name
+        hdu : int or str
+            HDU containing the image in each file
+        memmap : bool
+            Memory-map the data rather than reading the whole HDU
+        """
+        self.images = {name: FitsImage(path, hdu, memmap) for name, path in paths.items()}
+
+    @classmethod
+    def from_directory(cls, directory, suffix="mfbd_m300", names=None, **kwargs):
+        """
+        Find the maps in a directory, named as in MAP_FILES (i.e. halpha_coreint_mfbd_m300.fits).
+        Maps without a file are skipped, unless explicitly requested in names.
+        """
+        paths = {name: os.path.join(directory, MAP_FILES[name].format(suffix))
+                 for name in (MAP_FILES if names is None else names)}
+        if names is None:
+            paths = {name: path for name, path in paths.items() if os.path.exists(path)}
+        return cls(paths, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getitem__(self, name):
+        return self.images[name]
+
+    def __iter__(self):
+        return iter(self.images)
+
+    def close(self):
+        """Close every map."""
+        for image in self.images.values():
+            image.close()
+
+    def read(self, roi=None, plane=None, names=None):
+        """
+        Read the same region and plane from several maps. See FitsImage.read.
+
+        Returns
+        -------
+        dict
+            Array per map, keyed by map name
+        """
+        names = self.images if names is None else names
+        return {name: self.images[name].read(roi, plane) for name in names}
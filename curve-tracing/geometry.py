@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Fibril Geometry
+@author: Parker Lamb
+@description: Shape metrics of fibrils, computed for every fibril at once over the flat coordinate
+arrays of a FibrilCoordinates: arc length, cumulative arc length, unit tangents and normals,
+curvature, mean orientation and bounding boxes. Shared by the tracing sessions (lengths), the
+breadth calculation (normals) and the characterization output.
+@usage: geometry = FibrilGeometry(read_coordinates("data/occult_results/occult_output.dat")); geometry.fibrils()
+"""
+
+import numpy as np
+
+# Per-coordinate geometry, in the order of the coordinates
+POINT_GEOMETRY_DTYPE = np.dtype([
+    ('fibril_id', np.int64),
+    ('x', np.float64),
+    ('y', np.float64),
+    ('arc_length', np.float64),
+    ('tangent_x', np.float64),
+    ('tangent_y', np.float64),
+    ('normal_x', np.float64),
+    ('normal_y', np.float64),
+    ('curvature', np.float64),
+])
+
+# Per-fibril geometry, in the order of the fibrils
+FIBRIL_GEOMETRY_DTYPE = np.dtype([
+    ('fibril_id', np.int64),
+    ('points', np.int64),
+    ('length', np.float64),
+    ('orientation', np.float64),
+    ('mean_curvature', np.float64),
+    ('xmin', np.float64),
+    ('xmax', np.float64),
+    ('ymin', np.float64),
+    ('ymax', np.float64),
+])
+
+def point_fibrils(lengths):
+    """
+    Position of the fibril each coordinate belongs to, and the first and last coordinate of that
+    fibril, for fibrils stored one after another.
+
+    Returns
+    -------
+    tuple
+        (fibril, first, last), each with one entry per coordinate
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    fibril = np.repeat(np.arange(lengths.size), lengths)
+    first = (np.cumsum(lengths) - lengths)[fibril]
+    return fibril, first, first + lengths[fibril] - 1
+
+def segment_lengths(x, y, lengths):
+    """
+    Distance from each coordinate to the previous one in its fibril, 0 for the first.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Flat array of x coordinates for all fibrils, fibril after fibril
+    y : numpy.ndarray
+        Flat array of y coordinates, same layout as x
+    lengths : numpy.ndarray
+        Number of coordinates in each fibril, in the order they appear in x and y
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    steps = np.zeros(x.size)
+    if x.size > 1:
+        steps[1:] = np.hypot(np.diff(x), np.diff(y))
+        # Steps from the last point of one fibril to the first of the next don't count
+        starts = (np.cumsum(lengths) - lengths)[np.asarray(lengths) > 0]
+        steps[starts] = 0
+    return steps
+
+def path_lengths(x, y, lengths):
+    """Length of each fibril along its coordinates, in pixels (see segment_lengths)."""
+    fibril = np.repeat(np.arange(np.size(lengths)), lengths)
+    return np.bincount(fibril, weights=segment_lengths(x, y, lengths), minlength=np.size(lengths))
+
+def tangents(x, y, lengths):
+    """
+    Unit tangent and normal of each coordinate.
+
+    The tangent is taken between the previous and next coordinate in the same fibril (clamped at
+    the fibril ends), and the normal is the tangent turned a quarter clockwise, [ty, -tx].
+    Coordinates without a defined tangent (single-point fibrils, or equal neighbours) get zero
+    vectors.
+
+    Returns
+    -------
+    tuple
+        ((n, 2) array of [x, y] tangents, (n, 2) array of [x, y] normals)
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    _, first, last = point_fibrils(lengths)
+    index = np.arange(x.size)
+    nextcoord = np.minimum(index + 1, last)
+    prevcoord = np.maximum(index - 1, first)
+
+    dx = x[nextcoord] - x[prevcoord]
+    dy = y[nextcoord] - y[prevcoord]
+    mag = np.hypot(dx, dy)
+    valid = mag > 0
+    tangent = np.zeros((x.size, 2))
+    tangent[valid,0] = dx[valid]/mag[valid]
+    tangent[valid,1] = dy[valid]/mag[valid]
+    normal = np.zeros((x.size, 2))
+    normal[:,0] = tangent[:,1]
+    normal[:,1] = -tangent[:,0]
+    return tangent, normal
+
+def curvatures(x, y, lengths):
+    """
+    Signed curvature at each coordinate, in 1/pixels, of the circle through it and its two
+    neighbours: positive where the fibril turns anticlockwise (with y up). NaN at fibril ends and
+    where neighbours coincide.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    _, first, last = point_fibrils(lengths)
+    curvature = np.full(x.size, np.nan)
+    inner = np.flatnonzero((np.arange(x.size) > first) & (np.arange(x.size) < last))
+    if inner.size == 0:
+        return curvature
+    ax = x[inner] - x[inner-1]
+    ay = y[inner] - y[inner-1]
+    bx = x[inner+1] - x[inner]
+    by = y[inner+1] - y[inner]
+    denominator = np.hypot(ax, ay)*np.hypot(bx, by)*np.hypot(ax + bx, ay + by)
+    valid = denominator > 0
+    curvature[inner[valid]] = 2*(ax*by - ay*bx)[valid]/denominator[valid]
+    return curvature
+
+class FibrilGeometry:
+    def __init__(self, coords):
+        """
+        Geometry of every coordinate and fibril of a set of fibrils, computed in one pass.
+
+        Parameters
+        ----------
+        coords : FibrilCoordinates
+            Fibrils, with the coordinates of each stored one after another (as read_coordinates
+            and from_arrays give them)
+
+        Attributes
+        ----------
+        arc_length : numpy.ndarray
+            Distance along its fibril from the first coordinate to each coordinate
+        tangent, normal : numpy.ndarray
+            (n, 2) unit [x, y] tangent and normal of each coordinate (see tangents)
+        curvature : numpy.ndarray
+            Signed curvature of each coordinate (see curvatures)
+        length : numpy.ndarray
+            Length of each fibril along its coordinates
+        orientation : numpy.ndarray
+            Mean direction of each fibril, in degrees anticlockwise from the x axis in [0, 180),
+            weighting each segment by its length. NaN for fibrils of no length.
+        mean_curvature : numpy.ndarray
+            Mean absolute curvature of each fibril, NaN if it's nowhere defined
+        bbox : numpy.ndarray
+            (k, 4) array of [xmin, xmax, ymin, ymax] of each fibril, NaN for empty fibrils
+        """
+        self.ids = coords.ids
+        self.lengths = coords.lengths
+        self.point_ids = coords.point_ids
+        self.x = coords.x
+        self.y = coords.y
+        x, y, lengths = coords.x, coords.y, coords.lengths
+        nfibrils = lengths.size
+        fibril, first, _ = point_fibrils(lengths)
+
+        steps = segment_lengths(x, y, lengths)
+        self.length = np.bincount(fibril, weights=steps, minlength=nfibrils)
+        # First coordinates have no step, so the running total at each is its fibril's offset
+        total = np.cumsum(steps)
+        self.arc_length = total - total[first]
+        self.tangent, self.normal = tangents(x, y, lengths)
+        self.curvature = curvatures(x, y, lengths)
+
+        # Fibrils have no direction, so segment angles are averaged doubled: weighted by its
+        # length l, a segment at angle t adds l*(cos 2t, sin 2t) = ((dx^2 - dy^2)/l, 2*dx*dy/l)
+        dx = np.zeros(x.size)
+        dy = np.zeros(x.size)
+        dx[1:] = np.diff(x)
+        dy[1:] = np.diff(y)
+        moving = steps > 0
+        cos2 = np.bincount(fibril[moving], weights=(dx**2 - dy**2)[moving]/steps[moving], minlength=nfibrils)
+        sin2 = np.bincount(fibril[moving], weights=2*(dx*dy)[moving]/steps[moving], minlength=nfibrils)
+        self.orientation = np.where(self.length > 0, np.degrees(np.arctan2(sin2, cos2)/2) % 180, np.nan)
+
+        defined = np.isfinite(self.curvature)
+        count = np.bincount(fibril[defined], minlength=nfibrils)
+        total_curvature = np.bincount(fibril[defined], weights=np.abs(self.curvature[defined]), minlength=nfibrils)
+        self.mean_curvature = np.full(nfibrils, np.nan)
+        np.divide(total_curvature, count, out=self.mean_curvature, where=count > 0)
+
+        self.bbox = np.full((nfibrils, 4), np.nan)
+        nonempty = lengths > 0
+        if nonempty.any():
+            starts = (np.cumsum(lengths) - lengths)[nonempty]
+            self.bbox[nonempty] = np.column_stack((np.minimum.reduceat(x, starts), np.maximum.reduceat(x, starts),
+                                                   np.minimum.reduceat(y, starts), np.maximum.reduceat(y, starts)))
+
+    def __len__(self):
+        return self.ids.size
+
+    def points(self):
+        """Structured array of POINT_GEOMETRY_DTYPE, one row per coordinate."""
+        table = np.empty(self.x.size, dtype=POINT_GEOMETRY_DTYPE)
+        table['fibril_id'] = self.point_ids
+        table['x'] = self.x
+        table['y'] = self.y
+        table['arc_length'] = self.arc_length
+        table['tangent_x'], table['tangent_y'] = self.tangent.T
+        table['normal_x'], table['normal_y'] = self.normal.T
+        table['curvature'] = self.curvature
+        return table
+
+    def fibrils(self):
+        """Structured array of FIBRIL_GEOMETRY_DTYPE, one row per fibril."""
+        table = np.empty(len(self), dtype=FIBRIL_GEOMETRY_DTYPE)
+        table['fibril_id'] = self.ids
+        table['points'] = self.lengths
+        table['length'] = self.length
+        table['orientation'] = self.orientation
+        table['mean_curvature'] = self.mean_curvature
+        table['xmin'], table['xmax'], table['ymin'], table['ymax'] = self.bbox.T
+        return table
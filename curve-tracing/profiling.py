@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Profiling
+@author: Parker Lamb
+@description: Optional instrumentation of the tracing and characterization stages. Each stage
+records its wall time, peak (Python and NumPy) memory and the number of points and fibrils it
+handled, and a run can be written out as a JSON report. Profiling is off unless enabled, in which
+case stages cost next to nothing.
+@usage: PROFILER.enable(); with stage("edge_map"): ...; PROFILER.write("profile.json")
+"""
+
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+class StageRecord:
+    def __init__(self):
+        """Totals for one stage, over every time it ran."""
+        self.calls = 0
+        self.seconds = 0.0
+        self.peak_bytes = 0
+        self.counts = {}
+
+    def add(self, **counts):
+        """Add to the counters of the stage, i.e. add(points=n, fibrils=m)."""
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + int(value)
+
+    def merge(self, other):
+        """Add the totals of another record (i.e. from a worker process) of the same stage."""
+        self.calls += other["calls"]
+        self.seconds += other["seconds"]
+        self.peak_bytes = max(self.peak_bytes, other["peak_bytes"])
+        self.add(**other["counts"])
+
+    def report(self):
+        report = {
+            "calls": self.calls,
+            "seconds": self.seconds,
+            "peak_bytes": self.peak_bytes,
+            "counts": dict(self.counts),
+        }
+        # Throughput of every counter
+        for name, value in self.counts.items():
+            report["{}_per_second".format(name)] = value/self.seconds if self.seconds > 0 else None
+        return report
+
+class Profiler:
+    def __init__(self):
+        """
+        Collects stage records. Use the module-level PROFILER rather than making another.
+        """
+        self.enabled = False
+        self.trace_memory = False
+        self.stages = {}
+        self._peaks = []
+        self._start = None
+
+    def enable(self, trace_memory=True):
+        """
+        Start profiling. Tracing memory (with tracemalloc) slows down Python allocations
+        somewhat, but not NumPy array operations.
+        """
+        self.enabled = True
+        self.trace_memory = trace_memory
+        self._start = time.perf_counter()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        """Stop profiling, keeping the records so far."""
+        self.enabled = False
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def reset(self):
+        """Forget all stage records, i.e. between the frames handled by a worker process."""
+        self.stages = {}
+
+    def record(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageRecord()
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name, **counts):
+        """
+        Time a stage, with any counters known up front (see StageRecord.add). Yields the stage
+        record, to add counters known only at the end. Stages can be nested; the peak memory
+        of a stage includes that of the stages inside it. Memory is only followed for stages
+        in the main thread, as tracemalloc keeps a single peak for the whole process.
+        """
+        if not self.enabled:
+            yield StageRecord()
+            return
+        record = self.record(name)
+        record.add(**counts)
+        trace_memory = self.trace_memory and threading.current_thread() is threading.main_thread()
+        if trace_memory:
+            # tracemalloc has a single peak, so fold it into the enclosing stages before resetting
+            current, peak = tracemalloc.get_traced_memory()
+            self._peaks = [max(p, peak) for p in self._peaks]
+            tracemalloc.reset_peak()
+            self._peaks.append(current)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.calls += 1
+            record.seconds += time.perf_counter() - start
+            if trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                stage_peak = max(self._peaks.pop(), peak)
+                self._peaks = [max(p, stage_peak) for p in self._peaks]
+                record.peak_bytes = max(record.peak_bytes, stage_peak)
+
+    def merge(self, stages):
+        """Add stage records reported by another process (the "stages" of report())."""
+        for name, other in stages.items():
+            self.record(name).merge(other)
+
+    def report(self):
+        """
+        The run so far as a dictionary: when and where it ran, total wall time, maximum resident
+        memory, and the record of every stage.
+        """
+        report = {
+            "command": sys.argv,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "host": platform.node(),
+            "cpus": len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count(),
+            "python": platform.python_version(),
+            "seconds": time.perf_counter() - self._start if self._start is not None else 0.0,
+            "max_rss_bytes": max_rss_bytes(),
+            "stages": {name: record.report() for name, record in self.stages.items()},
+        }
+        return report
+
+    def write(self, path):
+        """Write the report as JSON."""
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+def max_rss_bytes():
+    """Largest resident memory of this process so far, if available."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss*1024
+
+# The profiler of this process
+PROFILER = Profiler()
+
+def stage(name, **counts):
+    """Time a stage with the process profiler. See Profiler.stage."""
+    return PROFILER.stage(name, **counts)
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Save File Arrays
+@author: Parker Lamb
+@description: Converts IDL .sav files (i.e. the Halpha maps) into a directory of .npy files next to
+them, one per variable, in native byte order, so they can be memory-mapped instead of parsing the
+whole save file on every run. read_sav() reads a .sav file through its conversion when there's an
+up-to-date one, and with scipy's readsav otherwise, so loaders can use it either way. Many files are
+converted in parallel.
+@usage: "python sav_arrays.py <.sav files or (quoted) globs...> [--variables halpha_width ...] [--workers N]"
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+# Suffix of the directory a .sav file is converted into
+ARRAYS_SUFFIX = ".arrays"
+
+# Description of the converted variables and the .sav file they came from
+INDEX_FILE = "index.json"
+
+def arrays_path(sav_file):
+    """Directory a .sav file is converted into: <name>.arrays next to <name>.sav."""
+    return os.path.splitext(sav_file)[0] + ARRAYS_SUFFIX
+
+def source_stamp(sav_file):
+    """Size and modification time of a .sav file, to tell whether a conversion is up to date."""
+    stat = os.stat(sav_file)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def read_index(sav_file):
+    """
+    Index of an up-to-date conversion of a .sav file.
+
+    Returns
+    -------
+    dict
+        {"source": stamp, "variables": {name: {"shape", "dtype"}}, "skipped": [names], "complete":
+        whether every variable was converted (or skipped)}, or None if the file isn't converted, or
+        was changed after it was
+    """
+    try:
+        with open(os.path.join(arrays_path(sav_file), INDEX_FILE)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return index if index.get("source") == source_stamp(sav_file) else None
+
+def convert(sav_file, variables=None, overwrite=False):
+    """
+    Convert the numeric array variables of a .sav file into <name>.arrays/<variable>.npy.
+
+    Parameters
+    ----------
+    sav_file : str
+        IDL .sav file
+    variables : list
+        Variables to convert (lower case, as readsav names them). Defaults to all numeric ones.
+    overwrite : bool
+        Convert again even if there's an up-to-date conversion
+
+    Returns
+    -------
+    dict
+        Index of the conversion (see read_index)
+    """
+    from scipy.io import readsav
+
+    if not overwrite:
+        index = read_index(sav_file)
+        if index is not None and (index["complete"] if variables is None else
+                                  {name.lower() for name in variables} <= set(index["variables"])):
+            return index
+
+    stamp = source_stamp(sav_file)
+    sav = readsav(sav_file)
+    names = list(sav.keys()) if variables is None else [name.lower() for name in variables]
+    missing = [name for name in names if name not in sav]
+    if missing:
+        raise KeyError("{} not in {}".format(", ".join(missing), sav_file))
+
+    # Written under a temporary name and moved into place, so readers never see a partial conversion
+    output = arrays_path(sav_file)
+    partial = "{}.{}.tmp".format(output, os.getpid())
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    index = {"source": stamp, "variables": {}, "skipped": [], "complete": variables is None}
+    try:
+        for name in names:
+            value = np.asarray(sav[name])
+            # Structures, strings and pointers stay in the .sav file
+            if value.dtype.kind not in "biufc":
+                index["skipped"].append(name)
+                continue
+            # IDL arrays are big-endian; native order makes memory-mapped reads zero-copy
+            value = np.ascontiguousarray(value, dtype=value.dtype.newbyteorder("="))
+            np.save(os.path.join(partial, name + ".npy"), value, allow_pickle=False)
+            index["variables"][name] = {"shape": list(value.shape), "dtype": value.dtype.str}
+        with open(os.path.join(partial, INDEX_FILE), "w") as f:
+            json.dump(index, f, indent=1)
+        shutil.rmtree(output, ignore_errors=True)
+        os.rename(partial, output)
+    except Exception:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    return index
+
+def read_sav(sav_file, variables=None, mmap=True):
+    """
+    Read variables of a .sav file, from its conversion if it has an up-to-date one.
+
+    Parameters
+    ----------
+    sav_file : str
+        IDL .sav file
+    variables : list
+        Variables to read. Defaults to all of them.
+    mmap : bool
+        Memory-map converted arrays (read-only) rather than reading them into memory
+
+    Returns
+    -------
+    dict
+        {variable: value}, with lower case names as readsav gives them
+    """
+    index = read_index(sav_file)
+    names = None if variables is None else [name.lower() for name in variables]
+    if index is not None:
+        # Without a list of variables, all of them have to be in the conversion
+        complete = index["complete"] and not index["skipped"]
+        wanted = names if names is not None else (list(index["variables"]) if complete else None)
+        if wanted is not None and set(wanted) <= set(index["variables"]):
+            directory = arrays_path(sav_file)
+            return {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode="r" if mmap else None,
+                                  allow_pickle=False)
+                    for name in wanted}
+
+    from scipy.io import readsav
+
+    sav = readsav(sav_file)
+    return dict(sav) if names is None else {name: sav[name] for name in names}
+
+def convert_file(sav_file, variables=None, overwrite=False):
+    """Convert one file, returning (number of variables converted, seconds). For worker processes."""
+    start = time.perf_counter()
+    index = convert(sav_file, variables, overwrite)
+    return len(index["variables"]), time.perf_counter() - start
+
+def convert_many(sav_files, variables=None, overwrite=False, workers=None, progress=True):
+    """
+    Convert many .sav files in parallel.
+
+    Parameters
+    ----------
+    sav_files : list
+        Paths to the .sav files
+    variables : list
+        Variables to convert. Defaults to all numeric ones.
+    overwrite : bool
+        Convert files that already have an up-to-date conversion
+    workers : int
+        Number of worker processes. Defaults to the number of cores available to us.
+    progress : bool
+        Print a line to stderr as each file completes
+
+    Returns
+    -------
+    dict
+        {sav_file: (number of variables converted, seconds)} for each converted file. Files that
+        failed are reported on stderr and left out.
+    """
+    if workers is None:
+        # Respect any CPU affinity set by the job scheduler
+        workers = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(sav_files)))) as pool:
+        futures = {pool.submit(convert_file, sav_file, variables, overwrite): sav_file for sav_file in sav_files}
+        for n, future in enumerate(as_completed(futures), start=1):
+            sav_file = futures[future]
+            try:
+                results[sav_file] = future.result()
+            except Exception as e:
+                print("[{}/{}] {}: failed ({})".format(n, len(sav_files), sav_file, e), file=sys.stderr)
+                continue
+            if progress:
+                print("[{}/{}] {}: {} variables ({:.1f} s)".format(n, len(sav_files), sav_file, *results[sav_file]),
+                      file=sys.stderr)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert IDL .sav files to memory-mappable .npy arrays.")
+    parser.add_argument('sav_files', nargs='+', help='.sav files, or (quoted) glob patterns')
+    parser.add_argument('--variables', nargs='+', default=None, help='variables to convert (default: all numeric ones)')
+    parser.add_argument('--overwrite', action='store_true', help='convert files which already have an up-to-date conversion')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all available cores)')
+    args = parser.parse_args()
+
+    sav_files = []
+    for pattern in args.sav_files:
+        sav_files.extend(sorted(glob.glob(pattern)) or [pattern])
+    results = convert_many(sav_files, args.variables, args.overwrite, args.workers)
+    if len(results) < len(sav_files):
+        sys.exit("{} of {} files failed".format(len(sav_files) - len(results), len(sav_files)))
+
+if __name__ == "__main__":
+    main()
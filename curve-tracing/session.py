@@ -0,0 +1,327 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Tracing Sessions
+@author: Parker Lamb
+@description: Incremental storage of manually traced fibrils. Completed fibrils are appended to the
+coordinates .csv (fibril ID, x, y) and their lengths to the characteristics .csv (Loop Number,
+Length (px)), so saving never rewrites what's already on disk. Lengths are kept as running totals
+while a fibril is traced. Saving can happen in a background thread, so the tracing window never
+waits on the disk, and sessions of thousands of fibrils reload in one pass over the file.
+@usage: with Session("coordinates.csv", "characteristics.csv", autosave=5) as session: session.add_point(x, y); session.finish()
+"""
+
+import csv
+import io
+import os
+import threading
+import numpy as np
+
+from coordinates import FibrilCoordinates, read_coordinates
+from geometry import path_lengths
+
+CHARACTERISTICS_HEADER = ["Loop Number", "Length (px)"]
+
+# Seconds between background saves in the tracing tools
+DEFAULT_AUTOSAVE = 10.0
+
+def fibril_path_lengths(fibrils):
+    """
+    Length of each fibril along its coordinates, in pixels.
+
+    Parameters
+    ----------
+    fibrils : FibrilCoordinates
+        Fibrils to measure
+
+    Returns
+    -------
+    numpy.ndarray
+        Length of each fibril
+    """
+    return path_lengths(fibrils.x, fibrils.y, fibrils.lengths)
+
+def as_coordinates(fibrils):
+    """FibrilCoordinates of a list of (fibril ID, (n, 2) array) pairs."""
+    coords = FibrilCoordinates.from_features([xy for _, xy in fibrils])
+    coords.ids[:] = [fibril_id for fibril_id, _ in fibrils]
+    return coords
+
+def characteristics_path(coordinate_file):
+    """
+    Characteristics file kept alongside a coordinates file: coordinates-<name>.csv gets
+    characteristics-<name>.csv (as the archive tracing script names them), and any other
+    <name>.csv gets <name>-characteristics.csv.
+    """
+    directory, name = os.path.split(coordinate_file)
+    stem = os.path.splitext(name)[0]
+    if stem.startswith("coordinates-"):
+        return os.path.join(directory, "characteristics-" + stem[len("coordinates-"):] + ".csv")
+    return os.path.join(directory, stem + "-characteristics.csv")
+
+def is_coordinates_file(path):
+    """
+    Whether a session can append to path: it doesn't exist yet, is empty, or has exactly the
+    fibril ID, x and y columns of a coordinates .csv (and not, i.e., a characterization output).
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return True
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if row:
+                return len(row) == 3
+    return True
+
+def repair(path):
+    """
+    Cut off a partly written last line (i.e. after a crash while saving), so the file can be
+    read and appended to.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+        # Find the end of the last complete line
+        block = min(size, 1 << 16)
+        while True:
+            f.seek(size - block)
+            cut = f.read(block).rfind(b"\n")
+            if cut >= 0 or block == size:
+                break
+            block = min(size, block*2)
+        f.truncate(size - block + cut + 1 if cut >= 0 else 0)
+
+def append(path, text):
+    """
+    Append text to a file in a single write. If the write fails, the file is cut back to its
+    previous size, so a retry doesn't repeat lines that made it to the disk.
+    """
+    data = memoryview(text.encode())
+    # Unbuffered, so nothing is left to be written after the file is cut back
+    with open(path, "ab", buffering=0) as f:
+        start = f.seek(0, os.SEEK_END)
+        try:
+            while data:
+                data = data[f.write(data):]
+        except Exception:
+            f.truncate(start)
+            raise
+
+class Session:
+    def __init__(self, coordinate_file, characteristics_file=None, autosave=None):
+        """
+        A manual tracing session, stored in a coordinates .csv and optionally a characteristics
+        .csv. Fibrils already in the coordinates file are loaded, and new fibrils are numbered
+        after them.
+
+        Parameters
+        ----------
+        coordinate_file : str
+            Coordinates .csv, created if needed
+        characteristics_file : str
+            Characteristics .csv with the length of each fibril. Lengths missing from it (i.e.
+            if it's new) are added when the session is opened.
+        autosave : float
+            Save every this many seconds in a background thread. By default, fibrils are only
+            saved by save() and close().
+        """
+        self.coordinate_file = coordinate_file
+        self.characteristics_file = characteristics_file
+        # Completed fibrils not yet saved, as (fibril ID, (n, 2) array)
+        self.pending = []
+        # Points of the fibril being traced
+        self.current = []
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+        repair(coordinate_file)
+        saved = read_coordinates(coordinate_file) if os.path.exists(coordinate_file) else \
+            FibrilCoordinates.from_arrays([], [], [])
+        # Fibrils in the coordinates file, as the chunks they were saved in. They're only joined
+        # when asked for (see saved), so each save costs the same however long the session.
+        self._saved = [saved]
+        self._nsaved = len(saved)
+        # IDs of saved fibrils whose lengths are still to be appended to the characteristics file
+        self._unlisted = []
+        self.lengths = dict(zip(saved.ids.tolist(), fibril_path_lengths(saved).tolist()))
+        self.next_id = int(saved.ids.max()) + 1 if len(saved) else 0
+        self.current_id = None
+        self.current_length = 0.0
+        if characteristics_file is not None:
+            self._complete_characteristics()
+
+        self._stop = threading.Event()
+        self._saver = None
+        if autosave:
+            self._saver = threading.Thread(target=self._autosave, args=(autosave,), daemon=True)
+            self._saver.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        """Number of completed fibrils, saved or not."""
+        return self._nsaved + len(self.pending)
+
+    @property
+    def saved(self):
+        """Fibrils in the coordinates file, as FibrilCoordinates."""
+        with self._lock:
+            if len(self._saved) > 1:
+                self._saved = [FibrilCoordinates.concatenate(self._saved)]
+            return self._saved[0]
+
+    def _complete_characteristics(self):
+        """Append the lengths of saved fibrils missing from the characteristics file."""
+        repair(self.characteristics_file)
+        listed = set()
+        new = not os.path.exists(self.characteristics_file) or os.path.getsize(self.characteristics_file) == 0
+        if not new:
+            with open(self.characteristics_file, newline='') as f:
+                listed = {int(float(row[0])) for row in csv.reader(f) if row and row[0] != CHARACTERISTICS_HEADER[0]}
+        missing = [[i, self.lengths[i]] for i in self._saved[0].ids.tolist() if i not in listed]
+        if new or missing:
+            with open(self.characteristics_file, "a", newline='') as f:
+                writer = csv.writer(f)
+                if new:
+                    writer.writerow(CHARACTERISTICS_HEADER)
+                writer.writerows(missing)
+
+    def add_point(self, x, y):
+        """
+        Add a point to the fibril being traced, adding the step to its length.
+
+        Returns
+        -------
+        float
+            Length of the fibril so far
+        """
+        if self.current:
+            px, py = self.current[-1]
+            self.current_length += float(np.hypot(x - px, y - py))
+        else:
+            self.current_id = self.next_id
+            self.next_id += 1
+        self.current.append((x, y))
+        self.lengths[self.current_id] = self.current_length
+        return self.current_length
+
+    def finish(self):
+        """
+        Complete the fibril being traced, queueing it to be saved. Fibrils of fewer than two
+        points are dropped.
+
+        Returns
+        -------
+        int
+            ID of the completed fibril, or None if it was dropped
+        """
+        fibril_id = self.current_id
+        if len(self.current) < 2:
+            self.lengths.pop(fibril_id, None)
+            fibril_id = None
+        else:
+            with self._lock:
+                self.pending.append((fibril_id, np.array(self.current, dtype=np.float64)))
+        self.current = []
+        self.current_id = None
+        self.current_length = 0.0
+        return fibril_id
+
+    def add(self, coords, fibril_id=None):
+        """
+        Queue a complete fibril to be saved, i.e. one traced elsewhere.
+
+        Parameters
+        ----------
+        coords : numpy.ndarray
+            (n, 2) array of [x, y]
+        fibril_id : int
+            ID of the fibril. Defaults to the next free ID.
+
+        Returns
+        -------
+        int
+            ID of the fibril
+        """
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        if fibril_id is None:
+            fibril_id = self.next_id
+        fibril_id = int(fibril_id)
+        self.lengths[fibril_id] = float(np.hypot(*np.diff(coords, axis=0).T).sum())
+        with self._lock:
+            self.pending.append((fibril_id, coords))
+        self.next_id = max(self.next_id, fibril_id + 1)
+        return fibril_id
+
+    def save(self):
+        """
+        Append the fibrils completed since the last save. Safe to call from any thread.
+
+        Each file gets a single write of complete lines, which is cut off again if it fails. Fibrils
+        are only appended to the coordinates file once, so if their lengths can't be written, only
+        the lengths are tried again by the next save.
+
+        Returns
+        -------
+        int
+            Number of fibrils saved
+        """
+        with self._save_lock:
+            with self._lock:
+                pending, self.pending = self.pending, []
+            if pending:
+                coords = io.StringIO()
+                writer = csv.writer(coords)
+                for fibril_id, xy in pending:
+                    writer.writerows([fibril_id, x, y] for x, y in xy.tolist())
+                try:
+                    append(self.coordinate_file, coords.getvalue())
+                except Exception:
+                    # Keep the fibrils for the next attempt
+                    with self._lock:
+                        self.pending = pending + self.pending
+                    raise
+                with self._lock:
+                    self._saved.append(as_coordinates(pending))
+                    self._nsaved += len(pending)
+                if self.characteristics_file is not None:
+                    self._unlisted.extend(fibril_id for fibril_id, _ in pending)
+            if self._unlisted:
+                lengths = io.StringIO()
+                csv.writer(lengths).writerows([fibril_id, self.lengths[fibril_id]] for fibril_id in self._unlisted)
+                append(self.characteristics_file, lengths.getvalue())
+                self._unlisted = []
+            return len(pending)
+
+    def _autosave(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.save()
+            except OSError as e:
+                print("Autosave to {} failed: {}".format(self.coordinate_file, e))
+
+    def coordinates(self):
+        """All completed fibrils, saved or not, as FibrilCoordinates."""
+        saved = self.saved
+        with self._lock:
+            pending = list(self.pending)
+        return FibrilCoordinates.concatenate([saved, as_coordinates(pending)]) if pending else saved
+
+    def close(self):
+        """Stop autosaving and save any remaining fibrils. The fibril being traced is dropped."""
+        if self._saver is not None:
+            self._stop.set()
+            self._saver.join()
+            self._saver = None
+        self.save()
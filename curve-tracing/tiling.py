@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Tiled Tracing
+@author: Parker Lamb
+@description: OCCULT-2 tracing of images too large to trace in one go. The image is split into a grid
+of cores, and each core is traced as a tile reaching overlap pixels further on every side, in parallel
+worker processes which each read only their own tile from the (memory-mapped) FITS file. Every point
+belongs to the tile whose core it lies in; points a tile found in a neighbouring core are only kept
+where the neighbour found nothing, so fibrils aren't traced twice in the overlap. Pieces of a fibril
+ending at a core boundary are then joined across it into a single fibril.
+@usage: "python tiling.py <image.fits> <output .csv/.fibrils> [--tile-size 1024] [--overlap 64] [--workers n]"
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.spatial import cKDTree
+
+from batch import OCCULT_PARAMETERS
+from coordinates import FibrilCoordinates
+from fits_images import FitsImage
+from profiling import stage
+
+DEFAULT_TILE_SIZE = 1024
+DEFAULT_OVERLAP = 64
+
+class TileGrid:
+    def __init__(self, shape, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP):
+        """
+        Cores of (at most) tile_size pixels covering the image without overlapping, each traced
+        as a tile reaching overlap pixels past the core (within the image).
+
+        Parameters
+        ----------
+        shape : tuple
+            (rows, columns) of the image
+        tile_size : int
+            Largest core size, in pixels. Cores are made as equal in size as possible.
+        overlap : int
+            Pixels each tile reaches past its core on every side
+        """
+        self.shape = tuple(shape[-2:])
+        self.overlap = overlap
+        rows, cols = self.shape
+        self.row_edges = np.linspace(0, rows, -(-rows//tile_size) + 1).round().astype(np.int64)
+        self.col_edges = np.linspace(0, cols, -(-cols//tile_size) + 1).round().astype(np.int64)
+
+    def __len__(self):
+        return (len(self.row_edges) - 1)*(len(self.col_edges) - 1)
+
+    def core(self, i):
+        """(y0, y1, x0, x1) of the ith core, in row-major order."""
+        r, c = divmod(i, len(self.col_edges) - 1)
+        return (self.row_edges[r], self.row_edges[r+1], self.col_edges[c], self.col_edges[c+1])
+
+    def tile(self, i):
+        """(y0, y1, x0, x1) of the ith tile: its core and the overlap around it."""
+        y0, y1, x0, x1 = self.core(i)
+        rows, cols = self.shape
+        return (max(y0 - self.overlap, 0), min(y1 + self.overlap, rows),
+                max(x0 - self.overlap, 0), min(x1 + self.overlap, cols))
+
+    def core_of(self, x, y):
+        """Index of the core each (x, y) point (in pixel coordinates of the image) lies in."""
+        r = np.clip(np.searchsorted(self.row_edges, np.rint(y), side='right') - 1, 0, len(self.row_edges) - 2)
+        c = np.clip(np.searchsorted(self.col_edges, np.rint(x), side='right') - 1, 0, len(self.col_edges) - 2)
+        return r*(len(self.col_edges) - 1) + c
+
+def trace_tile(image_path, tile, params, hdu=0, plane=None):
+    """
+    Trace one tile of an image. Runs in a worker process.
+
+    Returns
+    -------
+    FibrilCoordinates
+        Fibrils found, in pixel coordinates of the whole image
+    """
+    from tracing import AutoTracing
+
+    y0, _, x0, _ = tile
+    fibrils = FibrilCoordinates.from_features(AutoTracing(image_path, hdu, plane, roi=tile).run(**params))
+    fibrils.x += x0
+    fibrils.y += y0
+    return fibrils
+
+def deduplicate(grid, traced, distance=2.0):
+    """
+    Choose the points of each tile to keep. Points in the tile's own core are all kept. Points
+    in another core are kept unless they lie within distance of a point found there by the
+    tile owning that core, or by a tile before this one.
+
+    Parameters
+    ----------
+    grid : TileGrid
+        Grid the tiles were traced on
+    traced : list
+        FibrilCoordinates of every tile, from trace_tile
+    distance : float
+        Points closer than this (in pixels) to a kept point are considered duplicates
+
+    Returns
+    -------
+    list
+        Boolean mask over the points of each tile
+    """
+    cores = [grid.core_of(fibrils.x, fibrils.y) for fibrils in traced]
+    own = [core == i for i, core in enumerate(cores)]
+    owner_trees = [cKDTree(np.column_stack((f.x[mask], f.y[mask]))) if mask.any() else None
+                   for f, mask in zip(traced, own)]
+    # Points kept in the cores of other tiles so far, per core
+    extra = [[] for _ in range(len(grid))]
+
+    keep = []
+    for i, fibrils in enumerate(traced):
+        kept = own[i].copy()
+        foreign = np.flatnonzero(~own[i])
+        for c in np.unique(cores[i][foreign]):
+            points = foreign[cores[i][foreign] == c]
+            xy = np.column_stack((fibrils.x[points], fibrils.y[points]))
+            new = np.ones(len(points), dtype=bool)
+            trees = [owner_trees[c]] + ([cKDTree(np.concatenate(extra[c]))] if extra[c] else [])
+            for tree in trees:
+                if tree is not None:
+                    new &= np.isinf(tree.query(xy, distance_upper_bound=distance)[0])
+            kept[points[new]] = True
+            extra[c].append(xy[new])
+        keep.append(kept)
+    return keep
+
+def segments(fibrils, keep):
+    """
+    Split fibrils into runs of consecutive kept points, dropping runs of a single point.
+
+    Returns
+    -------
+    list
+        (n, 2) array of [x, y] for each run
+    """
+    index = np.flatnonzero(keep)
+    if index.size == 0:
+        return []
+    owner = np.repeat(np.arange(len(fibrils)), fibrils.lengths)[index]
+    breaks = np.flatnonzero((np.diff(index) != 1) | (np.diff(owner) != 0)) + 1
+    xy = np.column_stack((fibrils.x[index], fibrils.y[index]))
+    return [run for run in np.split(xy, breaks) if len(run) > 1]
+
+def outward(run, at_end, steps=3):
+    """Unit direction a run leaves in at one of its ends, over up to steps points."""
+    k = min(steps, len(run) - 1)
+    d = run[-1] - run[-1-k] if at_end else run[0] - run[k]
+    norm = np.hypot(*d)
+    return d/norm if norm > 0 else d
+
+def stitch(runs, tiles, distance=3.0, max_angle=60.0):
+    """
+    Join runs from different tiles whose ends meet, into single fibrils. Ends are paired
+    closest first, if they are within distance pixels of each other and leave their runs in
+    roughly opposite directions (within max_angle degrees).
+
+    Parameters
+    ----------
+    runs : list
+        (n, 2) arrays of [x, y], from segments
+    tiles : list
+        Tile each run was traced in. Runs of the same tile are never joined, as OCCULT-2
+        ended them deliberately.
+    distance : float
+        Largest gap between joined ends, in pixels
+    max_angle : float
+        Largest deviation from opposite directions of joined ends, in degrees
+
+    Returns
+    -------
+    list
+        (n, 2) arrays of [x, y] for each fibril
+    """
+    if not runs:
+        return []
+    # End 2*i is the start of run i, 2*i+1 its end
+    points = np.array([run[j] for run in runs for j in (0, -1)])
+    directions = np.array([outward(run, at_end) for run in runs for at_end in (False, True)])
+    pairs = cKDTree(points).query_pairs(distance, output_type='ndarray')
+    a, b = pairs[:,0], pairs[:,1]
+    tiles = np.asarray(tiles)
+    valid = (tiles[a//2] != tiles[b//2]) & \
+        (np.einsum('ij,ij->i', directions[a], directions[b]) < -np.cos(np.radians(max_angle)))
+    a, b = a[valid], b[valid]
+    order = np.argsort(np.hypot(*(points[a] - points[b]).T), kind='stable')
+
+    # Greedy pairing of free ends, never closing a loop
+    partner = np.full(len(points), -1)
+    parent = np.arange(len(runs))
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for i, j in zip(a[order], b[order]):
+        if partner[i] < 0 and partner[j] < 0 and root(i//2) != root(j//2):
+            partner[i], partner[j] = j, i
+            parent[root(i//2)] = root(j//2)
+
+    # Walk each chain from a free end
+    fibrils = []
+    done = np.zeros(len(runs), dtype=bool)
+    for start in range(len(points)):
+        if partner[start] >= 0 or done[start//2]:
+            continue
+        chain = []
+        end = start
+        while True:
+            run = end//2
+            chain.append(runs[run] if end % 2 == 0 else runs[run][::-1])
+            done[run] = True
+            # Leave through the other end of the run
+            end = partner[end ^ 1]
+            if end < 0:
+                break
+        fibrils.append(np.concatenate(chain))
+    return fibrils
+
+def trace_tiled(image_path, params=None, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP, workers=None,
+                hdu=0, plane=None, duplicate_distance=2.0, join_distance=3.0, progress=True):
+    """
+    Trace an image with OCCULT-2 tile by tile, in parallel, and stitch the tiles together.
+    Only one tile per worker is ever held in memory.
+
+    Parameters
+    ----------
+    image_path : str
+        FITS image to trace
+    params : dict
+        OCCULT-2 parameters, as passed to AutoTracing.run(). nstruc applies to each tile.
+    tile_size : int
+        Largest core size of the tiles (see TileGrid)
+    overlap : int
+        Pixels each tile reaches past its core. Should be well above nsm1 + 2, the border
+        OCCULT-2 blanks out, and preferably around lmin, so fibrils crossing a core boundary
+        are long enough to be found on both sides.
+    workers : int
+        Number of worker processes. Defaults to the number of cores available to us.
+    hdu : int or str
+        HDU containing the image
+    plane : int
+        Plane to trace, if the HDU is a data cube
+    duplicate_distance : float
+        See deduplicate
+    join_distance : float
+        See stitch
+    progress : bool
+        Print a line to stderr as each tile completes
+
+    Returns
+    -------
+    list
+        (n, 2) arrays of [x, y] for each fibril, as returned by AutoTracing.run()
+    """
+    params = dict(OCCULT_PARAMETERS, **(params or {}))
+    if overlap <= params["nsm1"] + 2:
+        raise ValueError("The overlap must be larger than the border of nsm1 + 2 = {} pixels".format(params["nsm1"] + 2))
+    with FitsImage(image_path, hdu) as image:
+        grid = TileGrid(image.shape, tile_size, overlap)
+
+    if workers is None:
+        # Respect any CPU affinity set by the job scheduler
+        workers = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    with ProcessPoolExecutor(max_workers=min(workers, len(grid))) as pool:
+        futures = [pool.submit(trace_tile, image_path, grid.tile(i), params, hdu, plane) for i in range(len(grid))]
+        traced = []
+        for i, future in enumerate(futures):
+            traced.append(future.result())
+            if progress:
+                print("[{}/{}] tile {}: {} features".format(i + 1, len(grid), grid.tile(i), len(traced[-1])), file=sys.stderr)
+
+    with stage("stitch_tiles", fibrils=sum(len(f) for f in traced)):
+        keep = deduplicate(grid, traced, duplicate_distance)
+        runs, tiles = [], []
+        for i, (fibrils, kept) in enumerate(zip(traced, keep)):
+            pieces = segments(fibrils, kept)
+            runs += pieces
+            tiles += [i]*len(pieces)
+        fibrils = stitch(runs, tiles, join_distance)
+    # Pieces left over from the overlaps may be shorter than OCCULT-2 allows
+    return [f for f in fibrils if np.hypot(*np.diff(f, axis=0).T).sum() >= params["lmin"]]
+
+def main():
+    parser = argparse.ArgumentParser(description="Trace a large FITS image with OCCULT-2, tile by tile.")
+    parser.add_argument('image', help='.fits image to trace')
+    parser.add_argument('output', help='.csv file or fibril store (.fibrils/.npz) to write the features to')
+    parser.add_argument('--tile-size', type=int, default=DEFAULT_TILE_SIZE, help='largest tile core size, in pixels (default: {})'.format(DEFAULT_TILE_SIZE))
+    parser.add_argument('--overlap', type=int, default=DEFAULT_OVERLAP, help='pixels each tile reaches past its core (default: {})'.format(DEFAULT_OVERLAP))
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per core)')
+    parser.add_argument('--hdu', type=int, default=0, help='HDU containing the image')
+    parser.add_argument('--plane', type=int, default=None, help='plane to trace, if the image is a data cube')
+    for name, default in OCCULT_PARAMETERS.items():
+        parser.add_argument('--'+name, type=type(default), default=default, help='OCCULT-2 {} (default: {})'.format(name, default))
+    args = parser.parse_args()
+
+    from tracing import save_features
+
+    params = {name: getattr(args, name) for name in OCCULT_PARAMETERS}
+    start = time.perf_counter()
+    features = trace_tiled(args.image, params, args.tile_size, args.overlap, args.workers, args.hdu, args.plane)
+    save_features(features, args.output)
+    print("Traced {} features in {:.1f} s".format(len(features), time.perf_counter() - start))
+
+if __name__ == "__main__":
+    main()
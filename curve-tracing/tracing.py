@@ -9,16 +9,17 @@ Created on Mon 6.5.22
 """
 
 import csv
-from json import tool
 import sys
-import sunkit_image.trace
-from astropy.io import fits
-from PySide6.QtGui import (QAction, QIcon)
-from PySide6.QtWidgets import (QApplication, QFileDialog, QMainWindow, QToolBar)
+from coordinates import FibrilCoordinates
+from fibril_store import is_store_path, write_store
+from fits_images import FitsImage
+from profiling import stage
+# sunkit_image and PySide6 take seconds to import, so they're only imported by AutoTracing.run
+# and ManualTrace.run, and headless use (i.e. batch workers saving features) starts quickly
 
 
 class AutoTracing:
-    def __init__(self, image_path):
+    def __init__(self, image_path, hdu=0, plane=None, roi=None):
         """
         Autotracing class which acts as a wrapper for sunkit's OCCULT-2 implementation to 
         trace out curvilinear features on an image. 
@@ -29,16 +30,20 @@ class AutoTracing:
         ----------
         image_path : str
             Path to the image containing features to trace. Image must be in .fits format.
+        hdu : int or str
+            HDU containing the image
+        plane : int
+            Plane to trace, if the HDU is a data cube
+        roi : tuple
+            (y0, y1, x0, x1) region of the image to trace. Defaults to the whole image.
         """
         
         self.path = image_path
 
-        # Test if file is a FITS file
-        if ".fits" in self.path:
-            f = fits.open(self.path, ignore_missing_end=True)
-            self.img_data = f[0].data
-        else:
-            raise Exception("Did not detect .fits extension in image path.")
+        # Only the selected plane and region are read, and the file is closed straight away
+        with stage("load_image") as record, FitsImage(self.path, hdu) as image:
+            self.img_data = image.read(roi, plane)
+            record.add(pixels=self.img_data.size)
 
     
     def run(self, nsm1=4, rmin=45, lmin=35, nstruc=2000, ngap=1, qthresh1=0, qthresh2=3):
@@ -68,22 +73,27 @@ class AutoTracing:
             List of features, with a list of coordinates per feature
         """
 
-        features = sunkit_image.trace.occult2(
-            self.img_data, 
-            nsm1, 
-            rmin, 
-            lmin, 
-            nstruc, 
-            ngap, 
-            qthresh1, 
-            qthresh2
-            )
+        import sunkit_image.trace
+
+        with stage("occult2", pixels=self.img_data.size) as record:
+            features = sunkit_image.trace.occult2(
+                self.img_data, 
+                nsm1, 
+                rmin, 
+                lmin, 
+                nstruc, 
+                ngap, 
+                qthresh1, 
+                qthresh2
+                )
+            record.add(fibrils=len(features), points=sum(len(feature) for feature in features))
         
         return(features)
     
     def save(self, features, save_path):
         """
-        Save features in a list to a .csv file.
+        Save features in a list to a .csv file, or to a binary fibril store if save_path
+        ends in .fibrils or .npz (see fibril_store.py).
 
         Parameters
         ----------
@@ -93,6 +103,18 @@ class AutoTracing:
             Path to save the .csv containing features to
         """
 
+        save_features(features, save_path)
+    
+def save_features(features, save_path):
+    """
+    Save features to a .csv file or fibril store. See AutoTracing.save.
+    """
+    with stage("save_features", fibrils=len(features)):
+        if is_store_path(save_path):
+            # Same fibril numbering as the .csv
+            write_store(save_path, FibrilCoordinates.from_features(features, first_id=2))
+            return
+
         with open(save_path, 'w', encoding='utf8') as savefile:
             savewriter = csv.writer(savefile)
             fibril_num = 1
@@ -100,9 +122,9 @@ class AutoTracing:
                 fibril_num += 1
                 for coord in fibril:
                     savewriter.writerow([fibril_num, coord[0], coord[1]])
-    
+
 class ManualTrace:
-    def __init__(self, image_path=""):
+    def __init__(self, image_path="", hdu=0, plane=None):
         """
         Manual tracing class. 
 
@@ -110,6 +132,10 @@ class ManualTrace:
         ----------
         image_path : str
             Path to the .fits file you want to manually trace.
+        hdu : int or str
+            HDU containing the image
+        plane : int
+            Plane to trace, if the HDU is a data cube
         """
         
         # By default, no image is supplied.
@@ -117,55 +143,22 @@ class ManualTrace:
 
         # Test if file is a FITS file
         if ".fits" in image_path:
-            f = fits.open(image_path, ignore_missing_end=True)
-            self.img_data = f[0].data
+            with FitsImage(image_path, hdu) as image:
+                self.img_data = image.read(plane=plane)
     
-    class Window(QMainWindow):
-        def __init__(self):
-            """
-            Window widget, where we set up the application
-            """
-            super().__init__()
-
-            self.setWindowTitle("Manual Feature Tracing")
-
-            toolbar = QToolBar()
-            self.addToolBar(toolbar)
-            
-            openAction = QAction(text="Open image", parent=self, triggered=self.open)
-            toolbar.addAction(openAction)
-
-            loadAction = QAction(text="Load data", parent=self, triggered=self.load)
-            toolbar.addAction(loadAction)
-
-
-        def open(self):
-            """
-            Open a file browser and select an image.
-            """
-            dialog = QFileDialog()
-            # Only allow single, existing files
-            dialog.setFileMode(QFileDialog.ExistingFile)
-            # Image is a tuple of (path, file_type)
-            image = dialog.getOpenFileName(self, "Open image", filter="FITS file (*.fits)")
-        
-        def load(self):
-            """
-            Open a .csv file containing previous data.
-            """
-            dialog = QFileDialog()
-            # Only allow single, existing files
-            dialog.setFileMode(QFileDialog.ExistingFile)
-            # Image is a tuple of (path, file_type)
-            data = dialog.getOpenFileName(self, "Open data", filter="CSV file (*.csv)")
-
     def run(self):
         """
         Run the manual tracing application.
         """
+        from PySide6.QtWidgets import QApplication
+        from viewer import ImagePyramid, TracingWindow
+
         app = QApplication([])
-        window = self.Window()
+        window = TracingWindow()
+        # Laid out before the image is fitted to it
         window.resize(800,600)
         window.show()
+        if self.img_data is not False:
+            window.view.set_image(ImagePyramid.from_array(self.img_data))
 
         sys.exit(app.exec())
\ No newline at end of file
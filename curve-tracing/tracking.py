@@ -0,0 +1,245 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Fibril Tracking
+@author: Parker Lamb
+@description: Link fibrils between consecutive frames, giving each a track ID that persists over
+time (OCCULT-2 fibril IDs are only unique within one frame). The points of each frame are held in
+a KD-tree, and fibrils are matched by how much of each lies close to the other.
+@usage: "python tracking.py <directory of per-frame coordinate files or stores> <tracks.csv>"
+"""
+
+import argparse
+import csv
+import glob
+import os
+import sys
+import time
+import numpy as np
+from scipy.spatial import cKDTree
+
+from coordinates import FibrilCoordinates, read_coordinates
+from fibril_store import STORE_SUFFIXES, is_store_path, open_store
+
+class FrameIndex:
+    def __init__(self, fibrils):
+        """
+        KD-tree over the points of every fibril in a frame.
+
+        Parameters
+        ----------
+        fibrils : FibrilCoordinates
+            Fibrils of the frame
+        """
+        self.fibrils = fibrils
+        self.owner = np.repeat(np.arange(len(fibrils)), fibrils.lengths)
+        self.points = np.column_stack((fibrils.x, fibrils.y))
+        self.tree = cKDTree(self.points) if fibrils.npoints else None
+
+    def __len__(self):
+        return len(self.fibrils)
+
+    def nearest(self, other, max_distance):
+        """
+        For each point of this frame within max_distance of a point in other, the fibril it
+        belongs to, the fibril of the closest point in other, and their distance.
+        """
+        if self.tree is None or other.tree is None:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0)
+        dist, index = other.tree.query(self.points, distance_upper_bound=max_distance)
+        hit = np.isfinite(dist)
+        return self.owner[hit], other.owner[index[hit]], dist[hit]
+
+def match_fibrils(previous, current, max_distance=2.0, min_overlap=0.5):
+    """
+    Match the fibrils of two frames one-to-one.
+
+    Every point of each frame is paired with its closest point in the other frame, if that is
+    within max_distance. The overlap of two fibrils is the number of their points paired with
+    each other, over their total number of points. Pairs are matched greedily from the largest
+    overlap down (ties going to the smaller mean distance), skipping fibrils already matched.
+
+    Parameters
+    ----------
+    previous : FrameIndex
+        Fibrils of the earlier frame
+    current : FrameIndex
+        Fibrils of the later frame
+    max_distance : float
+        Largest distance between paired points, in pixels
+    min_overlap : float
+        Smallest overlap of a match, between 0 and 1
+
+    Returns
+    -------
+    tuple
+        (previous positions, current positions, overlap) of each match
+    """
+    a_prev, b_cur, d_ab = previous.nearest(current, max_distance)
+    b_prev, a_cur, d_ba = current.nearest(previous, max_distance)
+    prev = np.concatenate((a_prev, a_cur))
+    cur = np.concatenate((b_cur, b_prev))
+    dist = np.concatenate((d_ab, d_ba))
+
+    pairs, inverse = np.unique(prev*len(current) + cur, return_inverse=True)
+    count = np.bincount(inverse.reshape(-1), minlength=pairs.size)
+    mean = np.bincount(inverse.reshape(-1), weights=dist, minlength=pairs.size) / np.maximum(count, 1)
+    prev, cur = np.divmod(pairs, max(len(current), 1))
+    overlap = count / (previous.fibrils.lengths[prev] + current.fibrils.lengths[cur])
+
+    keep = overlap >= min_overlap
+    prev, cur, overlap, mean = prev[keep], cur[keep], overlap[keep], mean[keep]
+    used_prev = np.zeros(len(previous), dtype=bool)
+    used_cur = np.zeros(len(current), dtype=bool)
+    matches = []
+    for k in np.lexsort((mean, -overlap)):
+        if not used_prev[prev[k]] and not used_cur[cur[k]]:
+            used_prev[prev[k]] = used_cur[cur[k]] = True
+            matches.append(k)
+    matches = np.array(matches, dtype=np.int64)
+    return prev[matches], cur[matches], overlap[matches]
+
+class Tracker:
+    def __init__(self, max_distance=2.0, min_overlap=0.5, max_gap=0):
+        """
+        Assigns track IDs to the fibrils of consecutive frames. A fibril matched to one in the
+        previous frame (see match_fibrils) keeps its track ID; any other starts a new track.
+
+        A fibril missing from a frame (i.e. not traced in it, or a frame with no fibrils at all)
+        ends its track, unless max_gap is set: unmatched fibrils are then kept and matched against
+        for up to max_gap further frames, so their track continues if they reappear.
+
+        Parameters
+        ----------
+        max_distance : float
+            Largest distance between paired points, in pixels
+        min_overlap : float
+            Smallest overlap of a match, between 0 and 1
+        max_gap : int
+            Number of frames a fibril may be missing from before its track ends
+        """
+        self.max_distance = max_distance
+        self.min_overlap = min_overlap
+        self.max_gap = max_gap
+        self.next_track = 0
+        # Fibrils matched against by the next frame, their track IDs, and the number of frames
+        # since each was last seen
+        self.previous = None
+        self.tracks = None
+        self.missing = None
+
+    def update(self, fibrils):
+        """
+        Track the fibrils of the next frame.
+
+        Parameters
+        ----------
+        fibrils : FibrilCoordinates, list or numpy.ndarray
+            Fibrils of the frame: coordinates, features as returned by AutoTracing.run(), or a
+            characterization table (structured array with fibril_id, x and y)
+
+        Returns
+        -------
+        numpy.ndarray
+            Track ID of each fibril, in the order of the fibrils
+        """
+        if isinstance(fibrils, np.ndarray) and fibrils.dtype.names:
+            fibrils = FibrilCoordinates.from_arrays(fibrils['fibril_id'], fibrils['x'], fibrils['y'])
+        elif not isinstance(fibrils, FibrilCoordinates):
+            fibrils = FibrilCoordinates.from_features(fibrils)
+        current = FrameIndex(fibrils)
+
+        tracks = np.full(len(current), -1, dtype=np.int64)
+        kept = np.zeros(0, dtype=np.int64)
+        if self.previous is not None:
+            prev, cur, _ = match_fibrils(self.previous, current, self.max_distance, self.min_overlap)
+            tracks[cur] = self.tracks[prev]
+            unmatched = np.ones(len(self.previous), dtype=bool)
+            unmatched[prev] = False
+            kept = np.flatnonzero(unmatched & (self.missing < self.max_gap))
+        new = np.flatnonzero(tracks < 0)
+        tracks[new] = self.next_track + np.arange(new.size)
+        self.next_track += new.size
+
+        if kept.size:
+            current = FrameIndex(FibrilCoordinates.concatenate([fibrils, self.previous.fibrils.subset(kept)]))
+        self.previous = current
+        self.tracks = np.concatenate((tracks, self.tracks[kept])) if kept.size else tracks
+        self.missing = np.concatenate((np.zeros(len(tracks), dtype=np.int64), self.missing[kept] + 1)) \
+            if kept.size else np.zeros(len(tracks), dtype=np.int64)
+        return tracks
+
+def load_frame(path):
+    """
+    Read the fibrils of a frame from a coordinates file or fibril store.
+    """
+    if is_store_path(path):
+        with open_store(path) as store:
+            return store.coordinates()
+    return read_coordinates(path)
+
+def is_companion(name):
+    """
+    Whether a file name is one written alongside a coordinates file rather than a frame: the
+    characteristics .csv of a tracing session, or the geometry output of characterization.py.
+    """
+    stem = os.path.splitext(name)[0]
+    return stem.startswith("characteristics") or stem.endswith(("-characteristics", "-geometry"))
+
+def find_frames(pattern):
+    """
+    Sorted coordinate files and stores, one per frame (i.e. the output of batch.py, or a
+    characterization series): those in a directory, leaving out the characteristics and geometry
+    files kept alongside them, or those matching a glob pattern.
+    """
+    if not os.path.isdir(pattern):
+        return sorted(glob.glob(pattern))
+    names = sorted(name for name in os.listdir(pattern)
+                   if name.endswith(STORE_SUFFIXES + (".dat", ".csv")) and not name.startswith(".")
+                   and not is_companion(name))
+    return [os.path.join(pattern, name) for name in names]
+
+def track_frames(paths, max_distance=2.0, min_overlap=0.5, max_gap=0, progress=True):
+    """
+    Track fibrils through a sequence of frames, reading one frame at a time.
+
+    Returns
+    -------
+    list
+        [frame index, fibril ID, track ID] for every fibril in every frame
+    """
+    tracker = Tracker(max_distance, min_overlap, max_gap)
+    rows = []
+    for frame, path in enumerate(paths):
+        start = time.perf_counter()
+        fibrils = load_frame(path)
+        first_new = tracker.next_track
+        tracks = tracker.update(fibrils)
+        rows.extend(zip([frame]*len(tracks), fibrils.ids.tolist(), tracks.tolist()))
+        if progress:
+            print("[{}/{}] {}: {} fibrils, {} new tracks ({:.2f} s)".format(
+                frame + 1, len(paths), path, len(tracks), tracker.next_track - first_new,
+                time.perf_counter() - start), file=sys.stderr)
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Track fibrils between consecutive frames.")
+    parser.add_argument('frames', help='directory with one coordinates file or store per frame, in frame order, or a glob pattern of them')
+    parser.add_argument('output', help='.csv to write frame, fibril ID and track ID to')
+    parser.add_argument('--max-distance', type=float, default=2.0, help='largest distance between matched points, in pixels (default: 2)')
+    parser.add_argument('--min-overlap', type=float, default=0.5, help='smallest fraction of matched points for two fibrils to match (default: 0.5)')
+    parser.add_argument('--max-gap', type=int, default=0, help='frames a fibril may be missing from before its track ends (default: 0)')
+    args = parser.parse_args()
+
+    paths = find_frames(args.frames)
+    if not paths:
+        sys.exit("No frames found")
+    rows = track_frames(paths, args.max_distance, args.min_overlap, args.max_gap)
+    with open(args.output, "w", newline='') as outfile:
+        csv.writer(outfile).writerows(rows)
+    print("{} tracks over {} frames".format(len({row[2] for row in rows}), len(paths)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Image Viewer
+@author: Parker Lamb
+@description: PySide6 image view for manual tracing of large FITS images. The image is kept as a
+pyramid of 8-bit levels, each halving the resolution of the one before, and drawn in tiles from the
+level matching the zoom, so only the visible tiles at screen resolution are ever painted. Each fibril
+is its own QGraphicsPathItem with a cosmetic pen, drawn with QPainter, so adding a point or a fibril
+only repaints the area around it. TracingWindow is the ManualTrace window around the view.
+@usage: view = TracingView(); view.set_image(ImagePyramid.from_fits(path)); view.set_fibrils(fibrils)
+"""
+
+import math
+import os
+from collections import OrderedDict
+import numpy as np
+
+from PySide6.QtCore import QPointF, QRectF, Qt, Signal
+from PySide6.QtGui import QAction, QColor, QImage, QPainter, QPainterPath, QPen, QPolygonF
+from PySide6.QtWidgets import (QFileDialog, QGraphicsItem, QGraphicsPathItem, QGraphicsScene, QGraphicsView,
+                               QMainWindow, QMessageBox, QStyleOptionGraphicsItem, QToolBar)
+
+from coordinates import read_coordinates
+from fits_images import FitsImage
+from session import DEFAULT_AUTOSAVE, Session, characteristics_path, is_coordinates_file
+
+# Pixels per side of a rendered tile
+TILE_SIZE = 256
+# Rendered tiles kept in memory (64 kB each at TILE_SIZE 256)
+TILE_CACHE = 1024
+# Rows read from the FITS file at once when building a pyramid
+STRIP_ROWS = 512
+
+FIBRIL_COLOR = QColor("#ff0000")
+# Fibrils loaded from a file, shown read-only
+LOADED_COLOR = QColor("#ffa500")
+CURRENT_COLOR = QColor("#00ff00")
+
+def display_range(data, percentiles=(1, 99.5), max_samples=1000000):
+    """
+    Values mapped to black and white, from percentiles of (a regular sample of) the image.
+    """
+    step = max(1, int(math.sqrt(data.size/max_samples)))
+    sample = np.asarray(data[::step,::step], dtype=np.float64)
+    low, high = np.nanpercentile(sample, percentiles)
+    return (float(low), float(high)) if high > low else (float(low), float(low) + 1.0)
+
+def to_uint8(data, low, high):
+    """Scale values from [low, high] to 0-255."""
+    scaled = (np.asarray(data, dtype=np.float32) - low)*(255.0/(high - low))
+    return np.nan_to_num(np.clip(scaled, 0, 255), nan=0).astype(np.uint8)
+
+def downsample(level):
+    """Halve the resolution of an 8-bit level, averaging 2x2 blocks (and edge pairs)."""
+    rows, cols = level.shape
+    padded = np.pad(level, ((0, rows % 2), (0, cols % 2)), mode='edge').astype(np.uint16)
+    return ((padded[0::2,0::2] + padded[1::2,0::2] + padded[0::2,1::2] + padded[1::2,1::2] + 2)//4).astype(np.uint8)
+
+class ImagePyramid:
+    def __init__(self, levels):
+        """
+        An image at several resolutions. levels[0] is the full image as 8-bit values, and each
+        next level has half the resolution of the one before. Use from_array or from_fits.
+        """
+        self.levels = levels
+        self.shape = levels[0].shape
+        self._tiles = OrderedDict()
+
+    @classmethod
+    def from_array(cls, data, display=None, min_size=TILE_SIZE):
+        """
+        Build from an image, with display=(low, high) values shown as black and white
+        (see display_range by default). Levels are added until one fits in a single tile.
+        """
+        low, high = display or display_range(data)
+        return cls(cls._levels(to_uint8(data, low, high), min_size))
+
+    @classmethod
+    def from_fits(cls, path, hdu=0, plane=None, display=None, min_size=TILE_SIZE):
+        """
+        Build from a FITS image, read in strips of rows, so the full image is only ever held
+        as 8-bit values.
+        """
+        with FitsImage(path, hdu) as image:
+            rows, cols = image.shape[-2:]
+            if display is None:
+                step = max(1, int(math.sqrt(rows*cols/1000000)))
+                display = display_range(image.read(roi=(slice(None, None, step), slice(None, None, step)), plane=plane))
+            level = np.empty((rows, cols), dtype=np.uint8)
+            for r0 in range(0, rows, STRIP_ROWS):
+                r1 = min(r0 + STRIP_ROWS, rows)
+                level[r0:r1] = to_uint8(image.read(roi=(r0, r1, 0, cols), plane=plane), *display)
+        return cls(cls._levels(level, min_size))
+
+    @staticmethod
+    def _levels(level, min_size):
+        levels = [level]
+        while max(levels[-1].shape) > min_size:
+            levels.append(downsample(levels[-1]))
+        return levels
+
+    def level_for(self, scale):
+        """Coarsest level with at least one pixel per screen pixel at a zoom of scale."""
+        if scale >= 1:
+            return 0
+        return min(int(math.floor(math.log2(1/scale))), len(self.levels) - 1)
+
+    def tile(self, level, row, col):
+        """
+        QImage of one tile of a level, made on first use and kept in an LRU cache.
+
+        Returns
+        -------
+        tuple
+            (QImage, QRectF, QRectF) of the tile, the area it covers in full-resolution pixels,
+            and the part of the QImage to draw there
+        """
+        key = (level, row, col)
+        if key in self._tiles:
+            self._tiles.move_to_end(key)
+            return self._tiles[key]
+        level_data = self.levels[level]
+        height = min(TILE_SIZE, level_data.shape[0] - row*TILE_SIZE)
+        width = min(TILE_SIZE, level_data.shape[1] - col*TILE_SIZE)
+        # One more row and column (where there is one), so smooth scaling blends into the next tile
+        data = np.ascontiguousarray(level_data[row*TILE_SIZE:row*TILE_SIZE+height+1, col*TILE_SIZE:col*TILE_SIZE+width+1])
+        image = QImage(data.data, data.shape[1], data.shape[0], data.shape[1], QImage.Format_Grayscale8).copy()
+        factor = 2**level
+        # Pixel centres are at integer coordinates
+        rect = QRectF(col*TILE_SIZE*factor - 0.5, row*TILE_SIZE*factor - 0.5, width*factor, height*factor)
+        self._tiles[key] = (image, rect, QRectF(0, 0, width, height))
+        if len(self._tiles) > TILE_CACHE:
+            self._tiles.popitem(last=False)
+        return self._tiles[key]
+
+class PyramidItem(QGraphicsItem):
+    def __init__(self, pyramid):
+        """
+        Scene item drawing an ImagePyramid, with pixel (row, column) centred on (x=column, y=row).
+        Only tiles overlapping the exposed area are painted, from the level matching the zoom.
+        """
+        super().__init__()
+        self.pyramid = pyramid
+        rows, cols = pyramid.shape
+        self._rect = QRectF(-0.5, -0.5, cols, rows)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+        self.setZValue(-1)
+
+    def boundingRect(self):
+        return self._rect
+
+    def paint(self, painter, option, widget=None):
+        scale = QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        level = self.pyramid.level_for(scale)
+        span = TILE_SIZE*2**level
+        exposed = option.exposedRect.intersected(self._rect)
+        rows = range(max(int((exposed.top() + 0.5)//span), 0), int((exposed.bottom() + 0.5)//span) + 1)
+        cols = range(max(int((exposed.left() + 0.5)//span), 0), int((exposed.right() + 0.5)//span) + 1)
+        nrows, ncols = self.pyramid.levels[level].shape
+        # Smooth scaling when zoomed out, sharp pixels when zoomed in. Antialiasing would leave
+        # seams between tiles.
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, scale < 1)
+        painter.setRenderHint(QPainter.Antialiasing, False)
+        for row in rows:
+            for col in cols:
+                if row*TILE_SIZE < nrows and col*TILE_SIZE < ncols:
+                    image, rect, source = self.pyramid.tile(level, row, col)
+                    painter.drawImage(rect, image, source)
+
+def fibril_path(coords):
+    """QPainterPath through the (n, 2) [x, y] coordinates of a fibril."""
+    path = QPainterPath()
+    # Python floats, as PySide doesn't take NumPy scalars everywhere
+    path.addPolygon(QPolygonF([QPointF(x, y) for x, y in np.asarray(coords, dtype=np.float64).tolist()]))
+    return path
+
+class TracingView(QGraphicsView):
+    # Emitted with the (n, 2) coordinates of each fibril completed in the view
+    fibrilFinished = Signal(object)
+
+    def __init__(self, parent=None):
+        """
+        Zoomable, pannable view of an image and its fibrils, with manual tracing: hold shift
+        and click to add points to a fibril, and release shift to complete it. Drag to pan and
+        use the mouse wheel to zoom. Row 0 of the image is at the bottom, as in the archive
+        tracing script.
+        """
+        super().__init__(parent)
+        self.setScene(QGraphicsScene(self))
+        self.setDragMode(QGraphicsView.ScrollHandDrag)
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+        self.setViewportUpdateMode(QGraphicsView.MinimalViewportUpdate)
+        self.setOptimizationFlag(QGraphicsView.DontSavePainterState)
+        self.setRenderHint(QPainter.Antialiasing)
+        self.scale(1, -1)
+
+        self.image_item = None
+        # Whether the image is kept fitted to the view, until the user zooms
+        self.fitted = False
+        # Path item of each fibril, by fibril ID
+        self.fibril_items = {}
+        # Path items of fibrils loaded read-only
+        self.loaded_items = []
+        # Points and path item of the fibril being traced
+        self.current = []
+        self.current_item = None
+
+    def set_image(self, pyramid):
+        """Show an ImagePyramid, replacing any image shown before."""
+        if self.image_item is not None:
+            self.scene().removeItem(self.image_item)
+        self.image_item = PyramidItem(pyramid)
+        self.scene().addItem(self.image_item)
+        self.scene().setSceneRect(self.image_item.boundingRect())
+        self.fitted = True
+        self.fit_image()
+
+    def fit_image(self):
+        """Zoom to show the whole image."""
+        if self.image_item is not None:
+            self.fitInView(self.image_item, Qt.KeepAspectRatio)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        # The view is only laid out once shown, so refit until the user zooms
+        if self.fitted:
+            self.fit_image()
+
+    def _pen(self, color):
+        # Cosmetic pens keep their width in screen pixels at any zoom
+        pen = QPen(color, 1.5)
+        pen.setCosmetic(True)
+        return pen
+
+    def set_fibrils(self, fibrils):
+        """Show a set of fibrils (FibrilCoordinates), replacing any shown before."""
+        for item in self.fibril_items.values():
+            self.scene().removeItem(item)
+        self.fibril_items = {}
+        for fibril_id, coords in zip(fibrils.ids.tolist(), fibrils):
+            self.add_fibril(fibril_id, coords)
+
+    def set_loaded(self, fibrils):
+        """Show a set of fibrils (FibrilCoordinates) read-only, replacing any loaded before."""
+        for item in self.loaded_items:
+            self.scene().removeItem(item)
+        self.loaded_items = []
+        pen = self._pen(LOADED_COLOR)
+        for coords in fibrils:
+            item = QGraphicsPathItem(fibril_path(coords))
+            item.setPen(pen)
+            self.scene().addItem(item)
+            self.loaded_items.append(item)
+
+    def add_fibril(self, fibril_id, coords):
+        """Show one more fibril. Only the area around it is repainted."""
+        item = QGraphicsPathItem(fibril_path(coords))
+        item.setPen(self._pen(FIBRIL_COLOR))
+        self.scene().addItem(item)
+        self.fibril_items[fibril_id] = item
+        return item
+
+    def remove_fibril(self, fibril_id):
+        self.scene().removeItem(self.fibril_items.pop(fibril_id))
+
+    def wheelEvent(self, event):
+        # One wheel step (120) zooms by sqrt(2)
+        factor = 2**(event.angleDelta().y()/240)
+        self.fitted = False
+        self.scale(factor, factor)
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton and event.modifiers() & Qt.ShiftModifier:
+            point = self.mapToScene(event.position().toPoint())
+            self.current.append((point.x(), point.y()))
+            if self.current_item is None:
+                self.current_item = QGraphicsPathItem()
+                self.current_item.setPen(self._pen(CURRENT_COLOR))
+                self.scene().addItem(self.current_item)
+            # Only the current fibril's area is repainted
+            self.current_item.setPath(fibril_path(self.current))
+            event.accept()
+            return
+        super().mousePressEvent(event)
+
+    def keyReleaseEvent(self, event):
+        if event.key() == Qt.Key_Shift and not event.isAutoRepeat():
+            self.finish_fibril()
+        super().keyReleaseEvent(event)
+
+    def finish_fibril(self):
+        """
+        Complete the fibril being traced, emitting fibrilFinished if it has at least two points.
+        Whoever stores the fibril shows it with add_fibril.
+        """
+        current, item = self.current, self.current_item
+        self.current, self.current_item = [], None
+        if item is not None:
+            self.scene().removeItem(item)
+        if len(current) > 1:
+            self.fibrilFinished.emit(np.array(current, dtype=np.float64))
+
+class TracingWindow(QMainWindow):
+    def __init__(self):
+        """
+        Manual tracing window (see ManualTrace in tracing.py), where we set up the application
+        """
+        super().__init__()
+
+        self.setWindowTitle("Manual Feature Tracing")
+
+        # Fibrils loaded read-only with "Load data", as a FibrilCoordinates instance
+        self.fibrils = None
+        # Session the traced fibrils are saved to (see session.py)
+        self.session = None
+        # Fibrils traced before a file to save them to was chosen, as (n, 2) arrays of [x, y]
+        self.unsaved = []
+
+        # Hold shift and click to trace, drag to pan, scroll to zoom
+        self.view = TracingView(self)
+        self.view.fibrilFinished.connect(self.finish_fibril)
+        self.setCentralWidget(self.view)
+
+        toolbar = QToolBar()
+        self.addToolBar(toolbar)
+
+        openAction = QAction(text="Open image", parent=self, triggered=self.open)
+        toolbar.addAction(openAction)
+
+        loadAction = QAction(text="Load data", parent=self, triggered=self.load)
+        toolbar.addAction(loadAction)
+
+        saveAction = QAction(text="Save", parent=self, triggered=self.save)
+        toolbar.addAction(saveAction)
+
+
+    def open(self):
+        """
+        Open a file browser and select an image.
+        """
+        dialog = QFileDialog()
+        # Only allow single, existing files
+        dialog.setFileMode(QFileDialog.ExistingFile)
+        # Image is a tuple of (path, file_type)
+        image = dialog.getOpenFileName(self, "Open image", filter="FITS file (*.fits)")
+        if image[0]:
+            self.view.set_image(ImagePyramid.from_fits(image[0]))
+
+    def load(self):
+        """
+        Open a .csv file containing previous data, and show its fibrils. The file is only read:
+        fibrils traced from now on go to the file chosen with "Save".
+        """
+        dialog = QFileDialog()
+        # Only allow single, existing files
+        dialog.setFileMode(QFileDialog.ExistingFile)
+        # Image is a tuple of (path, file_type)
+        data = dialog.getOpenFileName(self, "Open data", filter="CSV file (*.csv)")
+        if data[0]:
+            try:
+                self.fibrils = read_coordinates(data[0])
+            except (OSError, ValueError) as e:
+                QMessageBox.warning(self, "Load data", "Could not read {}: {}".format(data[0], e))
+                return
+            self.view.set_loaded(self.fibrils)
+
+    def start_session(self, path):
+        """
+        Save to a session in path from now on, loading any fibrils already in it. Fibrils
+        of the previous session, and any traced before there was one, are copied into the new
+        one, numbered after its own.
+        """
+        previous = self.session
+        self.session = Session(path, characteristics_path(path), autosave=DEFAULT_AUTOSAVE)
+        if previous is not None:
+            previous.close()
+            if os.path.abspath(previous.coordinate_file) != os.path.abspath(path):
+                for coords in previous.saved:
+                    self.session.add(coords)
+        for coords in self.unsaved:
+            self.session.add(coords)
+        self.unsaved = []
+        self.view.set_fibrils(self.session.coordinates())
+
+    def save(self):
+        """
+        Save the fibrils completed since the last save, asking for a file the first time. An
+        existing file is appended to if it's a coordinates .csv (fibril ID, x, y).
+        """
+        if self.session is None:
+            path = QFileDialog.getSaveFileName(self, "Save data", filter="CSV file (*.csv)")[0]
+            if not path:
+                return
+            if not is_coordinates_file(path):
+                QMessageBox.warning(self, "Save data", "{} is not a coordinates file (fibril ID, x, y), "
+                                    "so fibrils can't be added to it. Choose another file.".format(path))
+                return
+            self.start_session(path)
+        self.session.save()
+
+    def finish_fibril(self, coords):
+        """
+        Record a completed fibril, (n, 2) array of [x, y], starting a session if needed.
+        It's saved by the next autosave. If no file is chosen, the fibril is kept (and shown)
+        until one is, with "Save" or when the next fibril is completed.
+        """
+        if self.session is None:
+            self.unsaved.append(coords)
+            # Negative keys, so they're replaced when the session's fibrils are shown
+            self.view.add_fibril(-len(self.unsaved), coords)
+            self.save()
+            return None
+        fibril_id = self.session.add(coords)
+        self.view.add_fibril(fibril_id, coords)
+        return fibril_id
+
+    def closeEvent(self, event):
+        """Save any remaining fibrils when the window is closed."""
+        if self.session is None and self.unsaved:
+            self.save()
+        if self.session is not None:
+            self.session.close()
+        super().closeEvent(event)
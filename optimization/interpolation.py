@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Fibril Interpolation
+@author: Parker Lamb
+@description: Python version of interpolate_fibril_coordinates.pro. Sparse, manually clicked fibril
+coordinates are interpolated to points spaced one pixel apart, comparable to the output of OCCULT-2,
+optionally sampling the maps at each interpolated point. All fibrils are handled at once, working on
+the flat coordinate arrays of FibrilCoordinates.
+@usage: manual = interpolate_fibril_coordinates("data/manual_results/coords_parker.csv")
+"""
+
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "curve-tracing"))
+from coordinates import FibrilCoordinates, read_coordinates
+from sampling import sample_maps
+
+def segments(fibrils):
+    """
+    Index of the first point of every segment (pair of adjacent points within a fibril).
+    """
+    last = np.zeros(fibrils.npoints, dtype=bool)
+    last[fibrils.offsets + fibrils.lengths - 1] = True
+    return np.flatnonzero(~last)
+
+def interpolate_fibrils(fibrils):
+    """
+    Interpolate fibrils to one pixel spacing between points.
+
+    Each segment between two clicked points is split into round(segment length) steps, starting
+    at the first point of the segment. As in the IDL version, the last clicked point itself is not
+    included, and fibrils of a single point are dropped.
+
+    Parameters
+    ----------
+    fibrils : FibrilCoordinates
+        Sparse fibril coordinates
+
+    Returns
+    -------
+    FibrilCoordinates
+        Interpolated fibril coordinates
+    """
+    fibrils = fibrils.subset(fibrils.lengths >= 2)
+    starts = segments(fibrils)
+    step_x = fibrils.x[starts+1] - fibrils.x[starts]
+    step_y = fibrils.y[starts+1] - fibrils.y[starts]
+    # IDL rounds halves away from zero
+    n = np.floor(np.hypot(step_x, step_y) + 0.5).astype(np.int64)
+
+    # Segment and step number of every interpolated point
+    seg = np.repeat(np.arange(starts.size), n)
+    t = (np.arange(seg.size) - np.repeat(np.cumsum(n) - n, n)) / n[seg]
+    return FibrilCoordinates.from_arrays(
+        fibrils.point_ids[starts][seg],
+        fibrils.x[starts][seg] + t*step_x[seg],
+        fibrils.y[starts][seg] + t*step_y[seg],
+    )
+
+def smooth_fibrils(fibrils, smoothing, density=10):
+    """
+    Replace each fibril by a smoothing spline through its points, evaluated at density points
+    per pixel of length. Fibrils too short to fit are kept as they are.
+
+    Parameters
+    ----------
+    fibrils : FibrilCoordinates
+        Fibril coordinates
+    smoothing : float
+        Mean squared distance (in pixels^2) allowed between the spline and the points
+    density : int
+        Points per pixel to evaluate the spline at
+
+    Returns
+    -------
+    FibrilCoordinates
+        Smoothed fibril coordinates
+    """
+    from scipy.interpolate import splev, splprep
+
+    xs = []
+    ys = []
+    for coords in fibrils:
+        # The spline parameter must increase, so drop repeated points
+        keep = np.concatenate(([True], np.any(np.diff(coords, axis=0) != 0, axis=1)))
+        coords = coords[keep]
+        if len(coords) < 2:
+            xs.append(coords[:,0])
+            ys.append(coords[:,1])
+            continue
+        u = np.concatenate(([0], np.cumsum(np.hypot(*np.diff(coords, axis=0).T))))
+        tck, _ = splprep(coords.T, u=u, k=min(3, len(coords)-1), s=smoothing*len(coords))
+        smoothed = splev(np.linspace(0, u[-1], max(2, int(np.ceil(u[-1]*density)) + 1)), tck)
+        xs.append(smoothed[0])
+        ys.append(smoothed[1])
+    lengths = np.array([x.size for x in xs], dtype=np.int64)
+    return FibrilCoordinates(fibrils.ids, np.cumsum(lengths) - lengths, lengths,
+                             np.concatenate(xs) if xs else [], np.concatenate(ys) if ys else [])
+
+def resample_fibrils(fibrils, spacing=1.0, smoothing=None):
+    """
+    Resample fibrils to points spaced evenly along their arc length.
+
+    Unlike interpolate_fibrils, spacing is measured along the whole fibril rather than per
+    segment, and the first point and (if it falls on the spacing) the last point are kept.
+
+    Parameters
+    ----------
+    fibrils : FibrilCoordinates
+        Fibril coordinates
+    spacing : float
+        Arc length between output points, in pixels
+    smoothing : float
+        If given, fit a smoothing spline to each fibril first (see smooth_fibrils)
+
+    Returns
+    -------
+    FibrilCoordinates
+        Resampled fibril coordinates
+    """
+    if smoothing is not None:
+        fibrils = smooth_fibrils(fibrils, smoothing)
+    fibrils = fibrils.subset(fibrils.lengths >= 1)
+    # Arc length along each fibril
+    steps = np.hypot(np.diff(fibrils.x), np.diff(fibrils.y))
+    owner = np.repeat(np.arange(len(fibrils)), fibrils.lengths)
+    steps[owner[1:] != owner[:-1]] = 0
+    arc = np.concatenate(([0], np.cumsum(steps)))
+    arc -= arc[fibrils.offsets][owner]
+    total = arc[fibrils.offsets + fibrils.lengths - 1]
+
+    # Shift every fibril onto its own stretch of one increasing axis, to search all at once
+    base = np.cumsum(total + 1) - (total + 1)
+    count = np.floor(total/spacing + 1e-9).astype(np.int64) + 1
+    sample = np.repeat(np.arange(len(fibrils)), count)
+    s = (np.arange(sample.size) - np.repeat(np.cumsum(count) - count, count)) * spacing
+    s = np.minimum(s, total[sample])
+    start = np.searchsorted(arc + base[owner], s + base[sample], side='right') - 1
+    # Use the last segment for the last point, or the only point of a single-point fibril
+    last = fibrils.offsets[sample] + fibrils.lengths[sample] - 1
+    start = np.maximum(np.minimum(start, last - 1), fibrils.offsets[sample])
+    end = np.minimum(start + 1, last)
+    span = arc[end] - arc[start]
+    t = np.divide(s - arc[start], span, out=np.zeros_like(s), where=span > 0)
+    return FibrilCoordinates(
+        fibrils.ids, np.cumsum(count) - count, count,
+        fibrils.x[start] + t*(fibrils.x[end] - fibrils.x[start]),
+        fibrils.y[start] + t*(fibrils.y[end] - fibrils.y[start]),
+    )
+
+def interpolate_fibril_coordinates(fibril_coords_file, maps=None, interpolation="bicubic"):
+    """
+    Read a manual fibril coordinates .csv and interpolate it to one pixel spacing between points.
+
+    Parameters
+    ----------
+    fibril_coords_file : str
+        Manual coordinates .csv
+    maps : dict
+        Maps to sample at each interpolated point (e.g. width, intensity and velocity, as in the
+        IDL version). The values are kept as the extra columns, in the order of maps.
+    interpolation : str
+        How the maps are sampled (see sampling.py). The default, "bicubic", is the cubic
+        convolution IDL's interpolate(..., cubic=-0.5) uses.
+
+    Returns
+    -------
+    FibrilCoordinates
+        Interpolated fibril coordinates
+    """
+    fibrils = interpolate_fibrils(read_coordinates(fibril_coords_file))
+    if maps:
+        values = sample_maps(maps, fibrils.x, fibrils.y, interpolation)
+        fibrils.extra = np.column_stack(list(values.values()))
+    return fibrils
@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: OCCULT-2 Parameter Optimization
+@author: Parker Lamb
+@description: Python version of optimize_occult_2_parameters.pro. OCCULT-2 (through AutoTracing) is
+run for a grid of parameter sets, and the fibrils found are matched against the manually traced
+fibrils. Parameter sets are evaluated in parallel, each worker loading the image and manual fibrils
+once. Instead of the full grid, a coarse-to-fine search can be used.
+@usage: "python optimize.py <image.fits> [--search grid|coarse] [--workers n] [--output optimization.csv]"
+"""
+
+import argparse
+import csv
+import itertools
+import os
+import sys
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "curve-tracing"))
+from coordinates import FibrilCoordinates
+from interpolation import interpolate_fibril_coordinates
+from proximity import ReferenceIndex, best_matches, match_fraction
+
+# Parameter space, in the column order of optimization.csv
+PARAMETER_GRID = {
+    "nsm1": [3, 4, 5, 6, 7],
+    "rmin": [35, 40, 45, 50, 55],
+    "lmin": [35, 45],
+    "nstruc": [2000],
+    "nloopmax": [2000],
+    "ngap": [1, 2, 3],
+    "qthresh1": [0.0],
+    "qthresh2": [3],
+}
+
+# Manual fibril files, and the offset added to their fibril IDs to keep them unique
+MANUAL_RESULTS = [
+    ("data/manual_results/coords_gianna.csv", 0),
+    ("data/manual_results/coords_benoit.csv", 2000),
+    ("data/manual_results/coords_parker.csv", 1000),
+]
+
+# Fibrils with a best match further than this (in pixels) are considered unmatched
+MATCH_DISTANCE = 10.0
+
+def load_manual_fibrils(manual_results=MANUAL_RESULTS):
+    """
+    Read in and combine the manual fibrils, interpolated to one pixel spacing.
+    """
+    fibrils = [interpolate_fibril_coordinates(path) for path, _ in manual_results]
+    return FibrilCoordinates.concatenate(fibrils, [offset for _, offset in manual_results])
+
+def within(fibrils, roi):
+    """
+    Keep only the fibrils lying entirely within a (y0, y1, x0, x1) region.
+    """
+    y0, y1, x0, x1 = roi
+    inside = (fibrils.x >= x0) & (fibrils.x < x1) & (fibrils.y >= y0) & (fibrils.y < y1)
+    owner = np.repeat(np.arange(len(fibrils)), fibrils.lengths)
+    return fibrils.subset(np.bincount(owner, weights=~inside, minlength=len(fibrils)) == 0)
+
+def match_percentages(occult, manual, manual_index=None):
+    """
+    Get the fraction of OCCULT fibrils matched by a manual fibril, and vice versa.
+
+    Parameters
+    ----------
+    occult : FibrilCoordinates
+        OCCULT-2 fibrils
+    manual : FibrilCoordinates
+        Manual fibrils
+    manual_index : ReferenceIndex
+        Index over the manual fibrils, to reuse across calls. Built if not given.
+
+    Returns
+    -------
+    tuple
+        (occult_percent, manual_percent)
+    """
+    if manual_index is None:
+        manual_index = ReferenceIndex(manual)
+    occult_best = best_matches(manual_index, occult)
+    manual_best = best_matches(occult, manual)
+    return match_fraction(occult_best, MATCH_DISTANCE), match_fraction(manual_best, MATCH_DISTANCE)
+
+# Per-worker state, set up once by init_worker
+_tracer = None
+_manual = None
+_manual_index = None
+_offset = (0, 0)
+
+def init_worker(image_path, manual, roi=None):
+    """
+    Load the image, and index the manual fibrils, once for every evaluation in this worker.
+    The smoothing and thresholding depending on nsm1 and qthresh1/2 happen inside sunkit_image's
+    occult2, so they're redone for every parameter set.
+    """
+    global _tracer, _manual, _manual_index, _offset
+    from tracing import AutoTracing
+    _tracer = AutoTracing(image_path, roi=roi)
+    _manual = manual
+    _manual_index = ReferenceIndex(manual)
+    # Traced coordinates are relative to the region of interest
+    _offset = (roi[2], roi[0]) if roi else (0, 0)
+
+def evaluate(params):
+    """
+    Run OCCULT-2 with one parameter set and match the result against the manual fibrils.
+
+    Parameters
+    ----------
+    params : dict
+        Values for each parameter in PARAMETER_GRID
+
+    Returns
+    -------
+    tuple
+        (occult_percent, manual_percent)
+    """
+    features = _tracer.run(
+        nsm1=params["nsm1"],
+        rmin=params["rmin"],
+        lmin=params["lmin"],
+        nstruc=params["nstruc"],
+        ngap=params["ngap"],
+        qthresh1=params["qthresh1"],
+        qthresh2=params["qthresh2"],
+    )
+    occult = FibrilCoordinates.from_features(features)
+    occult.x += _offset[0]
+    occult.y += _offset[1]
+    return match_percentages(occult, _manual, _manual_index)
+
+class Optimizer:
+    def __init__(self, image_path, manual, grid=PARAMETER_GRID, workers=None, roi=None):
+        """
+        Evaluates parameter sets in a pool of worker processes, remembering every result.
+
+        Parameters
+        ----------
+        image_path : str
+            FITS image to run OCCULT-2 on
+        manual : FibrilCoordinates
+            Manual fibrils to match against
+        grid : dict
+            Values to search for each parameter
+        workers : int
+            Number of worker processes. Defaults to the number of cores.
+        roi : tuple
+            (y0, y1, x0, x1) region of the image to trace. Only manual fibrils within the region
+            are matched against.
+        """
+        if roi:
+            manual = within(manual, roi)
+        self.grid = grid
+        self.names = list(grid)
+        self.results = {}
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(image_path, manual, roi))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.pool.shutdown()
+
+    def params(self, index):
+        """Parameter set at an index tuple into the grid."""
+        return {name: self.grid[name][i] for name, i in zip(self.names, index)}
+
+    def evaluate(self, indices):
+        """
+        Evaluate the parameter sets at the given grid indices, skipping any already evaluated.
+        """
+        indices = [index for index in dict.fromkeys(indices) if index not in self.results]
+        for index, result in zip(indices, self.pool.map(evaluate, [self.params(index) for index in indices])):
+            self.results[index] = result
+            print("{}: occult {:.4f}, manual {:.4f}".format(self.params(index), *result), file=sys.stderr)
+
+    def best(self):
+        """Grid index of the best parameter set so far, maximizing both percentages."""
+        return max(self.results, key=lambda index: sum(self.results[index]))
+
+    def grid_search(self):
+        """Evaluate every parameter set in the grid."""
+        self.evaluate(itertools.product(*[range(len(self.grid[name])) for name in self.names]))
+
+    def coarse_to_fine(self):
+        """
+        Evaluate every second value of each parameter, then move from the best set found to
+        better neighbouring sets (one parameter one step up or down), until none is better.
+        """
+        sizes = [len(self.grid[name]) for name in self.names]
+        self.evaluate(itertools.product(*[sorted(set(range(0, n, 2)) | {n-1}) for n in sizes]))
+        best = self.best()
+        while True:
+            neighbours = []
+            for dim, n in enumerate(sizes):
+                for step in (-1, 1):
+                    if 0 <= best[dim] + step < n:
+                        neighbours.append(best[:dim] + (best[dim] + step,) + best[dim+1:])
+            self.evaluate(neighbours)
+            if self.best() == best:
+                break
+            best = self.best()
+
+    def rows(self):
+        """
+        Evaluated parameter sets in grid order, as rows of optimization.csv.
+        """
+        return [[self.params(index)[name] for name in self.names] + list(self.results[index])
+                for index in sorted(self.results)]
+
+def write_results(path, rows):
+    """
+    Write parameter sets and their occult_percent, manual_percent to a .csv file.
+    """
+    with open(path, "w", newline='') as outfile:
+        csv.writer(outfile).writerows(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description="Optimize OCCULT-2 parameters against manually traced fibrils.")
+    parser.add_argument('image', help='FITS image to run OCCULT-2 on')
+    parser.add_argument('--output', default="data/optimization_results/optimization.csv", help='where to write the results')
+    parser.add_argument('--search', default="grid", choices=["grid", "coarse"], help='full grid, or coarse-to-fine search')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per core)')
+    parser.add_argument('--roi', type=int, nargs=4, metavar=('Y0', 'Y1', 'X0', 'X1'), help='only trace this region of the image')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    manual = load_manual_fibrils()
+    with Optimizer(args.image, manual, workers=args.workers, roi=args.roi) as optimizer:
+        if args.search == "grid":
+            optimizer.grid_search()
+        else:
+            optimizer.coarse_to_fine()
+        write_results(args.output, optimizer.rows())
+        best = optimizer.params(optimizer.best())
+        print(
+            "Evaluated {} parameter sets in {:.1f} s\n".format(len(optimizer.results), time.perf_counter() - start),
+            "Best: {} (occult {:.4f}, manual {:.4f})".format(best, *optimizer.results[optimizer.best()])
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat 10.17.26
+@title: Fibril Proximity
+@author: Parker Lamb
+@description: Python version of calculate_fibril_proximity.pro. For each tested fibril, find the
+reference fibril with the smallest mean distance over their joint length. Reference points are held
+in a KD-tree, so only nearby reference fibrils are compared in full.
+@usage: best = best_matches(reference, tested), with both sets as FibrilCoordinates. To match many
+sets against the same reference, build index = ReferenceIndex(reference) once and pass it instead.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Columns of the best-match table, as in calculate_fibril_proximity.pro
+BEST_MATCH_COLUMNS = [
+    "test_id", "test_npoints", "test_length",
+    "reference_id", "reference_npoints", "reference_length",
+    "dist_mean", "dist_min", "dist_max",
+]
+
+# Maximum number of test point to reference point distances held in memory at once
+CHUNK_DISTANCES = 2**22
+
+def sum_steps(fibrils, steps):
+    """
+    Sum per-step values (between adjacent points) over each fibril.
+    """
+    if steps.size == 0:
+        return np.zeros(len(fibrils))
+    # Drop the steps between the last point of a fibril and the first of the next
+    inside = np.ones(steps.size, dtype=bool)
+    inside[(fibrils.offsets + fibrils.lengths - 1)[:-1]] = False
+    owner = np.repeat(np.arange(len(fibrils)), fibrils.lengths)[:-1]
+    return np.bincount(owner[inside], weights=steps[inside], minlength=len(fibrils))
+
+def path_length(fibrils):
+    """
+    Geometrical path length of each fibril, summed over the distances between adjacent points.
+    """
+    return sum_steps(fibrils, np.hypot(np.diff(fibrils.x), np.diff(fibrils.y)))
+
+def reference_length(fibrils):
+    """
+    Path length of the reference fibrils as computed in calculate_fibril_proximity.pro, which
+    uses the x steps for both terms (i.e. sqrt(2)*|dx| per step). Kept so the tables agree.
+    """
+    return sum_steps(fibrils, np.sqrt(2*np.diff(fibrils.x)**2))
+
+def sorted_by_id(fibrils):
+    """
+    Indices of the fibrils in order of increasing fibril ID (the order IDL's UNIQ gives).
+    """
+    return np.argsort(fibrils.ids, kind='stable')
+
+def reorder(fibrils, order):
+    """
+    Flat x and y arrays and start offsets, with the fibrils rearranged into the given order.
+    """
+    index = np.concatenate([np.arange(fibrils.offsets[i], fibrils.offsets[i]+fibrils.lengths[i]) for i in order])
+    lengths = fibrils.lengths[order]
+    return fibrils.x[index], fibrils.y[index], np.cumsum(lengths) - lengths
+
+def candidate_distances(points, ref_x, ref_y, ref_starts):
+    """
+    Distance from each test point to the closest point of every reference fibril.
+
+    Returns
+    -------
+    numpy.ndarray
+        (number of points, number of reference fibrils) array
+    """
+    dists = np.hypot(points[:,0,None] - ref_x[None,:], points[:,1,None] - ref_y[None,:])
+    return np.minimum.reduceat(dists, ref_starts, axis=1)
+
+class ReferenceIndex:
+    def __init__(self, reference):
+        """
+        KD-tree over all points of a set of reference fibrils, built once and reused for any
+        number of best_matches() calls (e.g. the manual fibrils, for every parameter set).
+
+        Parameters
+        ----------
+        reference : FibrilCoordinates
+            Reference fibrils
+        """
+        order = sorted_by_id(reference)
+        self.fibrils = reference
+        self.ids = reference.ids[order].astype(float)
+        self.npoints = reference.lengths[order]
+        self.length = reference_length(reference)[order]
+        self.x, self.y, self.starts = reorder(reference, order) if len(reference) else (np.zeros(0), np.zeros(0), np.zeros(0, dtype=int))
+        # Position (in ID order) of the fibril each point belongs to
+        self.owner = np.repeat(np.arange(len(order)), self.npoints)
+        self.tree = cKDTree(np.column_stack((self.x, self.y))) if len(reference) else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def points(self, positions):
+        """
+        Flat x, y arrays and start offsets of the reference fibrils at the given positions.
+        """
+        lengths = self.npoints[positions]
+        starts = np.cumsum(lengths) - lengths
+        index = np.repeat(self.starts[positions] - starts, lengths) + np.arange(lengths.sum())
+        return self.x[index], self.y[index], starts
+
+    def candidates(self, points):
+        """
+        Positions of the reference fibrils that can be the best match for a tested fibril.
+
+        The mean distance to the fibril holding most of the nearest neighbours of the tested points
+        bounds the best mean distance. The best match has at least one distance no larger than its
+        mean, so it has a point within this bound of some tested point.
+        """
+        _, nearest = self.tree.query(points)
+        guess = np.bincount(self.owner[nearest]).argmax()
+        x, y, starts = self.points([guess])
+        bound = self.statistics(points, x, y, starts, self.npoints[[guess]])[0][0]
+        near = self.tree.query_ball_point(points, bound, return_sorted=False)
+        return np.unique(self.owner[np.concatenate([np.asarray(n, dtype=int) for n in near])])
+
+    def statistics(self, points, x, y, starts, npoints):
+        """
+        Mean, minimum and maximum distance over the joint length of a tested fibril and each of
+        the given reference fibrils.
+        """
+        n = len(points)
+        step = max(1, CHUNK_DISTANCES // len(x))
+        dists = np.concatenate([candidate_distances(points[j:j+step], x, y, starts) for j in range(0, n, step)])
+        dists.sort(axis=0)
+        limit = np.minimum(npoints, n)
+        cols = np.arange(len(starts))
+        mean = np.cumsum(dists, axis=0)[limit-1, cols] / limit
+        return mean, dists[0], dists[limit-1, cols]
+
+def best_matches(reference, tested):
+    """
+    Find the closest reference fibril to each tested fibril.
+
+    For every tested fibril and every candidate reference fibril, the distance from each tested
+    point to the closest point of the candidate is calculated. The smallest N of these are kept,
+    N being the number of points in the shorter of the two fibrils. The candidate with the smallest
+    mean distance is the best match. Only reference fibrils near the tested fibril are candidates
+    (see ReferenceIndex.candidates), which gives the same result as trying all of them.
+
+    Parameters
+    ----------
+    reference : FibrilCoordinates or ReferenceIndex
+        Reference fibrils, or an index built over them
+    tested : FibrilCoordinates
+        Fibrils to find matches for
+
+    Returns
+    -------
+    numpy.ndarray
+        (number of tested fibrils, 9) array with the columns in BEST_MATCH_COLUMNS, in order of
+        increasing tested fibril ID. Fibrils with fewer than three points aren't compared, and
+        have NaN reference and distance columns. With no reference fibrils, the reference columns
+        are NaN and the distances infinite, so nothing is matched.
+    """
+    index = reference if isinstance(reference, ReferenceIndex) else ReferenceIndex(reference)
+    test_order = sorted_by_id(tested)
+    test_length = path_length(tested)
+
+    best = np.full((len(tested), 9), np.nan)
+    best[:,0] = tested.ids[test_order]
+    best[:,1] = tested.lengths[test_order]
+    best[:,2] = test_length[test_order]
+    if len(index) == 0:
+        best[tested.lengths[test_order] >= 3, 6:] = np.inf
+        return best
+    for row, i in enumerate(test_order):
+        n = tested.lengths[i]
+        if n < 3:
+            continue
+        part = slice(tested.offsets[i], tested.offsets[i] + n)
+        points = np.column_stack((tested.x[part], tested.y[part]))
+
+        # Candidates are in ID order, so ties go to the lowest ID as with a full scan
+        positions = index.candidates(points)
+        x, y, starts = index.points(positions)
+        mean, dmin, dmax = index.statistics(points, x, y, starts, index.npoints[positions])
+        k = np.argmin(mean)
+        pos = positions[k]
+        best[row] = [tested.ids[i], n, test_length[i],
+                     index.ids[pos], index.npoints[pos], index.length[pos],
+                     mean[k], dmin[k], dmax[k]]
+    return best
+
+def match_fraction(best, max_distance=10.0):
+    """
+    Fraction of tested fibrils whose best match has a minimum distance of at most max_distance
+    pixels (column 7 of the best-match table). Fibrils that weren't compared (fewer than three
+    points) are left out, and 0 is returned if no fibril was compared.
+    """
+    compared = best[~np.isnan(best[:,7])] if len(best) else best
+    if len(compared) == 0:
+        return 0.0
+    return np.count_nonzero(compared[:,7] <= max_distance)/len(compared)
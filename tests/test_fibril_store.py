@@ -0,0 +1,30 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "curve-tracing"))
+from coordinates import FibrilCoordinates
+from fibril_store import open_store, write_store
+
+@pytest.mark.parametrize("name", ["coords.fibrils", "coords.npz"])
+def test_coordinates_round_trip(tmp_path, name):
+    x = np.arange(7, dtype=float)
+    extra = np.column_stack((x*10, x*100))
+    coords = FibrilCoordinates.from_arrays([3, 3, 3, 8, 8, 1, 1], x, x + 0.5, extra)
+    path = str(tmp_path / name)
+    write_store(path, coords)
+    with open_store(path) as store:
+        assert store.columns == ["fibril_id", "x", "y", "extra_0", "extra_1"]
+        loaded = store.coordinates()
+        assert loaded.ids.tolist() == [3, 8, 1]
+        assert loaded.lengths.tolist() == [3, 2, 2]
+        assert np.array_equal(loaded.to_array(), coords.to_array())
+
+def test_coordinates_without_extra(tmp_path):
+    coords = FibrilCoordinates.from_features([[(0, 0), (1, 1)], [(2, 2)]])
+    path = str(tmp_path / "coords.fibrils")
+    write_store(path, coords)
+    with open_store(path) as store:
+        assert store.columns == ["fibril_id", "x", "y"]
+        assert np.array_equal(store.coordinates().to_array(), coords.to_array())
@@ -0,0 +1,37 @@
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "curve-tracing"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "optimization"))
+from coordinates import FibrilCoordinates
+from proximity import best_matches, match_fraction
+from optimize import match_percentages
+
+def line(x0, y0, n=10):
+    return np.column_stack((x0 + np.arange(n, dtype=float), np.full(n, float(y0))))
+
+def test_empty_reference_matches_nothing():
+    tested = FibrilCoordinates.from_features([line(0, 0), line(0, 50)])
+    best = best_matches(FibrilCoordinates.from_features([]), tested)
+    assert best.shape == (2, 9)
+    assert np.all(np.isinf(best[:,6:]))
+    assert match_fraction(best) == 0.0
+
+def test_no_fibrils_traced_scores_zero():
+    manual = FibrilCoordinates.from_features([line(0, 0), line(0, 50)])
+    assert match_percentages(FibrilCoordinates.from_features([]), manual) == (0.0, 0.0)
+
+def test_short_fibrils_are_left_out():
+    reference = FibrilCoordinates.from_features([line(0, 0)])
+    # Matched, unmatched (far away), and two too short to compare
+    tested = FibrilCoordinates.from_features([line(0, 1), line(0, 100), line(0, 0, 2), line(5, 5, 1)])
+    best = best_matches(reference, tested)
+    assert np.isnan(best[2:,7]).all()
+    assert match_fraction(best) == 0.5
+
+def test_only_short_fibrils():
+    reference = FibrilCoordinates.from_features([line(0, 0)])
+    best = best_matches(reference, FibrilCoordinates.from_features([line(0, 0, 2)]))
+    assert match_fraction(best) == 0.0
+    assert match_fraction(np.zeros((0, 9))) == 0.0
@@ -0,0 +1,36 @@
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "curve-tracing"))
+from tracking import Tracker, find_frames
+
+def line(x0, y0, n=10):
+    return np.column_stack((x0 + np.arange(n, dtype=float), np.full(n, float(y0))))
+
+def test_find_frames_skips_companion_files(tmp_path):
+    for name in ["coordinates-001.csv", "characteristics-001.csv", "frame-002.csv", "frame-002-characteristics.csv",
+                 "out-geometry.csv", "out-fibril-geometry.csv", "frame-003.dat", "notes.txt"]:
+        (tmp_path / name).write_text("")
+    names = [os.path.basename(path) for path in find_frames(str(tmp_path))]
+    assert names == ["coordinates-001.csv", "frame-002.csv", "frame-003.dat"]
+    assert find_frames(str(tmp_path / "frame-*.csv")) == [str(tmp_path / "frame-002-characteristics.csv"), str(tmp_path / "frame-002.csv")]
+
+def test_empty_frame_ends_tracks():
+    tracker = Tracker()
+    frame = [line(0, 0), line(0, 20)]
+    assert tracker.update(frame).tolist() == [0, 1]
+    assert tracker.update([]).tolist() == []
+    assert tracker.update(frame).tolist() == [2, 3]
+
+def test_tracks_continue_over_gaps():
+    tracker = Tracker(max_gap=1)
+    frame = [line(0, 0), line(0, 20)]
+    assert tracker.update(frame).tolist() == [0, 1]
+    assert tracker.update([]).tolist() == []
+    assert tracker.update(frame[::-1]).tolist() == [1, 0]
+    # Missing for longer than max_gap
+    assert tracker.update([frame[1]]).tolist() == [1]
+    tracker.update([])
+    tracker.update([])
+    assert tracker.update(frame).tolist() == [2, 3]